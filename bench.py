@@ -0,0 +1,652 @@
+"""Microbenchmarks for the hub and domain servers.
+
+Run as e.g. `python bench.py query` to run one benchmark, or `python bench.py` to run them all.
+Each benchmark sets up the module-level state it needs directly, so no servers need to be running.
+"""
+import asyncio
+import time
+
+import codec
+import hub
+
+benchmarks = {}
+
+def benchmark(f):
+    """Register a benchmark under its function name"""
+    benchmarks[f.__name__] = f
+    return f
+
+
+def fake_world(ndomains=1, nitems=0):
+    """Reset hub state to a play-mode world with registered domains and item templates"""
+    hub.users.clear(); hub.domains.clear(); hub.templates.clear()
+    for did in range(ndomains):
+        hub.domains[did] = {'url':f'http://domain{did}.invalid:1', 'name':f'domain {did}',
+            'description':'A benchmark domain', 'secret':hub.tokens.issue(hub.signing_key, 'd', did, 3600), 'loot':[]}
+    for tid in range(nitems):
+        hub.templates[tid] = {'name':f'thing{tid}', 'description':'A benchmark item',
+            'verb':{'use':'You use it.'}, 'home':tid % ndomains}
+    hub.mode = 'play'
+
+
+def fake_user(nitems, did=0):
+    """Add a user with nitems items: ten carried and the rest dropped ten to a room in domain did"""
+    user = hub.User(did)
+    for tid in range(nitems):
+        user.inventory[tid] = 'inventory' if tid < 10 else (did, f'room{tid//10}')
+        if tid < 10: user.mark_had(tid)
+    hub.users.append(user)
+
+
+async def hub_client(**settings):
+    """An in-process test client for the hub's routes, on an Application(**settings)"""
+    from aiohttp.test_utils import TestServer, TestClient
+    app = hub.web.Application(**settings)
+    app.add_routes(hub.routes)
+    client = TestClient(TestServer(app))
+    await client.start_server()
+    return client
+
+
+@benchmark
+async def query(rounds=500):
+    """/query latency as a single user's inventory grows"""
+    client = await hub_client()
+    try:
+        print(f'{"items":>8} {"location=inventory":>20} {"location=room3":>16}')
+        for n in (10, 100, 1000, 10000, 100000):
+            fake_world(1, n)
+            fake_user(n)
+            row = []
+            for where in ('inventory', 'room3'):
+                body = {'domain':0, 'secret':hub.domains[0]['secret'], 'user':0, 'location':where}
+                for _ in range(rounds//10): # warm-up
+                    async with client.post('/query', json=body) as resp:
+                        await resp.read()
+                t0 = time.perf_counter()
+                for _ in range(rounds):
+                    async with client.post('/query', json=body) as resp:
+                        await resp.read()
+                row.append((time.perf_counter()-t0)/rounds*1e6)
+            print(f'{n:>8} {row[0]:>17.1f} µs {row[1]:>13.1f} µs')
+    finally:
+        await client.close()
+
+
+def legacy_arrive_body(uid, dest, src='login'):
+    """/arrive body built the way hub.arrive did before briefs were cached, for comparison"""
+    import json
+    owned, carried, dropped, prize = [],[],[],[]
+    for tid, loc in hub.users[uid].inventory.items():
+        t = hub.templates[tid]
+        brief = {k:v for k,v in t.items() if k in ('name','description','verb')}
+        brief['id'] = tid
+        if loc == 'inventory':
+            if t['home'] == dest: owned.append(brief)
+            else: carried.append(brief)
+        elif loc[0] == dest:
+            brief['location'] = loc[1]
+            dropped.append(brief)
+    for tid in hub.domains[dest]['loot']:
+        if tid not in hub.users[uid].inventory:
+            t = hub.templates[tid]
+            brief = {k:v for k,v in t.items() if k in ('name','description','verb','depth')}
+            brief['id'] = tid
+            prize.append(brief)
+    return json.dumps({'secret':hub.domains[dest]['secret'], 'user':uid, 'from':src,
+        'owned':owned, 'carried':carried, 'dropped':dropped, 'prize':prize}).encode()
+
+
+@benchmark
+async def arrive(rounds=200):
+    """/arrive payload build time as a user's inventory grows"""
+    print(f'{"items":>8} {"per-call build":>16} {"cached briefs":>16} {"speed-up":>9}')
+    for n in (10, 100, 1000, 10000):
+        fake_world(2, n)
+        hub.domains[0]['loot'] = list(range(0, n, 7))
+        hub.make_briefs()
+        hub.users.append(hub.User(0))
+        for tid in range(n):
+            if tid % 7: hub.users[0].inventory[tid] = 'inventory' if tid % 3 else (0, f'room{tid%5}')
+        assert codec.decode(hub.arrive_body(0, 0)) == codec.decode(legacy_arrive_body(0, 0))
+        row = []
+        for build in (legacy_arrive_body, hub.arrive_body):
+            t0 = time.perf_counter()
+            for _ in range(rounds): build(0, 0)
+            row.append((time.perf_counter()-t0)/rounds*1e6)
+        print(f'{n:>8} {row[0]:>13.1f} µs {row[1]:>13.1f} µs {row[0]/row[1]:>8.1f}x')
+
+
+@benchmark
+async def codecs(rounds=2000):
+    """encode and decode+validate time of each installed JSON backend on /arrive and /query bodies"""
+    fake_world(2, 200)
+    hub.domains[0]['loot'] = list(range(0, 200, 20))
+    hub.make_briefs()
+    fake_user(200)
+    bodies = {
+        '/arrive': (codec.ArriveRequest, codec.decode(hub.arrive_body(0, 0))),
+        '/query': (codec.QueryRequest, {'domain':0, 'secret':hub.domains[0]['secret'], 'user':0, 'location':'inventory'}),
+        '/query reply': (None, list(hub.users[0].inventory.carried)),
+    }
+    print(f'{"backend":>8} {"body":>12} {"bytes":>6} {"encode":>10} {"decode":>10}')
+    before = codec.backend
+    try:
+        for name in codec.backends:
+            codec.use(name)
+            for what, (shape, data) in bodies.items():
+                t0 = time.perf_counter()
+                for _ in range(rounds): body = codec.dumps(data)
+                t1 = time.perf_counter()
+                for _ in range(rounds): codec.decode(body, shape)
+                t2 = time.perf_counter()
+                print(f'{name:>8} {what:>12} {len(body):>6} {(t1-t0)/rounds*1e6:>7.2f} µs {(t2-t1)/rounds*1e6:>7.2f} µs')
+    finally:
+        codec.use(before)
+
+
+@benchmark
+async def loot():
+    """assign_loot time distributing depth-tagged templates across many domains"""
+    print(f'{"domains":>8} {"templates":>10} {"time":>10} {"per template":>13}')
+    for ndomains, nitems in ((10, 1000), (100, 10000), (1000, 100000)):
+        fake_world(ndomains, nitems)
+        for tid, t in hub.templates.items(): t['depth'] = tid % 4
+        hub.make_map()
+        t0 = time.perf_counter()
+        hub.assign_loot()
+        t1 = time.perf_counter()
+        assert sum(len(hub.domains[did]['loot']) for did in hub.domains) == nitems + len(hub.others_items)
+        print(f'{ndomains:>8} {nitems:>10} {(t1-t0)*1e3:>7.1f} ms {(t1-t0)/nitems*1e6:>10.2f} µs')
+
+
+@benchmark
+async def worldgen(ndomains=2500, nitems=250000):
+    """time from POST /mode play to play mode, and the longest event-loop stall meanwhile, generating on the loop as before vs in a child process"""
+    client = await hub_client()
+    lags = []
+    async def ticker():
+        while True:
+            t0 = time.perf_counter()
+            await asyncio.sleep(0.001)
+            lags.append(time.perf_counter() - t0 - 0.001)
+
+    async def on_loop():
+        """What set_mode did before: generate the world without yielding to the loop"""
+        hub.make_map(); hub.assign_loot(); hub.make_briefs()
+        hub.mode = 'play'
+
+    async def off_loop():
+        async with client.post('/mode', data='play') as resp:
+            assert resp.status == 200, await resp.text()
+
+    try:
+        print(f'{"generation":>12} {"to play":>9} {"longest stall":>14}')
+        for label, enter_play in (('on loop', on_loop), ('child', off_loop)):
+            fake_world(ndomains, nitems)
+            for tid, t in hub.templates.items(): t['depth'] = tid % 4
+            hub.mode = 'setup'
+            task = asyncio.create_task(ticker())
+            await asyncio.sleep(0.01)
+            lags.clear()
+            t0 = time.perf_counter()
+            await enter_play()
+            took = time.perf_counter() - t0
+            await asyncio.sleep(0.01) # let the ticker see the stall it was held up by
+            task.cancel()
+            assert hub.mode == 'play' and len(hub.briefs) == nitems + len(hub.others_items)
+            print(f'{label:>12} {took:>7.2f} s {max(lags)*1e3:>11.1f} ms')
+    finally:
+        await client.close()
+
+
+@benchmark
+async def register(sizes=(10000, 100000)):
+    """/register of a domain with many items as one JSON body vs streamed NDJSON: time, longest event-loop stall, and memory held meanwhile beyond the templates"""
+    import tracemalloc
+    client = await hub_client(client_max_size=1 << 30) # the JSON body is over aiohttp's 1 MiB default
+    lags = []
+    async def ticker():
+        while True:
+            t0 = time.perf_counter()
+            await asyncio.sleep(0.001)
+            lags.append(time.perf_counter() - t0 - 0.001)
+    try:
+        print(f'{"items":>8} {"body":>7} {"time":>10} {"longest stall":>14} {"held":>9}')
+        for n in sizes:
+            info = {'url':'http://big.invalid:1', 'name':'big', 'description':'A benchmark domain'}
+            items = [{'name':f'thing{i}', 'description':'A benchmark item', 'verb':{'use':'You use it.'}, 'depth':i % 4} for i in range(n)]
+            whole = codec.dumps(info | {'items':items})
+            sends = (('json', lambda: client.post('/register', data=whole, headers={'Content-Type':'application/json'})),
+                ('ndjson', lambda: client.post('/register', data=codec.ndjson(info, items), headers={'Content-Type':'application/x-ndjson'})))
+            for label, send in sends:
+                row = []
+                for traced in (False, True):
+                    fake_world(0, 0)
+                    hub.mode = 'setup'
+                    if traced:
+                        tracemalloc.start()
+                    task = asyncio.create_task(ticker())
+                    await asyncio.sleep(0.01)
+                    lags.clear()
+                    t0 = time.perf_counter()
+                    async with send() as resp:
+                        assert resp.status == 200, await resp.text()
+                        await resp.read()
+                    took = time.perf_counter() - t0
+                    await asyncio.sleep(0.01)
+                    task.cancel()
+                    assert len(hub.templates) == n
+                    if traced:
+                        now, peak = tracemalloc.get_traced_memory()
+                        tracemalloc.stop()
+                        row.append((peak - now) / 2**20)
+                    else:
+                        row += [took*1e3, max(lags)*1e3]
+                print(f'{n:>8} {label:>7} {row[0]:>7.0f} ms {row[1]:>11.1f} ms {row[2]:>6.1f} MB')
+    finally:
+        await client.close()
+
+
+@benchmark
+async def journal(rounds=100000):
+    """write-ahead log cost per logged change, and restart time as the number of users grows"""
+    import os, shutil, tempfile
+    path = tempfile.mkdtemp()
+    try:
+        fake_world(10, 100)
+        hub.restore(path)
+        t0 = time.perf_counter()
+        for i in range(rounds): hub.logged('move', i % 1000, i % 100, (i % 10, 'room'))
+        print(f'append: {(time.perf_counter()-t0)/rounds*1e6:.2f} µs per logged change')
+        hub.journal.close()
+
+        print(f'{"users":>8} {"snapshot":>10} {"size":>8} {"restart, replaying 100k log records":>36}')
+        for n in (1000, 10000, 100000, 1000000):
+            shutil.rmtree(path)
+            fake_world(10, 100)
+            hub.restore(path)
+            for uid in range(n):
+                hub.users.append(hub.User(uid % 10))
+                for tid in range(uid % 4): hub.users[uid].inventory[tid] = 'inventory'
+            hub.mode = 'play'
+            t0 = time.perf_counter()
+            await hub.journal.snapshot(hub.world_state())
+            t1 = time.perf_counter()
+            for i in range(100000): hub.logged('move', i % n, i % 100, (i % 10, 'room'))
+            hub.journal.close()
+            size = os.path.getsize(os.path.join(path, 'snapshot'))
+            hub.users.clear()
+            t2 = time.perf_counter()
+            hub.restore(path)
+            t3 = time.perf_counter()
+            assert len(hub.users) == n
+            hub.journal.close()
+            print(f'{n:>8} {t1-t0:>8.2f} s {size/2**20:>5.1f} MB {t3-t2:>34.2f} s')
+    finally:
+        hub.journal = None
+        shutil.rmtree(path)
+
+
+@benchmark
+async def journey(rounds=10, slow=0.2):
+    """journey latency with a slow stand-in domain, awaiting /depart then /arrive as before vs queued notifications"""
+    from aiohttp import ClientSession
+    from aiohttp.test_utils import TestServer
+    from types import SimpleNamespace
+    delay = {} # {endpoint: seconds the stand-in domains take to answer it}
+    async def stand_in(req):
+        await asyncio.sleep(delay.get(req.match_info['endpoint'], 0))
+        return hub.web.Response(text='ok')
+    domain_app = hub.web.Application()
+    domain_app.router.add_post('/d/{n}/{endpoint}', stand_in)
+    server = TestServer(domain_app)
+    await server.start_server()
+    app = SimpleNamespace(client=ClientSession())
+    fake_world(2)
+    for did in hub.domains: hub.domains[did]['url'] = str(server.make_url(f'/d/{did}'))
+    hub.neighbors.clear()
+    hub.neighbors.update({0:{'north':1}, 1:{'south':0}})
+    hub.others_items[:] = [{'id':-1, 'name':'nothing'}]*3
+    hub.users.append(hub.User(0))
+
+    async def awaiting_each(way):
+        """What journey did before: tell the domain being left, then the one entered, then reply"""
+        me = hub.users[0]
+        dest = hub.neighbors[me.domain].get(way, me.domain)
+        async with app.client.post(hub.domains[me.domain]['url']+'/depart', json={'secret':hub.domains[me.domain]['secret'], 'user':0}) as resp:
+            await resp.read()
+        me.domain = dest
+        async with app.client.post(hub.domains[dest]['url']+'/arrive', data=hub.arrive_body(0, dest)) as resp:
+            await resp.read()
+
+    async def queued(way):
+        await hub.journey(0, [way], app)
+
+    try:
+        print(f'{"scenario":>28} {"await each":>12} {"queued":>10}')
+        for label, endpoint, between in (('fast domains', None, True), (f'{slow*1e3:.0f} ms /depart', 'depart', True),
+                (f'{slow*1e3:.0f} ms /arrive', 'arrive', True), (f'{slow*1e3:.0f} ms /depart, wilderness', 'depart', False)):
+            delay.clear()
+            if endpoint: delay[endpoint] = slow
+            row = []
+            for journey in (awaiting_each, queued):
+                took = 0
+                for _ in range(rounds):
+                    t0 = time.perf_counter()
+                    await journey(('north' if hub.users[0].domain == 0 else 'south') if between else 'east')
+                    took += time.perf_counter() - t0
+                    await asyncio.sleep(slow*1.5) # a player's pause, long enough for a slow domain to catch up
+                row.append(took/rounds*1e3)
+            print(f'{label:>28} {row[0]:>9.1f} ms {row[1]:>7.1f} ms')
+    finally:
+        await app.client.close()
+        await server.close()
+
+
+@benchmark
+async def breaker(rounds=40, hang=0.25):
+    """forwarded commands to a hung domain, each waiting out the timeout as before vs with its circuit breaker"""
+    from aiohttp import ClientSession, ClientTimeout
+    from aiohttp.test_utils import TestServer
+    from types import SimpleNamespace
+    async def hung(req):
+        await asyncio.sleep(60)
+    domain_app = hub.web.Application()
+    domain_app.router.add_post('/command', hung)
+    server = TestServer(domain_app)
+    await server.start_server()
+    app = SimpleNamespace(client=ClientSession(timeout=ClientTimeout(total=hang)))
+    fake_world(1)
+    hub.domains[0]['url'] = str(server.make_url(''))
+    hub.users.append(hub.User(0))
+    saved = hub.health.max_timeout, dict(hub.health.domains)
+    hub.health.max_timeout = hang
+    hub.health.domains.clear()
+
+    async def waiting(uid, cmd, app):
+        """What forwarding did before: every command waits for the domain until the timeout"""
+        try:
+            async with app.client.post(hub.domains[0]['url']+'/command', json={'user':uid, 'command':cmd}) as resp:
+                return resp.status, await resp.text()
+        except BaseException as ex:
+            return 502, repr(ex)
+
+    try:
+        print(f'{"forwarding":>12} {"first 5 ms":>11} {"rest ms":>9} {"total s":>8}')
+        for label, forward in (('waiting', waiting), ('breaker', hub.domain_command)):
+            took = []
+            for _ in range(rounds):
+                t0 = time.perf_counter()
+                await forward(0, ['look'], app)
+                took.append(time.perf_counter() - t0)
+            print(f'{label:>12} {sum(took[:5])/5*1e3:>11.1f} {sum(took[5:])/(rounds-5)*1e3:>9.3f} {sum(took):>8.2f}')
+    finally:
+        hub.health.max_timeout = saved[0]
+        hub.health.domains.clear(); hub.health.domains.update(saved[1])
+        await app.client.close()
+        await server.close()
+
+
+@benchmark
+async def metrics(rounds=200000):
+    """per-request cost of the metrics middleware, and of rendering /metrics"""
+    import metrics
+    from aiohttp.test_utils import make_mocked_request
+    app = hub.web.Application()
+    app.add_routes(hub.routes)
+    req = make_mocked_request('POST', '/command', app=app)
+    req._match_info = await app.router.resolve(req)
+    req['verb'] = 'look'
+    resp = hub.web.Response(text='ok')
+    async def handler(req): return resp
+    t0 = time.perf_counter()
+    for _ in range(rounds): await handler(req)
+    t1 = time.perf_counter()
+    for _ in range(rounds): await metrics.middleware(req, handler)
+    t2 = time.perf_counter()
+    print(f'middleware: {((t2-t1)-(t1-t0))/rounds*1e6:.2f} µs per request')
+    t0 = time.perf_counter()
+    text = metrics.render()
+    print(f'render: {(time.perf_counter()-t0)*1e3:.2f} ms for {len(text.splitlines())} lines')
+
+
+@benchmark
+async def auth(rounds=200000):
+    """checkuid and checkdid per request, comparing stored secrets as before vs verifying signed tokens"""
+    fake_world(1)
+    fake_user(0)
+    secrets = {'u':{0:'Ab3dEf6hIj9lMn2p'}, 'd':{0:'Qr5tUv8xYz1bCd4f'}}
+    def legacy_check(kind, data):
+        """What checkuid and checkdid did: look the id up and compare its stored secret"""
+        id = data['user' if kind == 'u' else 'domain']
+        if hub.mode != 'play': return None
+        if id not in secrets[kind]: return None
+        if secrets[kind][id] != data['secret']: return None
+        return id
+    print(f'{"check":>9} {"stored secret":>14} {"signed token":>13}')
+    for kind, check in (('u', hub.checkuid), ('d', hub.checkdid)):
+        field = 'user' if kind == 'u' else 'domain'
+        legacy = {field:0, 'secret':secrets[kind][0]}
+        signed = {field:0, 'secret':hub.tokens.issue(hub.signing_key, kind, 0, 3600)}
+        assert legacy_check(kind, legacy) == check(signed) == 0
+        t0 = time.perf_counter()
+        for _ in range(rounds): legacy_check(kind, legacy)
+        t1 = time.perf_counter()
+        for _ in range(rounds): check(signed)
+        t2 = time.perf_counter()
+        print(f'{check.__name__:>9} {(t1-t0)/rounds*1e6:>11.2f} µs {(t2-t1)/rounds*1e6:>10.2f} µs')
+
+
+@benchmark
+async def page(rounds=2000):
+    """GET / throughput, reading tba.html with FileResponse each time as before vs served from memory"""
+    import static
+    from aiohttp.test_utils import TestServer, TestClient
+    async def file_response(req): return hub.web.FileResponse(path='tba.html')
+    app = hub.web.Application()
+    app.router.add_get('/before', file_response)
+    app.cleanup_ctx.append(static.watch)
+    app.add_routes(static.routes)
+    client = TestClient(TestServer(app))
+    await client.start_server()
+    try:
+        etags = {}
+        for path in ('/before', '/'):
+            async with client.get(path, headers={'Accept-Encoding':'gzip'}) as resp:
+                etags[path] = resp.headers.get('ETag', '')
+        print(f'{"request":>26} {"before":>12} {"after":>12} {"bytes after":>12}')
+        for label, headers in (('plain', {'Accept-Encoding':''}), ('gzip', {'Accept-Encoding':'gzip'}),
+                ('gzip, If-None-Match', {'Accept-Encoding':'gzip'})):
+            row = []
+            for path in ('/before', '/'):
+                if 'None' in label: headers['If-None-Match'] = etags[path]
+                t0 = time.perf_counter()
+                for _ in range(rounds):
+                    async with client.get(path, headers=headers, auto_decompress=False) as resp:
+                        body = await resp.read()
+                row.append(rounds/(time.perf_counter()-t0))
+            print(f'{label:>26} {row[0]:>8.0f} r/s {row[1]:>8.0f} r/s {len(body):>12} {resp.status}')
+    finally:
+        await client.close()
+
+
+@benchmark
+async def batch(total=2000):
+    """hub commands per second sent one per /command request vs n per /commands request, over 100 users"""
+    client = await hub_client()
+    try:
+        fake_world(1, 100)
+        for uid in range(100): fake_user(20)
+        secrets = [hub.tokens.issue(hub.signing_key, 'u', uid, 3600) for uid in range(100)]
+        entries = [{'user':i % 100, 'secret':secrets[i % 100], 'command':['inventory']} for i in range(total)]
+        print(f'{"per request":>12} {"commands/s":>11} {"speed-up":>9}')
+        t0 = time.perf_counter()
+        for entry in entries:
+            async with client.post('/command', json=entry) as resp:
+                await resp.read()
+        one = total/(time.perf_counter()-t0)
+        print(f'{1:>12} {one:>11.0f} {1:>8.1f}x')
+        for n in (10, 100, 1000):
+            t0 = time.perf_counter()
+            for i in range(0, total, n):
+                async with client.post('/commands', json={'commands':entries[i:i+n]}) as resp:
+                    results = await resp.json()
+            assert all(r['status'] == 200 for r in results)
+            rate = total/(time.perf_counter()-t0)
+            print(f'{n:>12} {rate:>11.0f} {rate/one:>8.1f}x')
+    finally:
+        await client.close()
+
+
+@benchmark
+async def leaderboard(n=1000000, rounds=20000):
+    """score updates, rank and top-10 queries with a million players, vs sorting every total per query"""
+    import random
+    from leaderboard import Leaderboard
+    rng = random.Random(1)
+    totals = [rng.randrange(400)/2 for _ in range(n)]
+    board = Leaderboard()
+    t0 = time.perf_counter()
+    board.build(enumerate(totals))
+    print(f'build: {time.perf_counter()-t0:.2f} s for {n} players')
+    uids = [rng.randrange(n) for _ in range(rounds)]
+    t0 = time.perf_counter()
+    for uid in uids:
+        totals[uid] += .5
+        board.set(uid, totals[uid])
+    print(f'update: {(time.perf_counter()-t0)/rounds*1e6:.2f} µs')
+    t0 = time.perf_counter()
+    for uid in uids: board.above(totals[uid])
+    print(f'rank:   {(time.perf_counter()-t0)/rounds*1e6:.2f} µs')
+    t0 = time.perf_counter()
+    for _ in range(rounds): board.top(10)
+    print(f'top 10: {(time.perf_counter()-t0)/rounds*1e6:.2f} µs')
+    t0 = time.perf_counter()
+    for uid in uids[:3]:
+        ranked = sorted(range(n), key=totals.__getitem__, reverse=True)
+        sum(1 for t in totals if t > totals[uid]), ranked[:10]
+    print(f'scan:   {(time.perf_counter()-t0)/3*1e6:.0f} µs per rank and top 10, sorting every total')
+
+
+@benchmark
+async def logging(rounds=100000):
+    """cost on the event loop per logged event: print() as before vs eventlog disabled, sampled out and queued"""
+    import eventlog, os
+    was = eventlog.level, eventlog.stream
+    try:
+        with open(os.devnull, 'w') as devnull:
+            eventlog.stream = devnull
+            eventlog.start()
+            t0 = time.perf_counter()
+            for uid in range(rounds):
+                print(f"ARRIVE - Before: User {uid} state exists: {True}", file=devnull, flush=True)
+            row = [('print, flushed', time.perf_counter()-t0)]
+            for label, level, sample in (('disabled level', 'warning', None), ('sampled out', 'info', 0.0), ('queued', 'info', None)):
+                eventlog.level = eventlog.levels[level]
+                eventlog.sample.pop('bench', None)
+                if sample is not None: eventlog.sample['bench'] = sample
+                t0 = time.perf_counter()
+                for uid in range(rounds):
+                    eventlog.info('bench', user=uid, known=True)
+                row.append((label, time.perf_counter()-t0))
+                eventlog.stop()
+                eventlog.start()
+            eventlog.stop()
+    finally:
+        eventlog.level, eventlog.stream = was
+        eventlog.sample.pop('bench', None)
+    for label, seconds in row:
+        print(f'{label:>16} {seconds/rounds*1e6:>7.2f} µs')
+
+
+def legacy_room_text(state):
+    """newdomain's look text built the way handle_command did before it was cached, for comparison"""
+    import newdomain
+    response = newdomain.locs[state.location]['description']
+    for item in state.here().values():
+        if (state.location != 'vip-lounge' or
+            not state.keypad_locked or
+            item.get('depth', 0) == 0):
+            if state.location == 'vip-lounge' and item.get('depth', 0) >= 1:
+                response += f"\nThere is a {item['name']} <sub>{item['id']}</sub> in the VIP section."
+            else:
+                response += f"\nThere is a {item['name']} <sub>{item['id']}</sub> here."
+    return response
+
+
+@benchmark
+async def verbs(rounds=20000):
+    """newdomain time per command verb, and look text built each time as before vs cached as rooms fill up"""
+    import newdomain
+    from types import SimpleNamespace
+    req = SimpleNamespace(app=None)
+    newdomain.item_ids.update(enumerate(range(100, 105)))
+    newdomain.users.clear()
+    state = newdomain.users[0] = newdomain.UserState()
+    newdomain.inventories[0] = ({100, 101, 104}, time.monotonic() + 1e9) # never goes stale, so no /query
+    for tid in range(10):
+        state.place('vip-lounge', {'name':f'thing{tid}', 'id':200+tid, 'depth':tid % 3})
+    print(f'{"command":>26} {"time":>10}')
+    for location, words in (('boutique-entrance', ['look']), ('boutique-entrance', ['look', 'sales-flyer']),
+            ('boutique-entrance', ['read', 'sales-flyer']), ('boutique-entrance', ['go', 'east']),
+            ('vip-lounge', ['look']), ('vip-lounge', ['tell', 'keypad', 'vip000']),
+            ('vip-lounge', ['use', 'gold-card']), ('boutique-entrance', ['dance'])):
+        t0 = time.perf_counter()
+        for _ in range(rounds):
+            state.location = location
+            handler, fewest, most = newdomain.commands.get(words[0], (None, 0, -1))
+            if fewest <= len(words)-1 <= most: await handler(req, 0, state, words[1:])
+        print(f'{" ".join(words)+" in "+location[:3]:>26} {(time.perf_counter()-t0)/rounds*1e6:>7.2f} µs')
+
+    print(f'\n{"items in room":>14} {"look before":>12} {"cached":>10}')
+    state.location = 'shopping-area'
+    for n in (0, 10, 100, 1000):
+        for tid in range(len(state.here()), n):
+            state.place('shopping-area', {'name':f'thing{tid}', 'id':1000+tid})
+        assert legacy_room_text(state) == newdomain.room_text(state)
+        row = []
+        for build in (legacy_room_text, newdomain.room_text):
+            t0 = time.perf_counter()
+            for _ in range(rounds//10): build(state)
+            row.append((time.perf_counter()-t0)/(rounds//10)*1e6)
+        print(f'{n:>14} {row[0]:>9.2f} µs {row[1]:>7.2f} µs')
+
+
+@benchmark
+async def memory(n=100000):
+    """bytes per user held by the hub, for users who just logged in and users with a few items"""
+    import gc, tracemalloc
+    print(f'{"users":>8} {"items each":>11} {"per user":>12}')
+    for nitems in (0, 5):
+        fake_world(100, 10000)
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        for uid in range(n):
+            did = uid % 100
+            hub.users.append(hub.User(did))
+            me = hub.users[uid]
+            me.score[did] = 0
+            for k in range(nitems):
+                tid = 1000*k + uid % 50
+                me.inventory[tid] = 'inventory' if k < 3 else ((did+k) % 100, f'room{k}')
+                if k < 3: me.mark_had(tid)
+            if nitems: me.score[(did+1) % 100] = 3.5
+        gc.collect()
+        used = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        print(f'{n:>8} {nitems:>11} {used/n:>7.0f} bytes')
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('which', nargs='*', help='benchmarks to run (default: all of '+', '.join(benchmarks)+')')
+    args = parser.parse_args()
+    for name in args.which:
+        if name not in benchmarks: parser.error('unknown benchmark '+repr(name))
+    for name in args.which or benchmarks:
+        print(f'## {name}: {benchmarks[name].__doc__}')
+        asyncio.run(benchmarks[name]())
+        print()
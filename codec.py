@@ -0,0 +1,261 @@
+"""JSON encoding and decoding shared by the hub and domain servers.
+
+Uses msgspec or orjson when one is installed and the standard library's json module otherwise;
+set the TBA_JSON environment variable to "msgspec", "orjson" or "json" to pick one.
+
+Request bodies are checked against one of the TypedDict shapes below while they are decoded,
+so route handlers can assume the fields they need are present and of the right type.
+Bodies too long to hold at once, such as a big domain's items, are streamed as NDJSON (one value
+per line): send them with ndjson() and decode them a batch of lines at a time with decode_lines().
+"""
+from aiohttp import web
+from typing import Any, NotRequired, TypedDict, get_args, get_origin, get_type_hints
+import json
+import os
+
+
+##################################
+###  Section: request shapes  ###
+
+class UserRequest(TypedDict):
+    """Sent by players to the hub"""
+    user: int
+    secret: str
+
+class CommandRequest(UserRequest):
+    command: list[str]
+
+class BatchRequest(TypedDict):
+    """Sent by scripted players to the hub's /commands"""
+    commands: list[CommandRequest]
+
+class DomainRequest(TypedDict):
+    """Sent by domain servers to the hub"""
+    domain: int
+    secret: str
+
+class ScoreRequest(DomainRequest):
+    user: int
+    score: Any
+
+class TransferRequest(DomainRequest):
+    user: int
+    item: int
+    to: Any
+
+class QueryRequest(DomainRequest):
+    user: int
+    location: NotRequired[Any]
+    depth: NotRequired[int]
+
+class SocketCommand(TypedDict):
+    """Sent by players over the hub's /ws channel after they log in on it"""
+    id: int
+    command: list[str]
+    domain: NotRequired[bool]
+
+class ItemTemplate(TypedDict):
+    """One item a domain registers, in a /register body or one per line of a streamed one"""
+    name: NotRequired[str]
+    description: NotRequired[str]
+    verb: NotRequired[dict]
+    depth: NotRequired[Any] # used only if it is an integer, as it always was
+
+class DomainInfo(TypedDict):
+    """Sent by domain servers to the hub's /register, alone on the first line of a streamed registration"""
+    name: str
+    description: str
+    url: str
+
+class RegisterRequest(DomainInfo):
+    items: list[ItemTemplate]
+
+class HubRequest(TypedDict):
+    """Sent by the hub to domain servers"""
+    secret: str
+    user: int
+
+class DroppedRequest(HubRequest):
+    item: NotRequired[dict]
+
+ArriveRequest = TypedDict('ArriveRequest', {
+    'secret': str,
+    'user': int,
+    'from': NotRequired[str],
+    'owned': NotRequired[list[dict]],
+    'carried': NotRequired[list[dict]],
+    'dropped': NotRequired[list[dict]],
+    'prize': NotRequired[list[dict]],
+})
+
+class DomainCommandRequest(TypedDict):
+    """Sent by players to domain servers"""
+    user: int
+    command: list[str]
+
+class DomainBatchRequest(TypedDict):
+    """Sent by scripted players to a domain server's /commands"""
+    commands: list[DomainCommandRequest]
+
+
+###########################
+###  Section: backends  ###
+
+class BadRequest(ValueError):
+    """A request body that could not be decoded or did not have the expected shape"""
+
+
+def _describe(hint) -> str:
+    if get_origin(hint) is list:
+        inner = _describe(get_args(hint)[0])
+        if inner.startswith('an object with'): return 'a list of objects'+inner[9:]
+        return 'a list of '+{'a string':'strings', 'an integer':'integers', 'an object':'objects'}.get(inner, 'values')
+    if hasattr(hint, '__required_keys__'):
+        return 'an object with '+', '.join(get_type_hints(hint))
+    return {int:'an integer', float:'a number', str:'a string', dict:'an object', list:'a list'}.get(hint, 'a value')
+
+def _matches(value, hint) -> bool:
+    if hint is Any: return True
+    if get_origin(hint) is list:
+        return isinstance(value, list) and all(_matches(v, get_args(hint)[0]) for v in value)
+    if hasattr(hint, '__required_keys__'): # a nested TypedDict
+        try: _validate(value, hint)
+        except BadRequest: return False
+        return True
+    if isinstance(value, bool): return hint is bool
+    if hint is float: return isinstance(value, (int, float))
+    return isinstance(value, hint)
+
+_hints = {} # {shape: ((key, type hint),...)}
+
+def _validate(data, shape):
+    """Check decoded data against a TypedDict shape, or a list of them, for backends that can't do it while decoding"""
+    if get_origin(shape) is list:
+        if not isinstance(data, list):
+            raise BadRequest('JSON array required')
+        for i, value in enumerate(data):
+            try: _validate(value, get_args(shape)[0])
+            except BadRequest as ex: raise BadRequest(f'{ex} at [{i}]')
+        return data
+    if not isinstance(data, dict):
+        raise BadRequest('JSON object required')
+    if shape not in _hints:
+        _hints[shape] = tuple(get_type_hints(shape).items())
+    for key, hint in _hints[shape]:
+        if key not in data:
+            if key in shape.__required_keys__:
+                raise BadRequest('Request must contain '+key)
+        elif not _matches(data[key], hint):
+            raise BadRequest(f'Expected {key} to be {_describe(hint)}')
+    return data
+
+
+def _json_dumps(obj) -> bytes:
+    return json.dumps(obj, separators=(',',':')).encode()
+
+def _json_decode(body, shape=None):
+    try: data = json.loads(body)
+    except ValueError: raise BadRequest('JSON data required')
+    return data if shape is None else _validate(data, shape)
+
+backends = {'json': (_json_dumps, _json_decode)}
+
+try:
+    import orjson
+except ImportError:
+    pass
+else:
+    def _orjson_dumps(obj) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+    def _orjson_decode(body, shape=None):
+        try: data = orjson.loads(body)
+        except orjson.JSONDecodeError: raise BadRequest('JSON data required')
+        return data if shape is None else _validate(data, shape)
+
+    backends['orjson'] = (_orjson_dumps, _orjson_decode)
+
+try:
+    import msgspec
+except ImportError:
+    pass
+else:
+    _decoders = {None: msgspec.json.Decoder()}
+
+    def _msgspec_decode(body, shape=None):
+        if shape not in _decoders:
+            _decoders[shape] = msgspec.json.Decoder(shape)
+        try: return _decoders[shape].decode(body)
+        except msgspec.ValidationError as ex: raise BadRequest(str(ex))
+        except msgspec.DecodeError: raise BadRequest('JSON data required')
+
+    backends['msgspec'] = (msgspec.json.Encoder().encode, _msgspec_decode)
+
+
+def use(name: str) -> None:
+    """Switch every user of this module to the named backend"""
+    global backend, dumps, decode
+    backend = name
+    dumps, decode = backends[name]
+
+def decode_lines(lines:list[bytes], shape, first:int=1) -> list:
+    """Decode NDJSON lines, numbered from first, each to shape, in a single call to the backend when they're all fine"""
+    try:
+        data = decode(b'[' + b','.join(lines) + b']', list[shape])
+        if len(data) == len(lines): return data
+    except BadRequest:
+        pass
+    for i, line in enumerate(lines, first): # find the line that was wrong, to say so
+        try: decode(line, shape)
+        except BadRequest as ex: raise BadRequest(f'line {i}: {ex}')
+    raise BadRequest(f'lines {first} to {first+len(lines)-1}: one JSON value per line required')
+
+use(os.environ.get('TBA_JSON') or next(_ for _ in ('msgspec','orjson','json') if _ in backends))
+
+
+##################################
+###  Section: aiohttp helpers  ###
+
+def dumps_str(obj) -> str:
+    """For aiohttp's ClientSession(json_serialize=...), which wants a str"""
+    return dumps(obj).decode()
+
+def json_response(data=None, *, status: int = 200) -> web.Response:
+    """Like web.json_response, but encoded with the selected backend"""
+    return web.Response(body=dumps(data), status=status, content_type='application/json')
+
+async def ndjson(first, rest, every:int=1000):
+    """A streamed request body of first and then each of rest, one per line, sent every lines at a time"""
+    yield dumps(first) + b'\n'
+    batch = []
+    for obj in rest:
+        batch.append(dumps(obj))
+        if len(batch) == every:
+            yield b'\n'.join(batch) + b'\n'
+            batch.clear()
+    if batch: yield b'\n'.join(batch) + b'\n'
+
+async def read_lines(req : web.Request, chunk_size:int=1 << 16, longest:int=1 << 16):
+    """The non-blank lines of a streamed NDJSON request body as (number of the first, [line, ...]), a chunk at a time
+
+    Holds at most a chunk and one partial line of the body at once; raises BadRequest for a line over longest bytes.
+    """
+    n, pending = 1, b''
+    async for chunk in req.content.iter_chunked(chunk_size):
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        lines = [line for line in lines if line.strip()]
+        if any(len(line) > longest for line in lines) or len(pending) > longest:
+            raise BadRequest(f'Lines after line {n-1} must be at most {longest} bytes')
+        if lines:
+            yield n, lines
+            n += len(lines)
+    if pending.strip():
+        yield n, [pending]
+
+async def read(req : web.Request, shape=None) -> web.Response | Any:
+    """The decoded JSON body of a request, or an error response if it is malformed or the wrong shape"""
+    try:
+        return decode(await req.read(), shape)
+    except BadRequest as ex:
+        return json_response(status=400, data={'error':str(ex)})
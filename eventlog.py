@@ -0,0 +1,128 @@
+"""Structured event logging that keeps writes to stdout off the event loop.
+
+    eventlog.info('arrive', user=uid, new=True)
+
+queues the event for a background thread, which writes it as one JSON line:
+
+    {"t":1767225600.25,"level":"info","event":"arrive","user":3,"new":true}
+
+A call below the current `level` returns after one comparison. `sample` keeps only a fraction
+of an event type and `limit` caps how many of one are written per second; events they hold
+back are only counted, in tba_log_events_total on /metrics.
+
+Add `running` to an application's cleanup_ctx to start and stop the writer thread, and
+`arguments` to its argument parser with `configure` applied to the parsed arguments.
+"""
+import queue
+import random
+import sys
+import threading
+import time
+
+import codec
+import metrics
+
+levels = {'debug':10, 'info':20, 'warning':30, 'error':40, 'off':100}
+names = {v:k for k,v in levels.items()}
+level = levels['info']
+sample = {} # {event: fraction of them to write}
+limit = {} # {event: most of them to write per second}
+max_pending = 10000 # beyond this many unwritten events, drop new ones rather than fall further behind
+stream = sys.stdout
+
+outcomes = metrics.counter('tba_log_events_total', 'Log events at enabled levels, by type and whether they were queued, sampled out, rate limited or dropped', 'event', 'outcome')
+
+_pending = queue.SimpleQueue() # (time, level, event, fields), or None to stop the writer
+_buckets = {} # {event: [tokens, time.monotonic() when last refilled]}
+_writer = None
+
+
+def emit(levelno:int, event:str, fields:dict) -> None:
+    if event in sample and random.random() >= sample[event]:
+        metrics.count(outcomes, (event, 'sampled'))
+        return
+    if event in limit:
+        rate, now = limit[event], time.monotonic()
+        bucket = _buckets.setdefault(event, [rate, now])
+        bucket[0] = min(rate, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if bucket[0] < 1:
+            metrics.count(outcomes, (event, 'limited'))
+            return
+        bucket[0] -= 1
+    if _pending.qsize() >= max_pending:
+        metrics.count(outcomes, (event, 'dropped'))
+        return
+    metrics.count(outcomes, (event, 'queued'))
+    _pending.put((time.time(), levelno, event, fields))
+
+def debug(event:str, **fields) -> None:
+    if level <= 10: emit(10, event, fields)
+
+def info(event:str, **fields) -> None:
+    if level <= 20: emit(20, event, fields)
+
+def warning(event:str, **fields) -> None:
+    if level <= 30: emit(30, event, fields)
+
+def error(event:str, **fields) -> None:
+    if level <= 40: emit(40, event, fields)
+
+
+def _line(t:float, levelno:int, event:str, fields:dict) -> str:
+    record = {'t':round(t, 6), 'level':names[levelno], 'event':event} | fields
+    try:
+        return codec.dumps_str(record)
+    except Exception: # a field JSON can't represent
+        return codec.dumps_str({k:v if k in ('t','level','event') else repr(v) for k,v in record.items()})
+
+def _write() -> None:
+    """Write queued events until told to stop, a batch at a time"""
+    while True:
+        batch = [_pending.get()]
+        try:
+            while len(batch) < 1000: batch.append(_pending.get_nowait())
+        except queue.Empty:
+            pass
+        stop = None in batch
+        lines = [_line(*record) for record in batch if record is not None]
+        if lines:
+            try:
+                stream.write('\n'.join(lines)+'\n')
+                stream.flush()
+            except (OSError, ValueError):
+                pass
+        if stop: return
+
+def start() -> None:
+    global _writer
+    if _writer is None:
+        _writer = threading.Thread(target=_write, name='eventlog', daemon=True)
+        _writer.start()
+
+def stop() -> None:
+    """Write whatever is queued and stop the writer thread"""
+    global _writer
+    if _writer is not None:
+        _pending.put(None)
+        _writer.join(timeout=5)
+        _writer = None
+
+async def running(app):
+    start()
+    yield
+    stop()
+
+
+def arguments(parser) -> None:
+    parser.add_argument('--log-level', choices=list(levels), default=names[level], help='least severe events to log')
+    parser.add_argument('--log-sample', action='append', default=[], metavar='EVENT=FRACTION', help='log only this fraction of an event type')
+    parser.add_argument('--log-limit', action='append', default=[], metavar='EVENT=PER_SECOND', help='log at most this many of an event type each second')
+
+def configure(args) -> None:
+    global level
+    level = levels[args.log_level]
+    for option, into in ((args.log_sample, sample), (args.log_limit, limit)):
+        for setting in option:
+            event, _, value = setting.partition('=')
+            into[event] = float(value)
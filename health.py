@@ -0,0 +1,135 @@
+"""How each domain server has been answering the hub, and a circuit breaker for calls to it.
+
+For each domain the hub keeps whether each of its last `window` calls succeeded and a moving
+average of how long they took. Once enough recent calls have failed its circuit opens: calls
+to it raise Unavailable at once instead of each waiting out a timeout, so one hung domain
+can't hold up players elsewhere. After `cooldown` seconds a single call is let through as a
+probe; if it succeeds the circuit closes, and if not it stays open twice as long as before.
+
+Timeouts follow each domain's own latency: `timeout_factor` times its average, between
+`min_timeout` and `max_timeout`. Make calls with `post`, which does all of the above:
+
+    status, body = await health.post(app.client, did, url, json={...})
+
+Pass patient=True for calls that must not be cut short just because the domain is usually
+quick: /dropped, which isn't safe to give up on (the domain may have placed the item by the
+time the hub decides it wasn't dropped, leaving it in two places), and /arrive, whose bodies
+carry a player's whole inventory. Those wait `max_timeout`, as every call did before.
+"""
+from aiohttp import ClientSession, ClientTimeout
+import asyncio
+import collections
+import time
+
+import eventlog
+import metrics
+
+window = 20 # recent calls the error rate is taken over
+min_calls = 5 # fewest recent calls to judge a domain on
+trip_ratio = 0.5 # open the circuit once this fraction of recent calls failed
+cooldown = 2.0 # seconds the circuit first stays open for
+max_cooldown = 60.0
+smoothing = 0.2 # weight of each new call in the latency average
+timeout_factor = 4.0
+min_timeout = 0.25
+max_timeout = 3.0
+
+changes = metrics.counter('tba_domain_circuit_changes_total', 'Times a domain circuit opened, went half-open to probe, or closed again, by domain', 'domain', 'state')
+refused = metrics.counter('tba_domain_calls_refused_total', 'Calls to domains not made because their circuit was open, by domain', 'domain')
+
+
+class Unavailable(Exception):
+    """Raised instead of calling a domain whose circuit is open"""
+
+
+class Health:
+    """One domain's recent calls and circuit state: "closed" (calls go through), "open" or "half-open" (probing)"""
+    __slots__ = ('did', 'recent', 'latency', 'state', 'retry_at', 'backoff')
+
+    def __init__(self, did:int):
+        self.did = did
+        self.recent = collections.deque(maxlen=window) # True for each recent call that succeeded
+        self.latency = None # moving average of seconds per call
+        self.state = 'closed'
+        self.retry_at = 0.0 # time.monotonic() after which an open circuit lets a probe through
+        self.backoff = cooldown
+
+    def timeout(self) -> float:
+        if self.latency is None: return max_timeout
+        return min(max_timeout, max(min_timeout, self.latency * timeout_factor))
+
+    def errors(self) -> float:
+        """Fraction of recent calls that failed"""
+        return self.recent.count(False) / len(self.recent) if self.recent else 0.0
+
+    def usable(self) -> bool:
+        """Whether a call made now would be let through"""
+        return self.state == 'closed' or (self.state == 'open' and time.monotonic() >= self.retry_at)
+
+    def change(self, state:str) -> None:
+        self.state = state
+        metrics.count(changes, (self.did, state))
+        eventlog.warning('domain_circuit', domain=self.did, state=state, errors=round(self.errors(), 2),
+            latency=None if self.latency is None else round(self.latency, 4))
+
+    def begin(self) -> None:
+        """Call before each call to the domain; raises Unavailable if it shouldn't be made"""
+        if self.state == 'closed': return
+        if not self.usable():
+            metrics.count(refused, (self.did,))
+            raise Unavailable(f'domain {self.did} is not responding')
+        self.change('half-open') # this call is the probe; others are refused until it finishes
+
+    def done(self, ok:bool, seconds:float) -> None:
+        """Record how a call went"""
+        self.recent.append(ok)
+        self.latency = seconds if self.latency is None else self.latency + smoothing * (seconds - self.latency)
+        if self.state == 'half-open':
+            if ok:
+                self.backoff = cooldown
+                self.recent.clear()
+                self.change('closed')
+            else:
+                self.backoff = min(max_cooldown, self.backoff * 2)
+                self.trip()
+        elif not ok and self.state == 'closed' and len(self.recent) >= min_calls and self.errors() >= trip_ratio:
+            self.trip()
+
+    def trip(self) -> None:
+        self.retry_at = time.monotonic() + self.backoff
+        self.change('open')
+
+    def abandon(self) -> None:
+        """A call was cancelled before it finished: let another probe through if it was one"""
+        if self.state == 'half-open': self.state = 'open'
+
+
+domains = {} # {domain id: Health}
+
+def of(did:int) -> Health:
+    health = domains.get(did)
+    if health is None:
+        health = domains[did] = Health(did)
+    return health
+
+def usable(did:int) -> bool:
+    health = domains.get(did)
+    return health is None or health.usable()
+
+
+async def post(session:ClientSession, did:int, url:str, patient:bool=False, **kwargs) -> tuple[int, bytes]:
+    """POST to domain did, returning the status and body; 5xx replies and exceptions count against it"""
+    health = of(did)
+    health.begin()
+    t0 = time.perf_counter()
+    try:
+        async with session.post(url, timeout=ClientTimeout(total=max_timeout if patient else health.timeout()), **kwargs) as resp:
+            body = await resp.read()
+    except asyncio.CancelledError:
+        health.abandon()
+        raise
+    except Exception:
+        health.done(False, time.perf_counter() - t0)
+        raise
+    health.done(resp.status < 500, time.perf_counter() - t0)
+    return resp.status, body
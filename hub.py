@@ -1,5 +1,22 @@
 from aiohttp import web
+from array import array
+import asyncio
+import bisect
+import codec
+import eventlog
+import health
+from journal import Journal
+from leaderboard import Leaderboard
+import metrics
+import os
+import pickle
+import profiler
 import random
+import static
+import time
+import tokens
+import traffic
+from typing import Collection
 
 routes = web.RouteTableDef()
 
@@ -10,6 +27,9 @@ routes = web.RouteTableDef()
 
 # How all the domains a situated relative to on another
 grid = {} # {(x,y): domain_id}
+grid_size = 0 # the grid is a grid_size-by-grid_size torus
+neighbors = {} # {domain_id: {direction: domain_id}}, precomputed from grid by make_map
+directions = {'north':(0,1), 'south':(0,-1), 'east':(1,0), 'west':(-1,0)}
 
 # Information about each domain
 domains = {} # {domain_id:{"url":url, "name":str, "description":str, "cell":[x,y], "loot":[item_id]}}
@@ -17,12 +37,32 @@ domains = {} # {domain_id:{"url":url, "name":str, "description":str, "cell":[x,y
 # All item templates
 templates = {} # {item_id:{"name":str, "description":str, "home":domain_id, "hosts":[domain_id], "depth":int}}
 
+# Items each domain hosts for users from other domains, indexed by depth
+loot_index = {} # {domain_id: {depth: [item_id]}}
+
+# Pre-serialized JSON for each template, built once when play begins
+briefs = {} # {item_id: (b'{"name":...,"id":item_id' without its closing brace, b'{...,"depth":int,"id":item_id}')}
+
 # Centrally-tracked information about each user
-users = {} # id : {"in":domain_id, "open":[domain_id], "inventory":{item_id:location,...}}
+users = [] # [User], indexed by user id; None for users another worker process keeps
+leaders = Leaderboard() # this worker's users by total score, updated as scores change
+
+# With --workers, user uid is kept by worker process uid % workers
+worker = 0 # which one this is
+workers = 1
+
+# Every location an item has been at; inventories store indexes into this
+places = ['inventory'] # [location]
+place_codes = {'inventory':0} # {hashable location: index in places}
 
 # Global tracking of the different operation modes
 mode = "setup" # {"setup", "play", "locked"}
 
+# Signs the secrets handed out by /login and /register; see tokens.py
+signing_key = tokens.new_key()
+user_lifetime = 7*24*3600 # seconds a /login secret is good for
+domain_lifetime = 365*24*3600
+
 
 
 ##########################################################
@@ -39,29 +79,211 @@ item_verbs = {
     'eat':"The {0} is hard and has basically no flavor, but you force it down anyway.\n\nMoments later you feel a strange glow suffuse your body, starting from your belly and concentrating in your hand. You open you hand to see what the glow is like and inside you see the same {0}, as good as new.\n\nThe glow is gone now, but you have conflicted feelings. You feel foolish to have even tried to eat the {0}, but also morbidly curious if it would do the same thing if you ate it again...",
 }
 others_items = []
-domains_prizes = {}
+domains_prizes = {} # {home domain_id: {depth: [item_id]}} found in the wilderness rather than another domain
 
 
-###################################
-###  Section: helper functions  ###
+#####################################
+###  Section: compact user records  ###
 
 
-def make_secret(secure=False, nbytes=12):
-    """Creates a random string"""
-    if secure:
-        import secrets
-        return secrets.token_urlsafe(nbytes)
-    else:
-        import string
-        alphabet = string.ascii_letters + string.digits + '-_'
-        return ''.join(random.choice(alphabet) for _ in range(nbytes*8//6))
+def _loc_key(loc):
+    """Hashable form of a location; domains may pick JSON lists or objects as locations"""
+    if isinstance(loc, (list, tuple)):
+        return tuple(_loc_key(_) for _ in loc)
+    if isinstance(loc, dict):
+        return tuple(sorted((k, _loc_key(v)) for k,v in loc.items()))
+    return loc
+
+def place_code(loc, add:bool=True) -> int | None:
+    """The small int standing for a location in every user's inventory
+
+    A location not seen before is given the next code, or None is returned if add is False.
+    """
+    try:
+        return place_codes[loc]
+    except (KeyError, TypeError): # new, or a list or dict from JSON
+        key = _loc_key(loc)
+        code = place_codes.get(key)
+        if code is None and add:
+            code = place_codes[key] = len(places)
+            places.append(loc)
+        return code
+
+
+def _unpacked(data:bytes | None) -> array | tuple | None:
+    """Undo bytes(an array of item or place ids), which pickles far faster than the array itself"""
+    if data is None: return None
+    return array('I', data) if data else ()
+
+
+class Inventory:
+    """Where each item a user has ever interacted with is now.
+
+    Behaves like an {item_id:location} dict. Locations are stored as codes into `places`.
+    Most users have a handful of items, kept in two parallel arrays of item ids and codes
+    that are searched linearly. Once an inventory grows past `Inventory.small` items it
+    switches to dicts with reverse indexes, so that "what is at this location", "what is
+    carried" and "what is dropped in this domain" stay O(1) lookups; buckets are dicts
+    used as insertion-ordered sets.
+    """
+    __slots__ = ('tids', 'codes', 'where', 'at', 'dropped')
+    small = 32
+
+    def __init__(self):
+        self.tids = ()          # item ids, while small; an array once there are any
+        self.codes = ()         # their place codes, while small
+        self.where = None       # {item_id: place code}, once large
+        self.at = None          # {place code: {item_id:None}}, once large
+        self.dropped = None     # {domain_id: {item_id:None}}, once large
+
+    @property
+    def carried(self) -> Collection[int]:
+        return self.items_at('inventory')
+
+    def items_at(self, loc) -> Collection[int]:
+        code = place_code(loc, add=False)
+        if code is None: return ()
+        if self.where is not None:
+            return self.at.get(code, {})
+        return [tid for tid, c in zip(self.tids, self.codes) if c == code]
+
+    def dropped_in(self, did) -> Collection[int]:
+        if self.where is not None:
+            return self.dropped.get(did, {})
+        return [tid for tid, c in zip(self.tids, self.codes) if c and places[c][0] == did]
+
+    def get(self, tid, default=None):
+        if self.where is not None:
+            code = self.where.get(tid)
+            return default if code is None else places[code]
+        try:
+            return places[self.codes[self.tids.index(tid)]]
+        except ValueError:
+            return default
+
+    def __getitem__(self, tid):
+        loc = self.get(tid, self)
+        if loc is self: raise KeyError(tid)
+        return loc
+
+    def __contains__(self, tid) -> bool:
+        return self.get(tid, self) is not self
+
+    def __len__(self) -> int:
+        return len(self.where) if self.where is not None else len(self.tids)
+
+    def __iter__(self):
+        return iter(self.where) if self.where is not None else iter(self.tids)
+
+    def items(self):
+        if self.where is not None:
+            return ((tid, places[code]) for tid, code in self.where.items())
+        return ((tid, places[code]) for tid, code in zip(self.tids, self.codes))
+
+    def __getstate__(self):
+        if self.where is not None: return None, None, self.where, self.at, self.dropped
+        return bytes(self.tids), bytes(self.codes), None, None, None
+
+    def __setstate__(self, state):
+        tids, codes, self.where, self.at, self.dropped = state
+        self.tids, self.codes = _unpacked(tids), _unpacked(codes)
+
+    def __setitem__(self, tid, loc):
+        code = place_code(loc)
+        if self.where is None:
+            try:
+                self.codes[self.tids.index(tid)] = code
+                return
+            except ValueError:
+                if not self.tids: self.tids, self.codes = array('I'), array('I')
+                self.tids.append(tid)
+                self.codes.append(code)
+            if len(self.tids) <= Inventory.small: return
+            # too big for linear searches: move everything into indexed dicts
+            self.where, self.at, self.dropped = {}, {}, {}
+            for tid, code in zip(self.tids, self.codes):
+                self._index(tid, code)
+            self.tids = self.codes = None
+            return
+        old = self.where.get(tid)
+        if old is not None:
+            bucket = self.at[old]
+            del bucket[tid]
+            if not bucket: del self.at[old]
+            if old:
+                did = places[old][0]
+                bucket = self.dropped[did]
+                del bucket[tid]
+                if not bucket: del self.dropped[did]
+        self._index(tid, code)
+
+    def _index(self, tid, code):
+        self.where[tid] = code
+        self.at.setdefault(code, {})[tid] = None
+        if code:
+            self.dropped.setdefault(places[code][0], {})[tid] = None
+
+
+class User:
+    """Everything the hub knows about one player; slotted, as there may be millions"""
+    __slots__ = ('domain', 'open', 'inventory', 'domstate', 'score', 'hashad')
+
+    def __init__(self, did:int):
+        self.domain = did          # the domain they are in
+        self.open = array('I', [did])
+        self.inventory = Inventory()
+        self.domstate = 0
+        self.score = {}            # {domain_id: points}
+        self.hashad = ()           # sorted ids of items ever in inventory; an array once there are any
+
+    def had(self, tid:int) -> bool:
+        i = bisect.bisect_left(self.hashad, tid)
+        return i < len(self.hashad) and self.hashad[i] == tid
+
+    def mark_had(self, tid:int) -> None:
+        i = bisect.bisect_left(self.hashad, tid)
+        if i == len(self.hashad) or self.hashad[i] != tid:
+            if not self.hashad: self.hashad = array('I')
+            self.hashad.insert(i, tid)
+
+    def __reduce__(self):
+        # one flat call per user: pickling the Inventory as an object of its own costs more than the rest
+        return _unpickle_user, (self.domain, bytes(self.open), self.inventory.__getstate__(),
+            self.domstate, self.score, bytes(self.hashad))
+
+
+def _unpickle_user(did, opened, inventory, domstate, score, hashad) -> User:
+    me = User.__new__(User)
+    me.domain, me.open, me.domstate, me.score = did, _unpacked(opened), domstate, score
+    me.hashad = _unpacked(hashad)
+    me.inventory = Inventory.__new__(Inventory)
+    me.inventory.__setstate__(inventory)
+    return me
+
+
+###################################
+###  Section: helper functions  ###
 
 
 def make_map():
     """Puts each domain in a random location on a grid"""
-    # For this practice hub, only a single domain is supported
-
-    # Instead, pick a randomized set of items to host
+    global grid_size
+    grid_size = 1
+    while grid_size*grid_size < len(domains): grid_size += 1
+    grid.clear()
+    for did, cell in zip(domains, random.sample(range(grid_size*grid_size), len(domains))):
+        domains[did]['cell'] = [cell % grid_size, cell // grid_size]
+        grid[cell % grid_size, cell // grid_size] = did
+    neighbors.clear()
+    for (x,y), did in grid.items():
+        neighbors[did] = {}
+        for way, (dx,dy) in directions.items():
+            there = grid.get(((x+dx) % grid_size, (y+dy) % grid_size))
+            if there is not None and there != did:
+                neighbors[did][way] = there
+
+    # Empty cells lead to a simulated wilderness with a randomized set of items to find
+    others_items.clear()
     verbs = list(item_verbs.keys())
     random.shuffle(verbs)
     random.shuffle(item_names)
@@ -82,65 +304,296 @@ def make_map():
         'depth': random.randrange(3),
         'home':-1,
     })
-    for tid in templates:
-        item = templates[tid]
-        if 'depth' in item:
-            domains_prizes.setdefault(item['home'],{}).setdefault(item['depth'],[]).append(tid)
 
-    return
 
-def assign_loot():
-    """Distributes items with depth to other domains"""
-    # For this MP, only a single domain is supported, so this picks a random "outside world" scenario instead
-    global live_domain
-    
+def ring(did, r:int) -> list:
+    """Domains exactly r steps (Manhattan distance, wrapping around the grid) away from domain did"""
+    if (did, r) not in rings:
+        x,y = domains[did]['cell']
+        found = {}
+        for i in range(r):
+            for cx,cy in ((x+i,y+r-i), (x+r-i,y-i), (x-i,y-r+i), (x-r+i,y+i)):
+                cx,cy = cx % grid_size, cy % grid_size
+                if min(abs(cx-x), grid_size-abs(cx-x)) + min(abs(cy-y), grid_size-abs(cy-y)) != r: continue
+                there = grid.get((cx,cy))
+                if there is not None and there != did: found[there] = None
+        rings[did, r] = list(found)
+    return rings[did, r]
+rings = {} # {(domain_id, distance): [domain_id]}, filled in by ring() as needed
+
+
+def assign_loot(progress=None):
+    """Distributes items with depth to other domains
+
+    Each template with a depth is hosted by one domain depth+1 steps from its home, or by the
+    closest distance to that with any domains. Items with no other domain to go to can be found
+    by journeying into the wilderness instead, as can the simulated wilderness items.
+    progress, if given, is called now and then with the fraction of items placed so far.
+    """
     lootid = random.randrange(1000)
-    while lootid in templates: lootid += 1
-    hostid = next(iter(domains))
-    domains[hostid]['loot'] = []
+    while any(lootid+i in templates for i in range(len(others_items))): lootid += 1
     for i in range(len(others_items)):
         templates[lootid+i] = others_items[i]
         others_items[i]['id'] = lootid+i
-        templates[lootid+i]['hosts'] = [hostid]
-        domains[hostid]['loot'].append(lootid+i)
 
+    # group by where items are going so each ring is only searched once
+    groups = {}
+    for tid, t in templates.items():
+        if 'depth' in t:
+            groups.setdefault((t['home'], t['depth']), []).append(tid)
+
+    rings.clear()
+    domains_prizes.clear()
+    loot_index.clear()
+    for did in domains: domains[did]['loot'] = []
+    furthest = 2*(grid_size//2)
+    everywhere = list(domains)
+    placed = 0
+    for (home, depth), tids in groups.items():
+        if progress is not None:
+            progress(placed / len(templates))
+            placed += len(tids)
+        if home in domains:
+            hosts = []
+            for r in sorted(range(1, furthest+1), key=lambda r: (abs(r-(depth+1)), -r)): # nearest to depth+1 first, farther on ties
+                hosts = ring(home, r)
+                if hosts: break
+        else:
+            hosts = everywhere
+        if not hosts:
+            domains_prizes.setdefault(home,{}).setdefault(depth,[]).extend(tids)
+            continue
+        byhost = {}
+        for tid in tids:
+            host = random.choice(hosts)
+            templates[tid]['hosts'] = [host]
+            domains[host]['loot'].append(tid)
+            byhost.setdefault(host, []).append(tid)
+        for host, found in byhost.items():
+            loot_index.setdefault(host,{}).setdefault(depth,[]).extend(found)
+
+
+def make_briefs():
+    """Serializes the parts of each template that domains are sent on /arrive"""
+    briefs.clear()
+    for tid, t in templates.items():
+        brief = {k:v for k,v in t.items() if k in ('name','description','verb')}
+        brief['id'] = tid
+        prize = {k:v for k,v in t.items() if k in ('name','description','verb','depth')}
+        prize['id'] = tid
+        briefs[tid] = (codec.dumps(brief)[:-1], codec.dumps(prize))
+
+
+def arrive_body(uid: int, dest: int, src:str='login') -> bytes:
+    """The JSON body of an /arrive message, assembled from the cached briefs"""
+    owned, carried, dropped, prize = [],[],[],[]
+    inv = users[uid].inventory
+    for tid in inv.carried:
+        (owned if templates[tid]['home'] == dest else carried).append(briefs[tid][0] + b'}')
+    for tid in inv.dropped_in(dest):
+        dropped.append(briefs[tid][0] + b',"location":' + codec.dumps(inv[tid][1]) + b'}')
+    for tid in domains[dest]['loot']:
+        if tid not in inv:
+            prize.append(briefs[tid][1])
+    return b''.join((
+        b'{"secret":', codec.dumps(domains[dest]['secret']),
+        b',"user":', codec.dumps(uid),
+        b',"from":', codec.dumps(src),
+        b',"owned":[', b','.join(owned),
+        b'],"carried":[', b','.join(carried),
+        b'],"dropped":[', b','.join(dropped),
+        b'],"prize":[', b','.join(prize),
+        b']}',
+    ))
+
+
+def in_background(coro) -> None:
+    """Run a coroutine without waiting for it; keeps a reference so it isn't garbage-collected"""
+    task = asyncio.ensure_future(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+background_tasks = set()
+
+
+##########################################
+###  Section: domain notifications  ###
+
+# /depart and /arrive messages are queued per domain so that a slow domain only delays
+# the players who are going to it, and a journey doesn't wait on the domain being left.
+notify_window = 8 # most messages in flight to one domain at once
+outboxes = {} # {domain_id: Outbox}
+
+class Outbox:
+    """Messages waiting to be sent to one domain
+
+    Each user's messages are sent in the order they were queued, one at a time;
+    different users' messages are sent in parallel, up to notify_window at once.
+    """
+    def __init__(self, app:web.Application, did:int):
+        self.app = app
+        self.did = did
+        self.pending = [] # [(path, user id, () -> body bytes, future)], oldest first
+        self.sending = set() # user ids with a message in flight
+
+    def put(self, path:str, uid:int, body, done:asyncio.Future) -> None:
+        if path == '/depart':
+            last = next((_ for _ in reversed(self.pending) if _[1] == uid), None)
+            if last is not None and last[0] == '/arrive':
+                # the domain never heard they arrived, so it needn't hear they left
+                self.pending.remove(last)
+                if not last[3].done(): last[3].set_result(False)
+                done.set_result(False)
+                return
+        self.pending.append((path, uid, body, done))
+        self.pump()
+
+    def pump(self) -> None:
+        i = 0
+        while len(self.sending) < notify_window and i < len(self.pending):
+            if self.pending[i][1] in self.sending:
+                i += 1
+                continue
+            message = self.pending.pop(i)
+            self.sending.add(message[1])
+            in_background(self.send(*message))
+
+    async def send(self, path:str, uid:int, body, done:asyncio.Future) -> None:
+        url = domains[self.did]['url']+path
+        try:
+            status, text = await health.post(self.app.client, self.did, url, patient=path == '/arrive', data=body(), headers={'Content-Type':'application/json'})
+            if status >= 400:
+                eventlog.warning('domain_status', url=url, status=status, body=text[:200].decode(errors='replace'))
+        except health.Unavailable:
+            pass # counted by health; the domain will hear about the user when it is back and they act there
+        except Exception as ex:
+            eventlog.error('domain_failed', url=url, error=repr(ex))
+        finally:
+            self.sending.discard(uid)
+            if not done.done(): done.set_result(True)
+            self.pump()
+
+def notify(app:web.Application, did:int, path:str, uid:int, body=None) -> asyncio.Future:
+    """Queue a message about user uid for domain did; the future is done once it has been sent
+
+    body is called just before sending, so it reflects the user's state at that time;
+    by default it is the domain's secret and the user id.
+    """
+    if did not in outboxes:
+        outboxes[did] = Outbox(app, did)
+    if body is None:
+        body = lambda: codec.dumps({'secret':domains[did]['secret'], 'user':uid})
+    done = asyncio.get_running_loop().create_future()
+    outboxes[did].put(path, uid, body, done)
+    return done
+
+
+def known(uid:int) -> bool:
+    return 0 <= uid < len(users) and users[uid] is not None
+
+def add_user(uid:int, me:User) -> None:
+    users.extend([None] * (uid - len(users)))
+    users.append(me)
 
-def checkuid(data : dict) -> web.Response | int:
+def checkuid(data : codec.UserRequest) -> web.Response | int:
     if mode != 'play':
-        return web.json_response(status=409, data={'error':'Only available during play'})
-    for need in 'user','secret':
-        if need not in data:
-            return web.json_response(status=400, data={'error':'Request must contain '+need})
+        return codec.json_response(status=409, data={'error':'Only available during play'})
     uid = data['user']
-    if uid not in users:
-        return web.json_response(status=403, data={'error':f'User {uid} not known'})
-    if users[uid]['secret'] != data['secret']:
-        return web.json_response(status=403, data={'error':f'Invalid secret'})
+    problem = tokens.check(signing_key, data['secret'], 'u', uid)
+    if problem is not None:
+        return codec.json_response(status=403, data={'error':problem})
+    if not known(uid):
+        return codec.json_response(status=403, data={'error':f'User {uid} not known'})
     return uid
 
-def checkdid(data : dict) -> web.Response | int:
+def checkdid(data : codec.DomainRequest) -> web.Response | int:
     if mode != 'play':
-        return web.json_response(status=409, data={'error':'Only available during play'})
-    for need in 'domain','secret':
-        if need not in data:
-            return web.json_response(status=400, data={'error':'Request must contain '+need})
+        return codec.json_response(status=409, data={'error':'Only available during play'})
     did = data['domain']
+    problem = tokens.check(signing_key, data['secret'], 'd', did)
+    if problem is not None:
+        return codec.json_response(status=403, data={'error':problem})
     if did not in domains:
-        return web.json_response(status=403, data={'error':f'Domain {did} not known'})
-    if domains[did]['secret'] != data['secret']:
-        return web.json_response(status=403, data={'error':f'Invalid secret'})
+        return codec.json_response(status=403, data={'error':f'Domain {did} not known'})
     return did
     
 
 
+##########################################
+###  Section: world generation  ###
+
+# Entering play mode lays out the world in a forked child process, so the event loop keeps
+# serving while it does, then installs the result in one step
+building = None # asyncio.Future for the world being generated, while mode is "locked"
+built_fraction = None # multiprocessing.Value the child reports its progress in
+building_since = 0.0
+
+piece_size = 5000 # most entries of one dict in each pickled piece of a generated world
+
+def generate_world() -> list[bytes]:
+    """Lay out the map, hand out loot and serialize briefs; run in the child process
+
+    The world comes back as pickled pieces, so that unpickling it never holds up the event
+    loop for long: first everything small, then (name, entries) for each part of a big dict.
+    """
+    make_map()
+    built_fraction.value = 0.05
+    assign_loot(lambda done: setattr(built_fraction, 'value', 0.05 + 0.85*done))
+    make_briefs()
+    state = shared_state() | {'briefs':briefs}
+    big = [name for name, value in state.items() if isinstance(value, dict) and len(value) > piece_size]
+    pieces = [pickle.dumps({k:v for k,v in state.items() if k not in big}, protocol=pickle.HIGHEST_PROTOCOL)]
+    for name in big:
+        entries = list(state[name].items())
+        for i in range(0, len(entries), piece_size):
+            pieces.append(pickle.dumps((name, entries[i:i+piece_size]), protocol=pickle.HIGHEST_PROTOCOL))
+    built_fraction.value = 1.0
+    return pieces
+
+async def install_world(pieces:list[bytes], new_mode:str) -> None:
+    """Replace the world with generate_world()'s pieces, unpickled a piece per turn of the loop, in new_mode"""
+    import gc
+    gc.disable() # the world is long-lived, so don't keep scanning it as it arrives
+    try:
+        state = pickle.loads(pieces[0])
+        for piece in pieces[1:]:
+            await asyncio.sleep(0)
+            name, entries = pickle.loads(piece)
+            state.setdefault(name, {}).update(entries)
+        state['others_items'] = [state['templates'][_['id']] for _ in state['others_items']] # the same dicts, as before pickling
+        built = state.pop('briefs')
+        load_shared(state | {'mode':new_mode}, built)
+        gc.freeze()
+    finally:
+        gc.enable()
+
+async def build_world() -> None:
+    """Generate the world off the event loop, then install it and enter play mode"""
+    global mode, building, built_fraction, building_since
+    import concurrent.futures, multiprocessing
+    context = multiprocessing.get_context('fork')
+    built_fraction = context.Value('d', 0.0, lock=False)
+    building_since = time.monotonic()
+    pool = concurrent.futures.ProcessPoolExecutor(1, mp_context=context)
+    try:
+        pieces = await asyncio.get_running_loop().run_in_executor(pool, generate_world)
+        await install_world(pieces, 'locked')
+        if workers > 1:
+            await broadcast('/_world', pickle.dumps(pieces, protocol=pickle.HIGHEST_PROTOCOL))
+        mode = 'play'
+        eventlog.info('world_built', domains=len(domains), templates=len(templates), seconds=round(time.monotonic()-building_since, 3))
+    except Exception as ex:
+        mode = 'setup'
+        eventlog.error('world_failed', error=repr(ex))
+        raise
+    finally:
+        pool.shutdown(wait=False)
+        building = None
+    await save_snapshot()
+
+
 ####################################
 ###  Section: web UI interfaces  ###
 
-@routes.get("/")
-async def web_interface(req : web.Request) -> web.StreamResponse:
-    """Display web front-end"""
-    return web.FileResponse(path="tba.html")
-
 @routes.get("/mode")
 async def get_mode(req : web.Request) -> web.Response:
     """Get the mode of the server (play or setup)"""
@@ -149,10 +602,10 @@ async def get_mode(req : web.Request) -> web.Response:
 @routes.post("/mode")
 async def set_mode(req : web.Request) -> web.Response:
     """Change the mode of the server"""
-    global mode
+    global mode, building
     newmode = await req.text()
     if newmode == mode: return web.Response(text="Already in "+newmode+" mode")
-    elif mode == 'locked': return web.Response(status=409, text="Error: request sent midway through handling another request.")
+    elif mode == 'locked' and newmode != 'play': return web.Response(status=409, text="The world for play mode is being generated; see /mode/progress.")
     elif newmode == 'setup':
         return web.Response(status=403, text="The demo server cannot be put into setup mode.")
         mode = 'setup'
@@ -163,15 +616,30 @@ async def set_mode(req : web.Request) -> web.Response:
     elif newmode == 'play':
         if len(domains) == 0:
             return web.Response(status=409, text="Must register at least one domain before entering play mode.")
-        mode = 'locked'
-        make_map()
-        assign_loot()
-        mode = 'play'
+        if registering:
+            return web.Response(status=409, text="A domain is still sending its items; try again when it has registered.")
+        if building is None:
+            mode = 'locked'
+            building = asyncio.ensure_future(build_world())
+        try:
+            await asyncio.shield(building) # several requests may wait for the same world
+        except Exception as ex:
+            return web.Response(status=500, text="World generation failed: "+repr(ex))
     else:
         return web.Response(status=400, text="Unknown mode "+repr(newmode))
     
     return web.Response(text="Now in "+mode+" mode")
 
+@routes.get("/mode/progress")
+async def get_progress(req : web.Request) -> web.Response:
+    """How far along generating the world for play mode is
+    
+    {"mode":str, "done":fraction, "seconds":seconds since generation began, or null when not generating}
+    """
+    if building is None:
+        return codec.json_response({'mode':mode, 'done':1.0 if mode == 'play' else 0.0, 'seconds':None})
+    return codec.json_response({'mode':mode, 'done':round(built_fraction.value, 3), 'seconds':round(time.monotonic()-building_since, 3)})
+
 @routes.post("/domain")
 async def notify_domain(req : web.Request) -> web.Response:
     """Web front-end to tell hub server to ask domain server for details"""
@@ -182,7 +650,7 @@ async def notify_domain(req : web.Request) -> web.Response:
         if any(d['url'] == data for d in domains.values()):
             return web.Response(text="That domain server has already been registered.")
         async with req.app.client.post(data+'/newhub', data=whoami) as resp:
-            spot = await resp.json()
+            spot = codec.decode(await resp.read())
             if 'error' in spot:
                 return web.Response(text="Domain server returned an error message:<pre>"+spot['error']+"</pre>")
             else:
@@ -193,7 +661,7 @@ async def notify_domain(req : web.Request) -> web.Response:
 @routes.post("/newhub")
 async def notify_domain(req : web.Request) -> web.Response:
     """Placeholder to give more useful error messages for on common error"""
-    return web.json_response(status=400, data={
+    return codec.json_response(status=400, data={
         'error': whoami+' is the URL of the hub server, not a domain server.'
     })
 
@@ -201,43 +669,185 @@ async def notify_domain(req : web.Request) -> web.Response:
 async def login(req : web.Request) -> web.Response:
     """User log-in"""
     if mode != 'play':
-        return web.json_response(status=409, data={'error':'Players cannot log in during setup'})
-    data = {}
-    data['secret'] = make_secret()
-    data['in'] = random.choice(tuple(domains))
-    data['open'] = [data['in']]
-    data['inventory'] = {}
-    data['domstate'] = 0
-    data['score'] = {}
-    data['hashad'] = set() # items ever in inventory
-    uid = len(users)
-    users[uid] = data
-    await arrive(uid, data['in'], req.app, 'login')
-    return web.json_response(data={'id':uid,'secret':data['secret'],
-        'domain':{k:v for k,v in domains[data['in']].items() if k in ('url','name','description')}})
+        return codec.json_response(status=409, data={'error':'Players cannot log in during setup'})
+    me = User(random.choice([did for did in domains if health.usable(did)] or tuple(domains)))
+    uid = len(users) + (worker - len(users)) % workers # the next id this worker owns
+    add_user(uid, me)
+    leaders.set(uid, 0)
+    logged('login', uid, me.domain)
+    await arrive(uid, me.domain, req.app, 'login')
+    return codec.json_response(data={'id':uid,'secret':tokens.issue(signing_key, 'u', uid, user_lifetime),
+        'domain':{k:v for k,v in domains[me.domain].items() if k in ('url','name','description')}})
 
 
 @routes.post("/command")
 async def handle_command(req : web.Request) -> web.Response:
     """Handle hub-server commands"""
-    try: data = await req.json()
-    except: return web.json_response(status=400, text="JSON data required")
+    data = await codec.read(req, codec.CommandRequest)
+    if isinstance(data, web.Response): return data
+    req['verb'] = command_verb(data['command'])
+    return await user_command(data, req.app)
+
+async def user_command(data:codec.CommandRequest, app:web.Application) -> web.Response:
+    """Check who sent a command and carry it out; shared by /command and /commands"""
     uid = checkuid(data)
     if isinstance(uid, web.Response): return uid
-    if 'command' not in data: return web.json_response(status=400, text="Command expected")
-    cmd = data['command']
-    if not isinstance(cmd, list): return web.json_response(status=400, text="Command should be a list")
-    if not all(isinstance(word, str) for word in cmd): return web.json_response(status=400, text="Command should be a list of strings")
-    
+    return await run_command(uid, data['command'], app)
+
+def command_verb(cmd:list[str]) -> str:
+    """cmd[0] if it is a verb the hub knows, for labelling metrics without letting players invent labels"""
+    return cmd[0] if cmd and cmd[0] in ('region','journey','inventory','score','drop','top') else 'other'
+
+async def run_command(uid:int, cmd:list[str], app:web.Application) -> web.Response:
+    """Dispatch a hub command; shared by the /command route and the /ws channel"""
+    if not cmd: return web.Response(status=400, text="A command needs at least one word")
     if cmd[0] == 'region': return await region(uid, cmd[1:])
-    if cmd[0] == 'journey': return await journey(uid, cmd[1:], req.app)
+    if cmd[0] == 'journey': return await journey(uid, cmd[1:], app)
     if cmd[0] == 'inventory': return await inventory(uid, cmd[1:])
     if cmd[0] == 'score': return await score(uid, cmd[1:])
-    if cmd[0] == 'drop': return await drop(uid, cmd[1:], req.app)
+    if cmd[0] == 'drop': return await drop(uid, cmd[1:], app)
+    if cmd[0] == 'top': return await top(uid, cmd[1:])
     
     return web.Response(text="I don't know how to do that")
 
 
+batch_limit = 1000 # most commands in one /commands request
+
+@routes.post("/commands")
+async def handle_commands(req : web.Request) -> web.Response:
+    """Handle a list of hub-server commands, possibly for many users, in one request
+
+    Takes {"commands":[{"user":id, "secret":str, "command":[str]}, ...]} and replies with a list
+    of {"status":int, "text":str} in the same order. Each user's commands run in the order given;
+    different users' commands run concurrently.
+    """
+    data = await codec.read(req, codec.BatchRequest)
+    if isinstance(data, web.Response): return data
+    entries = data['commands']
+    if len(entries) > batch_limit:
+        return codec.json_response(status=413, data={'error':f'At most {batch_limit} commands per request'})
+    results = [None] * len(entries)
+
+    async def run_here(indexes):
+        for i in indexes:
+            t0 = time.perf_counter()
+            try:
+                resp = await user_command(entries[i], req.app)
+                results[i] = {'status':resp.status, 'text':resp.text}
+            except Exception as ex:
+                eventlog.error('command_failed', command=entries[i]['command'], error=repr(ex))
+                results[i] = {'status':500, 'text':'500 Internal Server Error'}
+            metrics.observe(metrics.command_seconds, (command_verb(entries[i]['command']),), time.perf_counter() - t0)
+
+    async def run_elsewhere(k, indexes):
+        body = codec.dumps({'commands':[entries[i] for i in indexes]})
+        try:
+            async with peers[k].post('http://worker/commands', data=body) as resp:
+                for i, result in zip(indexes, codec.decode(await resp.read())):
+                    results[i] = result
+        except Exception as ex:
+            for i in indexes:
+                results[i] = {'status':502, 'text':f'Worker {k} did not answer: {ex!r}'}
+
+    by_user, by_worker = {}, {}
+    for i, entry in enumerate(entries):
+        k = owner(entry['user'])
+        if k == worker: by_user.setdefault(entry['user'], []).append(i)
+        else: by_worker.setdefault(k, []).append(i)
+    await asyncio.gather(*(run_here(_) for _ in by_user.values()),
+        *(run_elsewhere(k, indexes) for k, indexes in by_worker.items()))
+    return codec.json_response(results)
+
+
+
+################################
+###  Section: push channel  ###
+
+# Open WebSocket for each player using one
+sockets = {} # {user_id: web.WebSocketResponse}
+
+@routes.get("/ws")
+async def websocket(req : web.Request) -> web.WebSocketResponse:
+    """One connection per player carrying their commands and pushed updates
+
+    The first message is {"user":id, "secret":str}; after that each {"id":n, "command":[str], "domain":bool}
+    gets a reply {"id":n, "status":int, "text":str}. Domain commands are forwarded to the domain the
+    player is in. Updates the player didn't ask for are sent as {"push":kind, "text":str}.
+    """
+    ws = web.WebSocketResponse(heartbeat=30)
+    await ws.prepare(req)
+    uid = secret = None
+    try:
+        async for msg in ws:
+            if msg.type != web.WSMsgType.TEXT: continue
+            try:
+                data = codec.decode(msg.data, codec.UserRequest if uid is None else codec.SocketCommand)
+            except codec.BadRequest as ex:
+                await ws.send_str(codec.dumps_str({'status':400, 'text':str(ex)}))
+                continue
+            reply = {} if uid is None else {'id':data['id']}
+            try:
+                if uid is None:
+                    if owner(data['user']) != worker: # check with the worker that has this user
+                        status, text = await socket_elsewhere(data, None)
+                    else:
+                        found = checkuid(data)
+                        status, text = (found.status, found.text) if isinstance(found, web.Response) else (200, 'ok')
+                    if status == 200:
+                        uid, secret = data['user'], data['secret']
+                        old = sockets.get(uid)
+                        sockets[uid] = ws
+                        if old is not None: in_background(old.close())
+                elif owner(uid) != worker:
+                    status, text = await socket_elsewhere({'user':uid, 'secret':secret}, data)
+                else:
+                    status, text = await socket_command(uid, data, req.app)
+            except Exception as ex: # one bad message shouldn't close the player's socket
+                eventlog.error('command_failed', command=data.get('command'), error=repr(ex))
+                status, text = 500, '500 Internal Server Error'
+            await ws.send_str(codec.dumps_str(reply | {'status':status, 'text':text}))
+    finally:
+        if uid is not None and sockets.get(uid) is ws:
+            del sockets[uid]
+    return ws
+
+async def socket_command(uid:int, data:codec.SocketCommand, app:web.Application) -> tuple[int, str]:
+    """Carry out one command sent over /ws, returning its status and reply text"""
+    t0 = time.perf_counter()
+    if data.get('domain'):
+        status, text = await domain_command(uid, data['command'], app)
+        metrics.observe(metrics.command_seconds, ('forwarded',), time.perf_counter() - t0)
+    else:
+        resp = await run_command(uid, data['command'], app)
+        status, text = resp.status, resp.text
+        metrics.observe(metrics.command_seconds, (command_verb(data['command']),), time.perf_counter() - t0)
+    return status, text
+
+async def domain_command(uid:int, cmd:list[str], app:web.Application) -> tuple[int, str]:
+    """Forward a player's command to the domain they are in"""
+    did = users[uid].domain
+    here = domains[did]
+    try:
+        status, body = await health.post(app.client, did, here['url']+'/command', json={'user':uid, 'command':cmd})
+        return status, body.decode(errors='replace')
+    except health.Unavailable:
+        return 503, 'Sorry, '+unavailable(did)
+    except Exception as ex:
+        return 502, "Failed to contact <code>"+here['url']+"</code>:<pre>"+repr(ex)+"</pre>"
+
+def unavailable(did:int) -> str:
+    """What to tell a player when a domain's circuit is open"""
+    return 'the domain <strong>'+domains[did]['name']+'</strong> is not responding. Try again in a little while.'
+
+def push(uid:int, kind:str, text:str) -> None:
+    """Tell a player about something that happened without them asking, if they have a /ws open"""
+    ws = sockets.get(uid)
+    if ws is not None and not ws.closed:
+        in_background(ws.send_str(codec.dumps_str({'push':kind, 'text':text})))
+    elif workers > 1: # their /ws may have reached another worker
+        in_background(broadcast('/_push', codec.dumps({'user':uid, 'kind':kind, 'text':text})))
+
+
 
 
 
@@ -248,103 +858,105 @@ async def handle_command(req : web.Request) -> web.Response:
 async def region(uid:int, rest:list[str]) -> web.Response:
     """Information about the current domain for the user"""
     me = users[uid]
-    here = domains[me['in']]
-    return web.Response(text='You are in domain <strong>'+here['name']+'</strong>\n'+here['description']+'\n\nFor this MP, there is no detail available about other domains in the region.')
+    here = domains[me.domain]
+    nearby = neighbors[me.domain]
+    if not nearby:
+        return web.Response(text='You are in domain <strong>'+here['name']+'</strong>\n'+here['description']+'\n\nThere are no other domains nearby.')
+    return web.Response(text='You are in domain <strong>'+here['name']+'</strong>\n'+here['description']+'\n\nNearby domains:<ul>'+
+        ''.join(f'<li>{way}: <strong>{domains[did]["name"]}</strong></li>' for way,did in nearby.items())+'</ul>')
 
 async def journey(uid:int, rest:list[str], app:web.Application) -> web.Response:
     """User-initiated move between domains"""
-    if len(rest) != 1 or rest[0] not in ('north','south','east','west'):
+    if len(rest) != 1 or rest[0] not in directions:
         return web.Response(text='I only know how to journey in cardinal directions', status=403)
 
     me = users[uid]
-    here = domains[me['in']]
     src = {'north':'south','south':'north','east':'west','west':'east'}.get(rest[0],'direct')
+    dest = neighbors[me.domain].get(rest[0])
+    if dest is not None and not health.usable(dest):
+        return web.Response(text='The way '+rest[0]+' is closed for now: '+unavailable(dest), status=503)
 
-    try:
-        async with app.client.post(here['url']+'/depart', json={
-            'secret':here['secret'],
-            'user':uid,
-        }) as resp:
-            if not resp.ok:
-                print("/depart returned a failing status code", resp.status)
-    except BaseException as ex:
-        print("/depart failed", ex)
+    notify(app, me.domain, '/depart', uid) # not awaited: the player is done with this domain
 
+    if dest is not None:
+        me.domain = dest
+        logged('in', uid, dest)
+        await arrive(uid, dest, app, src)
+        there = domains[dest]
+        return web.Response(text='$domain '+there['url']+'\nYou journey '+rest[0]+' to domain <strong>'+there['name']+'</strong><br/>'+there['description'])
 
     msg = ['You travel in other domains for a time.']
     used = []
     for ds in range(3):
-        if me['domstate'] == ds:
-            for prize in domains_prizes.get(me['in'],{}).get(ds,[]):
-                if prize not in me['hashad']:
-                    me['inventory'][prize] = 'inventory'
-                    me['hashad'].add(prize)
+        if me.domstate == ds:
+            for prize in domains_prizes.get(me.domain,{}).get(ds,[]):
+                if not me.had(prize):
+                    me.inventory[prize] = 'inventory'
+                    me.mark_had(prize)
+                    logged('move', uid, prize, 'inventory')
                     msg.append('You find a '+templates[prize]['name'])
-            if me['inventory'].get(others_items[ds]['id']) == 'inventory':
-                me['domstate'] = ds+1
+            if me.inventory.get(others_items[ds]['id']) == 'inventory':
+                me.domstate = ds+1
+                leaders.set(uid, total(me))
+                logged('domstate', uid, ds+1)
                 msg.append('You use your '+others_items[ds]['name']+' to bypass an obstacle.')
     if len(msg) == 1: msg.append('Finding nothing new, you return to this domain.')
     else: msg.append('You then return to this domain.')
 
-    await arrive(uid, me['in'], app, src)
+    await arrive(uid, me.domain, app, src)
     return web.Response(text='\n'.join(msg))
 
 async def inventory(uid:int, rest:list[str]) -> web.Response:
     """Display what the user is carrying"""
-    me = users[uid]
-    if not any(v == 'inventory' for v in me['inventory'].values()):
+    gear = users[uid].inventory.carried
+    if not gear:
         return web.Response(text='You are not carrying anything.')
-    return web.Response(text='You are carrying:<ul>'+''.join(f'<li>{templates[tid]["name"]} <sub>{tid}</sub></li>' for tid in me['inventory'] if me['inventory'][tid] == 'inventory'))
+    return web.Response(text='You are carrying:<ul>'+''.join(f'<li>{templates[tid]["name"]} <sub>{tid}</sub></li>' for tid in gear))
 
 async def score(uid:int, rest:list[str]) -> web.Response:
     """Display the scoreboard"""
     ans = f'Score for user {uid}:<ul>'
     points = 0
-    for k,v in users[uid]['score'].items():
+    for k,v in users[uid].score.items():
         ans += f'<li>Domain {k}: {v} points</li>'
         points += v
-    ans += f'<li>Others: {round(users[uid]["domstate"]/2,2)} points</li>'
-    ans += f'</ul>Total: {points+round(users[uid]["domstate"]/2,2)} points.'
+    ans += f'<li>Others: {round(users[uid].domstate/2,2)} points</li>'
+    ans += f'</ul>Total: {points+round(users[uid].domstate/2,2)} points.'
         
     return web.Response(text=ans)
 
+async def top(uid:int, rest:list[str]) -> web.Response:
+    """Display the leaderboard and where the user stands on it"""
+    try:
+        k = int(rest[0]) if rest else 10
+    except ValueError:
+        k = 10
+    board = await standings(max(1, min(k, max_top)), uid)
+    ans = 'Top players:<ul>'+''.join(f'<li>#{p["rank"]} User {p["user"]}: {p["total"]} points</li>' for p in board['top'])+'</ul>'
+    me = board['user']
+    return web.Response(text=ans+f'You are ranked #{me["rank"]} of {board["players"]} players, with {me["total"]} points.')
+
 
 async def arrive(uid: int, dest: int, app:web.Application, src:str='login') -> None:
-    """Alert a domain that a user has arrived"""
-    owned, carried, dropped, prize = [],[],[],[]
-    for tid, loc in users[uid]['inventory'].items():
-        t = templates[tid]
-        brief = {k:v for k,v in t.items() if k in ('name','description','verb')}
-        brief['id'] = tid
-        if loc == 'inventory':
-            if t['home'] == dest:
-                owned.append(brief)
-            else: carried.append(brief)
-        elif loc[0] == dest:
-            brief['location'] = loc[1]
-            dropped.append(brief)
-    for tid in domains[dest]['loot']:
-        if tid not in users[uid]['inventory']:
-            t = templates[tid]
-            brief = {k:v for k,v in t.items() if k in ('name','description','verb','depth')}
-            brief['id'] = tid
-            prize.append(brief)
-    
-    users[uid]['score'].setdefault(dest, 0)
-    
+    """Alert a domain that a user has arrived, returning once it has been told"""
+    users[uid].score.setdefault(dest, 0)
+    await notify(app, dest, '/arrive', uid, lambda: arrive_body(uid, dest, src))
+
+async def inventory_changed(uid: int, app:web.Application) -> None:
+    """Alert the domain a user is in that their inventory was changed by some other domain"""
+    dest = users[uid].domain
+    url = domains[dest]['url']+'/inventory'
     try:
-        async with app.client.post(domains[dest]['url']+'/arrive', json={
+        status, body = await health.post(app.client, dest, url, json={
             'secret':domains[dest]['secret'],
             'user':uid,
-            'from':src,
-            'owned':owned,
-            'carried':carried,
-            'dropped':dropped,
-            'prize':prize,
-        }) as resp:
-            assert resp.status == 200, (resp.status, await resp.read())
-    except BaseException as ex:
-        print('ERROR:',domains[dest]['url']+'/arrive','did not work',repr(ex))
+        })
+        if status >= 400 and status != 404: # 404: domain doesn't cache inventories
+            eventlog.warning('domain_status', url=url, status=status, body=body[:200].decode(errors='replace'))
+    except health.Unavailable:
+        pass
+    except Exception as ex:
+        eventlog.error('domain_failed', url=url, error=repr(ex))
 
 async def drop(uid:int, rest:list[str], app:web.Application) -> web.Response:
     """Called by users to drop items where they are"""
@@ -352,11 +964,11 @@ async def drop(uid:int, rest:list[str], app:web.Application) -> web.Response:
         return web.Response(text='What do you want to drop?\n><code>inventory</code> will show your options')
     
     me = users[uid]
-    gear = [tid for tid,where in me['inventory'].items() if where == 'inventory']
+    gear = me.inventory.carried
     
     todrop = ' '.join(rest)
     
-    if todrop in [str(tid) for tid in gear]:
+    if todrop.isascii() and todrop.lstrip('-').isdigit() and str(int(todrop)) == todrop and int(todrop) in gear: # int() fails on digits like '²'
         item = int(todrop)
     else:
         todrop = [tid for tid in gear if templates[tid]['name'] == todrop]
@@ -368,19 +980,22 @@ async def drop(uid:int, rest:list[str], app:web.Application) -> web.Response:
             +'</ul')
         item = todrop[0]
     
-    did = users[uid]['in']
+    did = users[uid].domain
     spot = None
     try:
-        async with app.client.post(domains[did]['url']+'/dropped', json={
+        status, body = await health.post(app.client, did, domains[did]['url']+'/dropped', patient=True, json={
             'secret':domains[did]['secret'],
             'user':uid,
             'item':{'id':item} | {k:v for k,v in templates[item].items() if k in ('name','description','verb')},
-        }) as resp:
-            spot = await resp.json()
-    except:
+        })
+        spot = codec.decode(body)
+    except health.Unavailable:
+        return web.Response(text="You try to drop it, but "+unavailable(did), status=503)
+    except Exception:
         return web.Response(text="You try to drop it, but the domain won't let you")
     
-    me['inventory'][item] = (did, spot)
+    me.inventory[item] = (did, spot)
+    logged('move', uid, item, (did, spot))
     
     return web.Response(text=templates[item]['name']+f" <sub>{item}</sub> dropped.")
 
@@ -390,45 +1005,93 @@ async def drop(uid:int, rest:list[str], app:web.Application) -> web.Response:
 ###  Section: domain server interfaces  ###
 
 
-@routes.post("/register")
-async def register_domain(req : web.Request) -> web.Response:
-    """Registers a domain, if the server is in the domain-registering mode"""
-    if mode != 'setup':
-        return web.Response(status=409, text="Central server is not in setup mode")
-    try: data = await req.json()
-    except: return web.json_response(status=400, data={"error":"JSON data required"})
-    if 'name' not in data or not isinstance(data['name'], str):
-        return web.json_response(status=400, data={"error":"Name string required"})
-    if 'description' not in data or not isinstance(data['description'], str):
-        return web.json_response(status=400, data={"error":"Description string required"})
-    if 'url' not in data or not isinstance(data['url'], str):
-        return web.json_response(status=400, data={"error":"Sever url required"})
-    if 'items' not in data or not isinstance(data['items'], list) or any(not isinstance(item, dict) for item in data['items']):
-        return web.json_response(status=400, data={"error":"List of item templates required"})
+registering = set() # ids of domains whose streamed registration is still arriving
+
+def add_domain(data : codec.DomainInfo) -> web.Response | tuple[int, str]:
+    """The new domain's id and secret, or an error response"""
     for i,d in domains.items():
         if d['url'] == data['url']:
-            return web.json_response(status=409, data={"error":"Cannot register same domain more than once"})
-    if len(domains) > 1:
-        return web.Response(status=409, text="MP10's hub server only supports a single domain at a time.")
-    did = random.randrange(1000) # only one domain, but fake a different ID for each
-    secret = make_secret()
+            return codec.json_response(status=409, data={"error":"Cannot register same domain more than once"})
+    did = random.randrange(1000)
+    while did in domains: did += 1
+    secret = tokens.issue(signing_key, 'd', did, domain_lifetime)
     domains[did] = {
         'url':data['url'],
         'name':data['name'],
         'description':data['description'],
         'secret':secret,
+        'loot':[],
     }
-    ids = []
-    t0 = random.randrange(1000)
-    for item in data['items']:
-        tid = len(templates)+t0
-        templates[tid] = {'name':item.get('name','thing'), 'description':item.get('description','error: owner did not describe this item'), 'verb':item.get('verb',{}), 'home':did}
-        ids.append(tid)
-        if 'depth' in item and isinstance(item['depth'], int):
-            templates[tid]['depth'] = max(0,item['depth'])
-        
+    return did, secret
+
+def add_templates(did:int, items:list[codec.ItemTemplate], tid:int) -> list[range]:
+    """Add templates for domain did's items, numbered from tid up past ids already taken, as runs of consecutive ids"""
+    runs = []
+    i = 0
+    while i < len(items):
+        while tid in templates: tid += 1
+        end, last = tid + 1, tid + len(items) - i
+        while end < last and end not in templates: end += 1
+        templates.update(zip(range(tid, end), [
+            {'name':item.get('name','thing'), 'description':item.get('description','error: owner did not describe this item'), 'verb':item.get('verb',{}), 'home':did}
+            | ({'depth':max(0,item['depth'])} if isinstance(item.get('depth'), int) else {})
+            for item in items[i:i+end-tid]]))
+        runs.append(range(tid, end))
+        i += end - tid
+        tid = end
+    return runs
 
-    return web.json_response({'id':did,"items":ids,'secret':secret})
+@routes.post("/register")
+async def register_domain(req : web.Request) -> web.Response:
+    """Registers a domain, if the server is in the domain-registering mode
+
+    Takes the domain's name, description, url and list of items, and replies with its id, secret
+    and the ids of its items in order. Domains with many items can send NDJSON instead; see register_stream.
+    """
+    if mode != 'setup':
+        return web.Response(status=409, text="Central server is not in setup mode")
+    if req.content_type == 'application/x-ndjson':
+        return await register_stream(req)
+    data = await codec.read(req, codec.RegisterRequest)
+    if isinstance(data, web.Response): return data
+    added = add_domain(data)
+    if isinstance(added, web.Response): return added
+    did, secret = added
+    runs = add_templates(did, data['items'], len(templates)+random.randrange(1000))
+    return codec.json_response({'id':did,"items":[tid for run in runs for tid in run],'secret':secret})
+
+async def register_stream(req : web.Request) -> web.Response:
+    """Registers a domain sent as NDJSON, adding its items a chunk at a time as they arrive
+
+    The first line has the domain's name, description and url, and each line after it one item.
+    Replies with the domain's id and secret, and its items' ids as [first, after] ranges: the
+    first item has the first range's first id, and so on. Nothing is kept if any line is wrong.
+    """
+    did, runs, kept = None, [], False # runs: [[first, after]]
+    tid = len(templates)+random.randrange(1000)
+    try:
+        async for n, lines in codec.read_lines(req):
+            if did is None:
+                added = add_domain(codec.decode_lines(lines[:1], codec.DomainInfo, n)[0])
+                if isinstance(added, web.Response): return added
+                (did, secret), lines, n = added, lines[1:], n+1
+                registering.add(did)
+            for run in add_templates(did, codec.decode_lines(lines, codec.ItemTemplate, n), tid):
+                if runs and runs[-1][1] == run.start: runs[-1][1] = run.stop
+                else: runs.append([run.start, run.stop])
+                tid = run.stop
+        if did is None:
+            return codec.json_response(status=400, data={'error':'Request must start with a line describing the domain'})
+        kept = True
+    except codec.BadRequest as ex:
+        return codec.json_response(status=400, data={'error':str(ex)})
+    finally:
+        registering.discard(did)
+        if did is not None and not kept: # a bad line, or the sender gave up
+            for first, after in runs:
+                for tid in range(first, after): del templates[tid]
+            del domains[did]
+    return codec.json_response({'id':did,'ranges':runs,'count':sum(after-first for first, after in runs),'secret':secret})
 
 @routes.post("/score")
 async def transfer(req: web.Request) -> web.Response:
@@ -442,23 +1105,26 @@ async def transfer(req: web.Request) -> web.Response:
     
     Finding Secret areas may add multiples of 0.001 points, to a maximum of 1.005.
     """
-    try: data = await req.json()
-    except: return web.json_response(status=400, data={"error":"JSON data required"})
+    data = await codec.read(req, codec.ScoreRequest)
+    if isinstance(data, web.Response): return data
     did = checkdid(data)
     if isinstance(did, web.Response): return did
-    uid = data.get('user')
-    if uid not in users:
-        return web.json_response(status=400, data={"error":"Valid user ID required"})
+    uid = data['user']
+    if not known(uid):
+        return codec.json_response(status=400, data={"error":"Valid user ID required"})
     try:
         score = float(data['score'])
     except:
-        return web.json_response(status=400, data={"error":"Numeric score required"})
+        return codec.json_response(status=400, data={"error":"Numeric score required"})
     if score < 0 or score > 1.005:
-        return web.json_response(status=400, data={"error":"Invalid score; should be between 0 and 1"})
-    if score < users[uid]['score'].get(did,0):
-        return web.json_response(status=409, data={"error":"Reducing scores is not supported"})
-    users[uid]['score'][did] = score
-    return web.json_response(data={"ok":"Score changed"})
+        return codec.json_response(status=400, data={"error":"Invalid score; should be between 0 and 1"})
+    if score < users[uid].score.get(did,0):
+        return codec.json_response(status=409, data={"error":"Reducing scores is not supported"})
+    users[uid].score[did] = score
+    leaders.set(uid, total(users[uid]))
+    logged('score', uid, did, score)
+    push(uid, 'score', f'Your score in domain <strong>{domains[did]["name"]}</strong> is now {score} points.')
+    return codec.json_response(data={"ok":"Score changed"})
 
 @routes.post("/transfer")
 async def transfer(req: web.Request) -> web.Response:
@@ -475,41 +1141,46 @@ async def transfer(req: web.Request) -> web.Response:
     Any other destination names some location within the sending domain (as if dropped).
     
     """
-    try: data = await req.json()
-    except: return web.json_response(status=400, data={"error":"JSON data required"})
+    data = await codec.read(req, codec.TransferRequest)
+    if isinstance(data, web.Response): return data
     did = checkdid(data)
     if isinstance(did, web.Response): return did
-    uid = data.get('user')
-    if uid not in users:
-        return web.json_response(status=400, data={"error":"Valid user ID required"})
-    tid = data.get('item')
+    uid = data['user']
+    if not known(uid):
+        return codec.json_response(status=400, data={"error":"Valid user ID required"})
+    tid = data['item']
     if tid not in templates:
-        return web.json_response(status=400, data={"error":"Valid item ID required"})
-    if 'to' not in data:
-        return web.json_response(status=400, data={"error":"Missing \"to\" field"})
+        return codec.json_response(status=400, data={"error":"Valid item ID required"})
     
-    old = users[uid]['inventory'].get(tid)
+    old = users[uid].inventory.get(tid)
     new = data['to']
     owned = templates[tid]['home'] == did or did in templates[tid].get('hosts',[])
     
     
     if old == new:
-        return web.json_response(status=409, data={"error":"Cannot move item to where it already is"})
+        return codec.json_response(status=409, data={"error":"Cannot move item to where it already is"})
     
     if old is None and not owned:
-        return web.json_response(status=403, data={"error":"Cannot generate items that don't belong to you"})
+        return codec.json_response(status=403, data={"error":"Cannot generate items that don't belong to you"})
     if old is not None and new != 'inventory' and templates[tid]['home'] != did:
-        return web.json_response(status=403, data={"error":"Cannot move or remove items that don't belong to you"})
+        return codec.json_response(status=403, data={"error":"Cannot move or remove items that don't belong to you"})
 
     if old is not None and old[0] != did:
-        return web.json_response(status=403, data={"error":"That item has been dropped in a different domain"})
+        return codec.json_response(status=403, data={"error":"That item has been dropped in a different domain"})
 
-    users[uid]['inventory'][tid] = new if new == 'inventory' else (did, new)
-    if users[uid]['inventory'][tid] == 'inventory':
-        users[uid]['hashad'].add(tid)
+    users[uid].inventory[tid] = new if new == 'inventory' else (did, new)
+    if users[uid].inventory[tid] == 'inventory':
+        users[uid].mark_had(tid)
+    logged('move', uid, tid, users[uid].inventory[tid])
+    if users[uid].domain != did:
+        in_background(inventory_changed(uid, req.app))
+        if new == 'inventory':
+            push(uid, 'inventory', f'{templates[tid]["name"]} <sub>{tid}</sub> is now in your inventory.')
+        elif old == 'inventory':
+            push(uid, 'inventory', f'{templates[tid]["name"]} <sub>{tid}</sub> is no longer in your inventory.')
 
 
-    return web.json_response(status=200, data={"ok":"Item transferred"})
+    return codec.json_response(status=200, data={"ok":"Item transferred"})
 
 
 @routes.post("/query")
@@ -527,46 +1198,373 @@ async def transfer(req: web.Request) -> web.Response:
     
     Return is a list of item ID.
     """
-    try: data = await req.json()
-    except: return web.json_response(status=400, data={"error":"JSON data required"})
+    data = await codec.read(req, codec.QueryRequest)
+    if isinstance(data, web.Response): return data
     did = checkdid(data)
     if isinstance(did, web.Response): return did
-    uid = data.get('user')
-    if uid not in users:
-        return web.json_response(status=400, data={"error":"Valid user ID required"})
+    uid = data['user']
+    if not known(uid):
+        return codec.json_response(status=400, data={"error":"Valid user ID required"})
     if ('location' in data) == ('depth' in data):
-        return web.json_response(status=400, data={"error":"Must provide location xor depth"})
+        return codec.json_response(status=400, data={"error":"Must provide location xor depth"})
 
     if 'location' in data:
         where = data['location']
         if where is None:
-            return web.json_response(status=400, data={"error":"Location required"})
+            return codec.json_response(status=400, data={"error":"Location required"})
         if where != 'inventory':
             where = (did, where)
-        resp = [iid for iid,loc in users[uid]['inventory'].items() if loc == where]
+        resp = list(users[uid].inventory.items_at(where))
     else:
-        resp = [iid for iid in domains[did]['loot'] if iid not in users[uid]['inventory'] and templates[iid].get('depth') == data['depth']]
+        inv = users[uid].inventory
+        resp = [iid for iid in loot_index.get(did,{}).get(data['depth'],()) if iid not in inv]
+    
+    return codec.json_response(status=200, data=resp)
+
+
+
+################################
+###  Section: leaderboard  ###
+
+max_top = 100 # most players a leaderboard lists
+
+def total(me:User) -> float:
+    """A user's total score, as the score command adds it up"""
+    return sum(me.score.values()) + round(me.domstate/2, 2)
+
+def standings_here(k:int, uid:int | None, points:float | None) -> dict:
+    """This worker's share of a leaderboard: its top k, its player count, how many are ahead of points and uid's total"""
+    return {'top':leaders.top(k), 'players':len(leaders), 'above':leaders.above(points) if points is not None else 0,
+        'total':leaders.total(uid) if uid is not None else None}
+
+async def standings(k:int, uid:int | None=None) -> dict:
+    """The top k players across every worker, with their ranks, and uid's rank and total if given"""
+    async def ask(session, body:dict) -> dict:
+        async with session.post('http://worker/_leaders', data=codec.dumps(body)) as resp:
+            return codec.decode(await resp.read())
+    points = None
+    if uid is not None:
+        points = leaders.total(uid) if owner(uid) == worker else (await ask(peers[owner(uid)], {'k':0, 'user':uid}))['total']
+    shares = [standings_here(k, None, points)] + list(await asyncio.gather(*(ask(_, {'k':k, 'points':points}) for _ in peers.values())))
+    best = sorted((tuple(entry) for share in shares for entry in share['top']), key=lambda entry: (-entry[1], entry[0]))[:k]
+    board = {'top':[], 'players':sum(share['players'] for share in shares)}
+    for i, (who, got) in enumerate(best):
+        tied = i and got == best[i-1][1]
+        board['top'].append({'rank':board['top'][-1]['rank'] if tied else i+1, 'user':who, 'total':got})
+    if points is not None:
+        board['user'] = {'rank':1+sum(share['above'] for share in shares), 'user':uid, 'total':points}
+    return board
+
+@routes.get("/leaderboard")
+async def leaderboard(req : web.Request) -> web.Response:
+    """The top players by total score
+    
+    ?k=number of players to list (default 10, at most max_top)
+    &user=a user id, to also give their rank and total
     
-    return web.json_response(status=200, data=resp)
+    Replies {"top":[{"rank":int, "user":int, "total":float}, ...], "players":int} with "user":{"rank":int, "user":int, "total":float} added if asked
+    """
+    try:
+        k = int(req.query.get('k', 10))
+        uid = int(req.query['user']) if 'user' in req.query else None
+    except ValueError:
+        return codec.json_response(status=400, data={"error":"k and user must be integers"})
+    if not 1 <= k <= max_top:
+        return codec.json_response(status=400, data={"error":f"k must be between 1 and {max_top}"})
+    if uid is not None and uid < 0:
+        return codec.json_response(status=400, data={"error":"Valid user ID required"})
+    board = await standings(k, uid)
+    if uid is not None and 'user' not in board:
+        return codec.json_response(status=400, data={"error":"Valid user ID required"})
+    return codec.json_response(data=board)
+
+
+###############################
+###  Section: persistence  ###
+
+journal = None # a journal.Journal when run with --state
+snapshotting = False
+
+def logged(*record) -> None:
+    """Record a change to user state in the write-ahead log, if there is one"""
+    if journal is not None: journal.append(*record)
+
+def replay(seq:int, op:str, uid:int, *args) -> None:
+    """Re-apply a change recorded by logged()"""
+    if op == 'login':
+        add_user(uid, User(args[0]))
+        users[uid].score.setdefault(args[0], 0)
+    elif op == 'in':
+        users[uid].domain = args[0]
+        users[uid].score.setdefault(args[0], 0)
+    elif op == 'move':
+        tid, loc = args
+        users[uid].inventory[tid] = loc if loc == 'inventory' else tuple(loc)
+        if loc == 'inventory': users[uid].mark_had(tid)
+    elif op == 'score':
+        users[uid].score[args[0]] = args[1]
+    elif op == 'domstate':
+        users[uid].domstate = args[0]
+
+def shared_state() -> dict:
+    """The world every worker process has a copy of; briefs are rebuilt from templates instead"""
+    return {'mode':mode, 'domains':domains, 'templates':templates, 'grid':grid,
+        'grid_size':grid_size, 'neighbors':neighbors, 'loot_index':loot_index,
+        'domains_prizes':domains_prizes, 'others_items':others_items, 'signing_key':signing_key}
+
+def world_state() -> dict:
+    """Everything a snapshot needs to restore"""
+    return shared_state() | {'users':users, 'places':places}
+
+def load_shared(state:dict, built:dict | None=None) -> None:
+    """Replace the world with one from shared_state(), and its briefs with built ones if given"""
+    global mode, grid_size, signing_key
+    for name in ('domains','templates','grid','neighbors','loot_index','domains_prizes'):
+        globals()[name].clear()
+        globals()[name].update(state[name])
+    others_items[:] = state['others_items']
+    grid_size = state['grid_size']
+    signing_key = state['signing_key']
+    mode = state['mode']
+    if built is None:
+        make_briefs()
+    else:
+        briefs.clear()
+        briefs.update(built)
+
+def restore(path:str) -> None:
+    """Open the journal in path, loading its snapshot and replaying the log after it"""
+    global journal
+    import gc
+    gc.disable() # none of the millions of objects made here are garbage, so don't keep scanning them
+    try:
+        journal = Journal(path)
+        state, records = journal.load()
+        if state is not None:
+            load_shared(state)
+            users[:] = state['users']
+            places[:] = state['places']
+            place_codes.clear()
+            place_codes.update((_loc_key(loc), code) for code, loc in enumerate(places))
+        for record in records:
+            replay(*record)
+        leaders.build((uid, total(me)) for uid, me in enumerate(users) if me is not None)
+        del state, records
+        gc.freeze()
+    finally:
+        gc.enable()
+
+async def save_snapshot() -> None:
+    """Write all state to the journal so the log before now can be discarded
+
+    A failed save (a full disk, say) is logged and left for the next one to make up: until then
+    the log keeps every record, so nothing is lost, but it grows.
+    """
+    global snapshotting
+    if journal is None or snapshotting or mode != 'play': return
+    snapshotting = True
+    try:
+        await journal.snapshot(world_state())
+    except Exception as ex:
+        eventlog.error('snapshot_failed', path=journal.path, error=repr(ex))
+    finally:
+        snapshotting = False
+
+async def start_snapshots(app):
+    """To be run on startup when there is a journal; snapshots every app.snapshot_every seconds"""
+    async def every():
+        while True:
+            await asyncio.sleep(app.snapshot_every)
+            await save_snapshot()
+    app.snapshots = asyncio.ensure_future(every())
+
+async def end_snapshots(app):
+    """To be run on shutdown when there is a journal"""
+    app.snapshots.cancel()
+    try:
+        await save_snapshot()
+    finally:
+        journal.close()
+
 
+##################################
+###  Section: worker processes  ###
+
+# With --workers, each process serves the same port and keeps a share of the users;
+# requests that reach the wrong one are passed on over the other's Unix socket
+socket_dir = None # directory holding worker<k>.sock for each worker k
+peers = {} # {worker index: ClientSession connected to that worker's Unix socket}
+internal = web.RouteTableDef() # routes served only on the Unix sockets
+
+user_routes = ('/command', '/score', '/transfer', '/query') # POSTed with the "user" they are about
+setup_routes = ('/domain', '/register', '/mode') # worker 0 builds the world, then sends it to the rest
+
+def owner(uid:int) -> int:
+    """The worker process that keeps user uid"""
+    return uid % workers
+
+@web.middleware
+async def to_owner(req : web.Request, handler) -> web.StreamResponse:
+    """Pass requests about another worker's user, and changes during setup, to the worker that handles them"""
+    if workers > 1 and req.path == '/mode/progress' and worker != 0: # worker 0 builds the world
+        async with peers[0].get('http://worker/mode/progress') as resp:
+            return web.Response(status=resp.status, body=await resp.read(), content_type='application/json')
+    if workers > 1 and req.method == 'POST':
+        if req.path in user_routes:
+            try: uid = codec.decode(await req.read()).get('user')
+            except (codec.BadRequest, AttributeError): uid = None # the handler will say what is wrong
+            if isinstance(uid, int) and owner(uid) != worker:
+                return await forward(req, owner(uid))
+        elif req.path in setup_routes and worker != 0:
+            return await forward(req, 0)
+        elif req.path.startswith('/debug/') and 'worker' in req.query: # profile a particular worker
+            if req.query['worker'] not in [str(k) for k in range(workers)]:
+                return codec.json_response(status=400, data={'error':f'worker must be from 0 to {workers-1}'})
+            if int(req.query['worker']) != worker:
+                return await forward(req, int(req.query['worker']), profiler.most_seconds + 30)
+    return await handler(req)
+
+async def forward(req : web.Request, to:int, seconds:float | None=None) -> web.Response:
+    """Pass req on to worker `to`, waiting up to seconds (by default the peer session's timeout) for its reply"""
+    from aiohttp import ClientTimeout
+    headers = {'Content-Type':req.headers.get('Content-Type', 'application/octet-stream')}
+    if 'Authorization' in req.headers: headers['Authorization'] = req.headers['Authorization']
+    longer = {'timeout':ClientTimeout(total=seconds)} if seconds else {}
+    body = req.content.iter_chunked(1 << 16) if req.content_type == 'application/x-ndjson' else await req.read() # streamed on as it comes
+    async with peers[to].post('http://worker'+req.path_qs, data=body, headers=headers, **longer) as resp:
+        return web.Response(status=resp.status, body=await resp.read(),
+            headers={'Content-Type':resp.headers.get('Content-Type', 'application/octet-stream')})
+
+async def broadcast(path:str, body:bytes) -> None:
+    """POST body to path on every other worker"""
+    async def post(session):
+        async with session.post('http://worker'+path, data=body) as resp:
+            if not resp.ok: eventlog.error('worker_status', path=path, status=resp.status, body=(await resp.text())[:200])
+    await asyncio.gather(*(post(_) for _ in peers.values()))
+
+async def socket_elsewhere(login:codec.UserRequest, data:codec.SocketCommand | None) -> tuple[int, str]:
+    """Have the worker that keeps a /ws player check their secret and carry out data, if given"""
+    body = login | {'message':data} if data is not None else login
+    async with peers[owner(login['user'])].post('http://worker/_ws', data=codec.dumps(body)) as resp:
+        reply = codec.decode(await resp.read())
+    return reply['status'], reply['text']
+
+@internal.post('/_ws')
+async def socket_here(req : web.Request) -> web.Response:
+    data = codec.decode(await req.read())
+    uid = checkuid(data)
+    if isinstance(uid, web.Response):
+        return codec.json_response({'status':uid.status, 'text':uid.text})
+    if 'message' not in data:
+        return codec.json_response({'status':200, 'text':'ok'})
+    status, text = await socket_command(uid, data['message'], req.app)
+    return codec.json_response({'status':status, 'text':text})
+
+@internal.post('/_push')
+async def push_here(req : web.Request) -> web.Response:
+    data = codec.decode(await req.read())
+    ws = sockets.get(data['user'])
+    if ws is not None and not ws.closed:
+        await ws.send_str(codec.dumps_str({'push':data['kind'], 'text':data['text']}))
+    return web.Response(text='ok')
+
+@internal.post('/_leaders')
+async def leaders_here(req : web.Request) -> web.Response:
+    data = codec.decode(await req.read())
+    return codec.json_response(standings_here(data['k'], data.get('user'), data.get('points')))
+
+@internal.post('/_world')
+async def world_here(req : web.Request) -> web.Response:
+    """Worker 0 entered play mode and built this world"""
+    await install_world(pickle.loads(await req.read()), 'play')
+    await save_snapshot()
+    return web.Response(text='ok')
+
+async def start_peers(app):
+    from aiohttp import ClientSession, ClientTimeout, UnixConnector
+    for k in range(workers):
+        if k != worker:
+            peers[k] = ClientSession(connector=UnixConnector(path=os.path.join(socket_dir, f'worker{k}.sock')),
+                timeout=ClientTimeout(total=30))
+
+async def end_peers(app):
+    for session in peers.values(): await session.close()
+
+async def run_worker(args) -> None:
+    """Serve as worker process `worker` until sent SIGTERM or SIGINT"""
+    import signal
+    app = make_app(args, [to_owner, metrics.middleware])
+    app.on_startup.append(start_peers)
+    app.on_shutdown.append(end_peers)
+    private = web.Application(client_max_size=1 << 31) # /_world brings the whole world at once
+    private.on_startup.append(start_session)
+    private.on_shutdown.append(end_session)
+    private.add_routes(routes)
+    private.add_routes(internal)
+    private.add_routes(profiler.routes)
+    runners = [web.AppRunner(app), web.AppRunner(private, access_log=None)]
+    for runner in runners: await runner.setup()
+    try:
+        await web.TCPSite(runners[0], args.host, args.port, reuse_port=True).start()
+        await web.UnixSite(runners[1], os.path.join(socket_dir, f'worker{worker}.sock')).start()
+        stop = asyncio.Event()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            asyncio.get_running_loop().add_signal_handler(sig, stop.set)
+        await stop.wait()
+    finally:
+        for runner in runners: await runner.cleanup()
 
 
 async def start_session(app):
     """To be run on startup of each event loop"""
     from aiohttp import ClientSession, ClientTimeout
-    app.client = ClientSession(timeout=ClientTimeout(total=3))
+    app.client = ClientSession(timeout=ClientTimeout(total=3), json_serialize=codec.dumps_str,
+        trace_configs=[metrics.client_trace()])
 
 async def end_session(app):
     """To be run on shutdown of each event loop"""
     await app.client.close()
 
 
+def make_app(args, middlewares:list) -> web.Application:
+    recorder = None
+    if args.record:
+        recorder = traffic.Recorder(args.record if workers == 1 else f'{args.record}.{worker}', 'hub')
+        middlewares = [recorder.middleware] + middlewares
+    app = web.Application(middlewares=middlewares)
+    if recorder is not None:
+        app.cleanup_ctx.append(recorder.running)
+    app.on_startup.append(start_session)
+    app.on_shutdown.append(end_session)
+    if args.state:
+        app.snapshot_every = args.snapshot_every
+        app.on_startup.append(start_snapshots)
+        app.on_shutdown.append(end_snapshots)
+    app.cleanup_ctx.append(static.watch)
+    app.cleanup_ctx.append(eventlog.running)
+    app.cleanup_ctx.append(metrics.lag_monitor)
+    app.cleanup_ctx.append(profiler.watching)
+    app.add_routes(routes)
+    app.add_routes(metrics.routes)
+    app.add_routes(static.routes)
+    app.add_routes(profiler.routes)
+    return app
+
+
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument('--host', type=str, default="0.0.0.0")
     parser.add_argument('-p','--port', type=int, default=10340)
+    parser.add_argument('--state', type=str, help='directory to keep a journal of hub state in, to survive restarts')
+    parser.add_argument('--snapshot-every', type=float, default=60, help='seconds between journal snapshots')
+    parser.add_argument('--workers', type=int, default=1, help='processes to serve the port with, each keeping a share of the users')
+    parser.add_argument('--record', type=str, help='append the requests players and domains send to this trace file; see traffic.py')
+    eventlog.arguments(parser)
+    profiler.arguments(parser)
     args = parser.parse_args()
+    eventlog.configure(args)
+    profiler.configure(args)
 
     import socket
     whoami = socket.getfqdn()
@@ -575,9 +1573,31 @@ if __name__ == '__main__':
     whoami = 'http://' + whoami
     print("URL to visit in browser:\n\t"+whoami)
     print()
-    
-    app = web.Application()
-    app.on_startup.append(start_session)
-    app.on_shutdown.append(end_session)
-    app.add_routes(routes)
-    web.run_app(app, host=args.host, port=args.port)
+
+    def restore_from(path):
+        t0 = time.perf_counter()
+        restore(path)
+        print(f'Restored {sum(_ is not None for _ in users)} users in {mode} mode from {path} in {time.perf_counter()-t0:.2f}s')
+
+    if args.workers == 1:
+        if args.state: restore_from(args.state)
+        web.run_app(make_app(args, [metrics.middleware]), host=args.host, port=args.port)
+    else:
+        import shutil, signal, tempfile
+        workers = args.workers
+        socket_dir = tempfile.mkdtemp(prefix='tba-hub-')
+        children = []
+        for k in range(workers):
+            pid = os.fork()
+            if pid == 0:
+                worker = k
+                if args.state: restore_from(os.path.join(args.state, f'worker{k}'))
+                asyncio.run(run_worker(args))
+                os._exit(0)
+            children.append(pid)
+        def stop(signum, frame):
+            for pid in children: os.kill(pid, signal.SIGTERM)
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        for pid in children: os.waitpid(pid, 0)
+        shutil.rmtree(socket_dir)
@@ -0,0 +1,111 @@
+"""Write-ahead log and snapshots, so a restarted hub can pick up where it left off.
+
+The hub appends a record for each change to its state with `append` and every so often
+writes all of its state with `snapshot`. On restart, `load` returns the newest
+snapshot and the records appended after it was taken, for the hub to replay.
+
+Files in the journal directory:
+    snapshot  pickled state, read back through mmap
+    log       newline-separated JSON records [seq, op, ...] since the last rotate
+    log.old   the previous log segment, until the snapshot that replaces it is saved
+"""
+import asyncio
+import mmap
+import os
+import pickle
+
+import codec
+
+
+class Journal:
+    def __init__(self, path:str):
+        self.path = path
+        self.seq = 0 # sequence number of the last record appended
+        self.log = None
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, name:str) -> str:
+        return os.path.join(self.path, name)
+
+    def load(self) -> tuple[dict | None, list[list]]:
+        """The last snapshot saved (or None) and the records appended after it; opens the log for appending
+
+        This allocates millions of objects for a big hub, so callers should disable gc around it.
+        """
+        state = None
+        if os.path.exists(self._file('snapshot')):
+            with open(self._file('snapshot'), 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                state = pickle.loads(mm)
+        self.seq = state['seq'] if state is not None else 0
+        records = []
+        for name in ('log.old', 'log'):
+            if not os.path.exists(self._file(name)): continue
+            with open(self._file(name), 'r+b') as f:
+                whole, kept = 0, b'' # bytes up to the end of the last complete record, and that record
+                for line in f:
+                    try: record = codec.decode(line)
+                    except codec.BadRequest: break # torn write at the end of the log
+                    whole, kept = whole + len(line), line
+                    if record[0] > self.seq:
+                        records.append(record)
+                        self.seq = record[0]
+                f.truncate(whole) # so records appended later, or a log rotated onto this one, start on a line of their own
+                if kept and not kept.endswith(b'\n'): # only the newline was lost
+                    f.seek(whole)
+                    f.write(b'\n')
+        self.log = open(self._file('log'), 'ab', buffering=0)
+        return state, records
+
+    def append(self, *record) -> None:
+        """Log one change; unbuffered, so it survives the hub process dying right after"""
+        self.seq += 1
+        self.log.write(codec.dumps((self.seq,)+record) + b'\n')
+
+    def rotate(self) -> int:
+        """Start a new log segment, returning the sequence number the next snapshot covers up to"""
+        self.log.close()
+        if os.path.exists(self._file('log.old')): # an earlier save never finished, so keep both segments
+            with open(self._file('log.old'), 'ab') as old, open(self._file('log'), 'rb') as new:
+                old.write(new.read())
+            os.remove(self._file('log'))
+        else:
+            os.replace(self._file('log'), self._file('log.old'))
+        self.log = open(self._file('log'), 'ab', buffering=0)
+        return self.seq
+
+    def save(self, state:dict, seq:int) -> None:
+        """Write state as of record seq (from `rotate`) as the snapshot"""
+        state = dict(state, seq=seq)
+        with open(self._file('snapshot.tmp'), 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self._file('snapshot.tmp'), self._file('snapshot'))
+        if os.path.exists(self._file('log.old')):
+            os.remove(self._file('log.old'))
+
+    async def snapshot(self, state:dict) -> None:
+        """Rotate the log and save state without stalling the event loop
+
+        Where fork() is available a child process serializes a copy-on-write view of state,
+        so the parent can keep changing it; otherwise this blocks while state is saved.
+        """
+        seq = self.rotate()
+        if not hasattr(os, 'fork'):
+            self.save(state, seq)
+            return
+        pid = os.fork()
+        if pid == 0:
+            failed = 1
+            try:
+                self.save(state, seq)
+                failed = 0
+            finally:
+                os._exit(failed)
+        _, status = await asyncio.get_running_loop().run_in_executor(None, os.waitpid, pid, 0)
+        if status != 0:
+            raise RuntimeError(f'snapshot process failed with status {status}')
+
+    def close(self) -> None:
+        if self.log is not None:
+            self.log.close()
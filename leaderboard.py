@@ -0,0 +1,124 @@
+"""Players ranked by total score, kept up to date one change at a time.
+
+A Leaderboard holds one int key per user, -hundredths of a point << 32 | user id, so that
+sorting keys ascending puts the best totals first and breaks ties by user id. Keys are kept
+in sorted buckets of about `load` each, with the bucket sizes in a Fenwick tree, so setting a
+user's total, finding how many users are ahead of a total, and listing the top K each take
+O(log n) plus a memmove within one bucket, even with millions of players.
+"""
+from bisect import bisect_left, insort
+
+
+def _key(uid:int, total:float) -> int:
+    return (-round(total * 100) << 32) | uid
+
+def _total(key:int) -> float:
+    return -(key >> 32) / 100
+
+
+class Leaderboard:
+    """Each user's total score, ordered best first"""
+    load = 1000 # buckets are split when they reach twice this
+
+    def __init__(self):
+        self.buckets = [] # [[key, ...]], each sorted, all of one before all of the next
+        self.maxes = []   # last key of each bucket
+        self.tree = []    # Fenwick tree over len(bucket)
+        self.keys = []    # [key or None], indexed by user id
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def build(self, totals) -> None:
+        """Replace everything with these (user id, total) pairs, sorting once"""
+        self.keys = []
+        for uid, total in totals:
+            self.keys.extend([None] * (uid + 1 - len(self.keys)))
+            self.keys[uid] = _key(uid, total)
+        ordered = sorted(key for key in self.keys if key is not None)
+        self.buckets = [ordered[i:i+self.load] for i in range(0, len(ordered), self.load)]
+        self.maxes = [bucket[-1] for bucket in self.buckets]
+        self.size = len(ordered)
+        self._index()
+
+    def _index(self) -> None:
+        tree = [len(bucket) for bucket in self.buckets]
+        for i in range(len(tree)):
+            j = i | (i + 1)
+            if j < len(tree): tree[j] += tree[i]
+        self.tree = tree
+
+    def _grow(self, i:int, n:int) -> None:
+        while i < len(self.tree):
+            self.tree[i] += n
+            i |= i + 1
+
+    def _before(self, i:int) -> int:
+        """Keys in buckets before bucket i"""
+        n = 0
+        while i > 0:
+            n += self.tree[i - 1]
+            i &= i - 1
+        return n
+
+    def _insert(self, key:int) -> None:
+        if not self.buckets:
+            self.buckets, self.maxes = [[key]], [key]
+            self._index()
+            return
+        i = min(bisect_left(self.maxes, key), len(self.buckets) - 1)
+        bucket = self.buckets[i]
+        insort(bucket, key)
+        self.maxes[i] = bucket[-1]
+        if len(bucket) >= 2 * self.load:
+            self.buckets[i:i+1] = [bucket[:self.load], bucket[self.load:]]
+            self.maxes[i:i+1] = [bucket[self.load-1], bucket[-1]]
+            self._index()
+        else:
+            self._grow(i, 1)
+
+    def _remove(self, key:int) -> None:
+        i = bisect_left(self.maxes, key)
+        bucket = self.buckets[i]
+        del bucket[bisect_left(bucket, key)]
+        if bucket:
+            self.maxes[i] = bucket[-1]
+            self._grow(i, -1)
+        else:
+            del self.buckets[i], self.maxes[i]
+            self._index()
+
+    def set(self, uid:int, total:float) -> None:
+        """Record user uid's new total"""
+        key = _key(uid, total)
+        if uid < len(self.keys):
+            old = self.keys[uid]
+            if old == key: return
+            if old is not None:
+                self._remove(old)
+                self.size -= 1
+        else:
+            self.keys.extend([None] * (uid + 1 - len(self.keys)))
+        self.keys[uid] = key
+        self._insert(key)
+        self.size += 1
+
+    def total(self, uid:int) -> float | None:
+        key = self.keys[uid] if uid < len(self.keys) else None
+        return None if key is None else _total(key)
+
+    def above(self, total:float) -> int:
+        """How many users have a higher total"""
+        key = _key(0, total)
+        i = bisect_left(self.maxes, key)
+        if i == len(self.buckets): return self.size
+        return self._before(i) + bisect_left(self.buckets[i], key)
+
+    def top(self, k:int) -> list[tuple[int, float]]:
+        """The k best (user id, total) pairs, best first"""
+        best = []
+        for bucket in self.buckets:
+            best += bucket[:k - len(best)]
+            if len(best) == k: break
+        return [(key & 0xFFFFFFFF, _total(key)) for key in best]
@@ -0,0 +1,281 @@
+"""Synthetic player load for the hub and domain servers.
+
+Logs in simulated players with /login and has each of them send a seeded random mix of hub
+commands (journey, inventory, drop) and domain commands (go, take, look), then reports
+throughput and latency percentiles for each kind of request.
+
+Against servers that are already running and in play mode:
+
+    python loadgen.py --hub http://localhost:10340 --players 200 --duration 30
+
+With --farm N this process also serves N cheap stand-in domains on one port (as /d/0, /d/1, ...),
+registers them with a hub that is still in setup mode, and switches it to play mode first:
+
+    python loadgen.py --hub http://localhost:10340 --farm 300 --players 1000 --concurrency 200
+
+or only does that, leaving another process to drive players: `python loadgen.py --farm 300 --serve`.
+
+With --scrape URL (repeatable) it also reads URL/metrics before and after sending commands and
+reports how many log events that server wrote or held back and how long its event loop stalled.
+"""
+from aiohttp import web, ClientSession, ClientTimeout, TCPConnector
+import asyncio
+import codec
+import random
+import re
+import time
+
+routes = web.RouteTableDef()
+
+
+##########################################
+###  Section: stand-in domain farm  ###
+
+farm = {} # {n: {"url":str, "hub":url, "id":domain_id, "secret":str, "items":{item_id:name}}}
+rooms = {} # {(stand-in url, user_id): {item_id: name}} what lies where each user is
+items_each = 3 # items each stand-in registers, at depths 0, 1, 2, ...
+
+def stand_in(req : web.Request) -> dict:
+    return farm[int(req.match_info['n'])]
+
+@routes.post('/d/{n:[0-9]+}/newhub')
+async def newhub(req : web.Request) -> web.Response:
+    me = stand_in(req)
+    me['hub'] = await req.text()
+    async with req.app.client.post(me['hub']+'/register', json={
+        'url': me['url'],
+        'name': 'Stand-in '+req.match_info['n'],
+        'description': 'A stand-in domain run by loadgen.py.',
+        'items': [{'name':f'token-{req.match_info["n"]}-{depth}', 'description':'A load-test token.',
+            'verb':{}, 'depth':depth} for depth in range(items_each)],
+    }) as resp:
+        data = codec.decode(await resp.read())
+        if 'error' in data:
+            return codec.json_response(status=resp.status, data=data)
+    me['id'], me['secret'] = data['id'], data['secret']
+    me['items'] = {tid:f'token-{req.match_info["n"]}-{depth}' for depth, tid in enumerate(data['items'])}
+    return codec.json_response({'ok':'Stand-in '+req.match_info['n']+' registered'})
+
+@routes.post('/d/{n:[0-9]+}/arrive')
+async def arrive(req : web.Request) -> web.Response:
+    data = await codec.read(req, codec.ArriveRequest)
+    if isinstance(data, web.Response): return data
+    me = stand_in(req)
+    held = {item['id'] for item in data.get('owned',[])}
+    here = {tid:name for tid, name in me['items'].items() if tid not in held}
+    for item in data.get('dropped',[]) + data.get('prize',[]):
+        here[item['id']] = item['name']
+    rooms[me['url'], data['user']] = here
+    return web.Response(text='ok')
+
+@routes.post('/d/{n:[0-9]+}/depart')
+@routes.post('/d/{n:[0-9]+}/inventory')
+async def ignored(req : web.Request) -> web.Response:
+    return web.Response(text='ok')
+
+@routes.post('/d/{n:[0-9]+}/dropped')
+async def dropped(req : web.Request) -> web.Response:
+    data = await codec.read(req, codec.DroppedRequest)
+    if isinstance(data, web.Response): return data
+    if 'item' in data:
+        rooms.setdefault((stand_in(req)['url'], data['user']), {})[data['item']['id']] = data['item']['name']
+    return codec.json_response('floor')
+
+@routes.post('/d/{n:[0-9]+}/command')
+async def command(req : web.Request) -> web.Response:
+    data = await codec.read(req, codec.DomainCommandRequest)
+    if isinstance(data, web.Response): return data
+    me = stand_in(req)
+    here = rooms.setdefault((me['url'], data['user']), {})
+    verb = data['command'][0] if data['command'] else ''
+    if verb == 'look':
+        return web.Response(text='A bare room.'+''.join(f'\nThere is a {name} <sub>{tid}</sub> here.' for tid, name in here.items()))
+    if verb == 'go':
+        return web.Response(text='You wander around and end up back where you started.')
+    if verb == 'take':
+        name = ' '.join(data['command'][1:])
+        tid = next((tid for tid, n in here.items() if n == name), None)
+        if tid is None:
+            return web.Response(text=f"There's no {name} here to take")
+        async with req.app.client.post(me['hub']+'/transfer', json={
+            'domain':me['id'], 'secret':me['secret'], 'user':data['user'], 'item':tid, 'to':'inventory',
+        }) as resp:
+            if not resp.ok:
+                return web.Response(text=f'You cannot take the {name}: '+await resp.text())
+        del here[tid]
+        return web.Response(text=f'You take the {name}.')
+    return web.Response(status=400, text="I don't know how to do that here.")
+
+
+async def start_farm(n:int, host:str, port:int) -> web.AppRunner:
+    """Serve n stand-in domains on one port"""
+    import socket
+    whoami = socket.getfqdn()
+    if '.' not in whoami: whoami = 'localhost'
+    for i in range(n):
+        farm[i] = {'url':f'http://{whoami}:{port}/d/{i}', 'items':{}}
+    app = web.Application()
+    app.client = ClientSession(timeout=ClientTimeout(total=10), json_serialize=codec.dumps_str)
+    app.on_shutdown.append(lambda app: app.client.close())
+    app.add_routes(routes)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+async def register_farm(hub:str) -> None:
+    """Register every stand-in domain with a hub in setup mode, then start play"""
+    async with ClientSession(timeout=ClientTimeout(total=30)) as session:
+        for d in farm.values():
+            async with session.post(hub+'/domain', data=d['url']) as resp:
+                if not resp.ok: raise RuntimeError(d['url']+' not registered: '+await resp.text())
+        async with session.post(hub+'/mode', data='play') as resp:
+            print(await resp.text())
+
+
+##################################
+###  Section: simulated players  ###
+
+mix = {'journey':5, 'inventory':10, 'drop':5, 'go':25, 'take':20, 'look':35}
+hub_verbs = {'journey', 'inventory', 'drop'}
+
+class Stats:
+    """Latencies of completed requests and counts of failed ones, by route"""
+    def __init__(self):
+        self.times = {} # {route: [seconds]}
+        self.errors = {} # {route: count}
+
+    async def timed(self, route:str, request) -> tuple[int, str] | None:
+        """Send a request, recording how long it took; returns (status, body text) or None on failure"""
+        t0 = time.perf_counter()
+        try:
+            async with request as resp:
+                text = await resp.text()
+        except Exception:
+            self.errors[route] = self.errors.get(route, 0) + 1
+            return None
+        self.times.setdefault(route, []).append(time.perf_counter() - t0)
+        if resp.status >= 500:
+            self.errors[route] = self.errors.get(route, 0) + 1
+        return resp.status, text
+
+    def report(self, seconds:float) -> None:
+        def pct(ts, q): return ts[min(len(ts)-1, int(q*len(ts)))]*1e3
+        print(f'{"route":>18} {"requests":>9} {"errors":>7} {"req/s":>8} {"p50 ms":>8} {"p99 ms":>8} {"p999 ms":>8}')
+        for route in sorted(self.times.keys() | self.errors.keys()):
+            ts = sorted(self.times.get(route, [0]))
+            print(f'{route:>18} {len(self.times.get(route, [])):>9} {self.errors.get(route, 0):>7} '
+                f'{len(self.times.get(route, []))/seconds:>8.1f} {pct(ts,.5):>8.2f} {pct(ts,.99):>8.2f} {pct(ts,.999):>8.2f}')
+
+
+async def player(session:ClientSession, hub:str, rng:random.Random, stats:Stats, slots:asyncio.Semaphore,
+        until:float, think:float, login:dict) -> None:
+    """One simulated player sending commands until time.perf_counter() reaches until"""
+    uid, secret, domain = login['id'], login['secret'], login['domain']['url']
+    seen, carried = [], [] # item names from the last look, item ids from the last inventory
+    verbs, weights = list(mix), list(mix.values())
+    while time.perf_counter() < until:
+        if think: await asyncio.sleep(rng.expovariate(1/think))
+        verb = rng.choices(verbs, weights)[0]
+        if verb == 'take' and not seen: verb = 'look'
+        if verb == 'drop' and not carried: verb = 'inventory'
+        cmd = [verb]
+        if verb == 'journey': cmd.append(rng.choice(('north','south','east','west')))
+        if verb == 'go': cmd.append(rng.choice(('north','south','east','west','up','down')))
+        if verb == 'take': cmd.append(seen.pop(rng.randrange(len(seen))))
+        if verb == 'drop': cmd.append(str(carried.pop(rng.randrange(len(carried)))))
+        async with slots:
+            if verb in hub_verbs:
+                reply = await stats.timed('hub '+verb, session.post(hub+'/command', json={'user':uid, 'secret':secret, 'command':cmd}))
+            else:
+                reply = await stats.timed('domain '+verb, session.post(domain+'/command', json={'user':uid, 'command':cmd}))
+        if reply is None: continue
+        text = reply[1]
+        if text.startswith('$domain '):
+            domain, _, text = text[8:].partition('\n')
+        if verb == 'look': seen = re.findall(r'There is an? (\S+) <sub>', text)
+        if verb == 'inventory': carried = [int(_) for _ in re.findall(r'<sub>(\d+)</sub>', text)]
+
+
+async def scrape(session:ClientSession, url:str) -> dict:
+    """The samples on a server's /metrics page, {name with labels: value}"""
+    async with session.get(url+'/metrics') as resp:
+        text = await resp.text()
+    samples = {}
+    for line in text.splitlines():
+        if line and not line.startswith('#'):
+            name, _, value = line.rpartition(' ')
+            samples[name] = float(value)
+    return samples
+
+def report_server(url:str, before:dict, after:dict) -> None:
+    """Log volume and event-loop lag between two scrapes of url"""
+    delta = {k: v - before.get(k, 0) for k, v in after.items()}
+    print(f'\n{url}')
+    for name, n in sorted(delta.items()):
+        if name.startswith('tba_log_events_total') and n:
+            labels = dict(re.findall(r'(\w+)="([^"]*)"', name))
+            print(f'{"log "+labels["event"]+" "+labels["outcome"]:>30} {n:>9.0f}')
+    lag = 'tba_event_loop_lag_seconds'
+    count = delta.get(lag+'_count{}', 0)
+    if count:
+        buckets = sorted((float(re.search(r'le="([^"]+)"', k)[1]), n) for k, n in delta.items() if k.startswith(lag+'_bucket'))
+        p99 = next(le for le, n in buckets if n >= .99*count)
+        print(f'{"event-loop lag":>30} {count:>9.0f} samples, mean {delta[lag+"_sum{}"]/count*1e3:.2f} ms, p99 under {p99*1e3:g} ms')
+
+
+async def run(hub:str, players:int, concurrency:int, think:float, duration:float, seed:int, scraped:list[str]=()) -> None:
+    stats, login_stats = Stats(), Stats()
+    slots = asyncio.Semaphore(concurrency)
+    async with ClientSession(connector=TCPConnector(limit=concurrency), timeout=ClientTimeout(total=30),
+            json_serialize=codec.dumps_str) as session:
+        logins = []
+        async def log_in():
+            async with slots:
+                reply = await login_stats.timed('hub login', session.get(hub+'/login'))
+            if reply and reply[0] == 200: logins.append(codec.decode(reply[1]))
+        t0 = time.perf_counter()
+        await asyncio.gather(*(log_in() for _ in range(players)))
+        login_stats.report(time.perf_counter()-t0)
+        logins.sort(key=lambda d: d['id'])
+        before = [await scrape(session, url) for url in scraped]
+        t0 = time.perf_counter()
+        await asyncio.gather(*(player(session, hub, random.Random(f'{seed}-{i}'), stats, slots, t0+duration, think, login)
+            for i, login in enumerate(logins)))
+        print()
+        stats.report(time.perf_counter()-t0)
+        for url, was in zip(scraped, before):
+            report_server(url, was, await scrape(session, url))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hub', type=str, default='http://localhost:10340', help='URL of the hub server')
+    parser.add_argument('--players', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=50, help='most requests in flight at once')
+    parser.add_argument('--think', type=float, default=0.0, help='mean seconds a player waits between commands')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds to send commands for after logging in')
+    parser.add_argument('--seed', type=int, default=340)
+    parser.add_argument('--mix', type=str, help='command weights, e.g. "look=30,take=20,journey=5"')
+    parser.add_argument('--farm', type=int, default=0, help='serve this many stand-in domains and register them with the hub')
+    parser.add_argument('--host', type=str, default='0.0.0.0', help='address the stand-in domains listen on')
+    parser.add_argument('-p','--port', type=int, default=3500, help='port the stand-in domains listen on')
+    parser.add_argument('--serve', action='store_true', help='only serve the stand-in domains')
+    parser.add_argument('--scrape', action='append', default=[], metavar='URL', help='report log volume and event-loop lag from URL/metrics')
+    args = parser.parse_args()
+    if args.mix:
+        mix = {k:float(v) for k,v in (_.split('=') for _ in args.mix.split(','))}
+
+    async def main():
+        runner = await start_farm(args.farm, args.host, args.port) if args.farm else None
+        try:
+            if runner is not None: await register_farm(args.hub)
+            if args.serve:
+                print(f'Serving {args.farm} stand-in domains on port {args.port}')
+                await asyncio.Event().wait()
+            await run(args.hub, args.players, args.concurrency, args.think, args.duration, args.seed, args.scrape)
+        finally:
+            if runner is not None: await runner.cleanup()
+
+    asyncio.run(main())
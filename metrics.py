@@ -0,0 +1,141 @@
+"""Request counters and latency histograms for the hub and domain servers, served on /metrics.
+
+Add `middleware` to an application's middlewares, `routes` to its routes, `lag_monitor` to its
+cleanup_ctx and `client_trace()` to the trace_configs of its ClientSession. Handlers that dispatch on a command verb can set
+req['verb'] to have the request's time also recorded by verb.
+
+Everything runs on the event loop's thread, so recording is a couple of list and dict updates
+with no locking; `python bench.py metrics` measures what that costs per request.
+"""
+from aiohttp import web, TraceConfig
+import asyncio
+import bisect
+import time
+
+routes = web.RouteTableDef()
+
+
+#############################
+###  Section: recording  ###
+
+# Upper bounds, in seconds, of the histogram buckets
+buckets = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+histograms = {} # {name: (help, label names, {label values: [count per bucket..., count above the last, sum]})}
+counters = {} # {name: (help, label names, {label values: count})}
+
+def histogram(name:str, help:str, *labels:str) -> dict:
+    """Declare a histogram, returning the dict its series are kept in"""
+    histograms[name] = (help, labels, {})
+    return histograms[name][2]
+
+def counter(name:str, help:str, *labels:str) -> dict:
+    """Declare a counter, returning the dict its series are kept in"""
+    counters[name] = (help, labels, {})
+    return counters[name][2]
+
+def observe(series:dict, values:tuple, seconds:float) -> None:
+    """Add one observation to a histogram's series for these label values"""
+    h = series.get(values)
+    if h is None:
+        h = series[values] = [0]*(len(buckets)+1) + [0.0]
+    h[bisect.bisect_left(buckets, seconds)] += 1
+    h[-1] += seconds
+
+def count(series:dict, values:tuple) -> None:
+    """Add one to a counter's series for these label values"""
+    series[values] = series.get(values, 0) + 1
+
+
+request_seconds = histogram('tba_http_request_duration_seconds', 'Time to handle a request, by route', 'method', 'route')
+request_count = counter('tba_http_requests_total', 'Requests handled, by route and status code', 'method', 'route', 'status')
+command_seconds = histogram('tba_command_duration_seconds', 'Time to handle a player command, by verb', 'verb')
+client_seconds = histogram('tba_client_request_duration_seconds', 'Time for requests to other servers, by target and endpoint', 'target', 'endpoint')
+client_count = counter('tba_client_requests_total', 'Requests to other servers, by target, endpoint and status code', 'target', 'endpoint', 'status')
+loop_lag = histogram('tba_event_loop_lag_seconds', 'How much later than asked the event loop woke from a short sleep; long lags mean something stalled it')
+
+
+@web.middleware
+async def middleware(req : web.Request, handler) -> web.StreamResponse:
+    """Time every request, labelled by the route it matched"""
+    t0 = time.perf_counter()
+    status = 500
+    try:
+        resp = await handler(req)
+        status = resp.status
+        return resp
+    except web.HTTPException as ex:
+        status = ex.status
+        raise
+    finally:
+        seconds = time.perf_counter() - t0
+        resource = req.match_info.route.resource
+        route = resource.canonical if resource is not None else 'unmatched'
+        observe(request_seconds, (req.method, route), seconds)
+        count(request_count, (req.method, route, status))
+        if 'verb' in req:
+            observe(command_seconds, (req['verb'],), seconds)
+
+
+def client_trace() -> TraceConfig:
+    """Times requests made with a ClientSession, by the URL up to its last path segment and that segment"""
+    def record(ctx, url, status):
+        target, _, endpoint = str(url.with_query(None)).rpartition('/')
+        observe(client_seconds, (target, '/'+endpoint), time.perf_counter() - ctx.t0)
+        count(client_count, (target, '/'+endpoint, status))
+    async def start(session, ctx, params):
+        ctx.t0 = time.perf_counter()
+    async def end(session, ctx, params):
+        record(ctx, params.url, params.response.status)
+    async def failed(session, ctx, params):
+        record(ctx, params.url, 'error')
+    trace = TraceConfig()
+    trace.on_request_start.append(start)
+    trace.on_request_end.append(end)
+    trace.on_request_exception.append(failed)
+    return trace
+
+
+lag_every = 0.1 # seconds between event-loop lag measurements
+
+async def lag_monitor(app):
+    """Measure event-loop lag for as long as the application runs"""
+    async def measure():
+        while True:
+            t0 = time.perf_counter()
+            await asyncio.sleep(lag_every)
+            observe(loop_lag, (), max(0.0, time.perf_counter() - t0 - lag_every))
+    task = asyncio.create_task(measure())
+    yield
+    task.cancel()
+
+
+###########################
+###  Section: exporting  ###
+
+def _labels(names:tuple, values:tuple, *extra:str) -> str:
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in values)
+    return '{'+','.join([f'{k}="{v}"' for k,v in zip(names, escaped)] + list(extra))+'}'
+
+def render() -> str:
+    """Everything recorded, in Prometheus text exposition format"""
+    lines = []
+    for name, (help, names, series) in counters.items():
+        lines += [f'# HELP {name} {help}', f'# TYPE {name} counter']
+        for values, n in series.items():
+            lines.append(f'{name}{_labels(names, values)} {n}')
+    for name, (help, names, series) in histograms.items():
+        lines += [f'# HELP {name} {help}', f'# TYPE {name} histogram']
+        for values, h in series.items():
+            total = 0
+            for le, n in zip(buckets + ('+Inf',), h):
+                total += n
+                le = f'le="{le}"'
+                lines.append(f'{name}_bucket{_labels(names, values, le)} {total}')
+            lines.append(f'{name}_sum{_labels(names, values)} {h[-1]}')
+            lines.append(f'{name}_count{_labels(names, values)} {total}')
+    return '\n'.join(lines)+'\n'
+
+@routes.get('/metrics')
+async def serve(req : web.Request) -> web.Response:
+    return web.Response(body=render().encode(), headers={'Content-Type':'text/plain; version=0.0.4; charset=utf-8'})
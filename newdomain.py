@@ -1,6 +1,15 @@
 from aiohttp import web
-from aiohttp.web import Request, Response, json_response
+from aiohttp.web import Request, Response
+from codec import json_response
+import asyncio
+import codec
+import eventlog
+import metrics
+import profiler
 import random
+import sys
+import time
+import traffic
 
 
 routes = web.RouteTableDef()
@@ -11,8 +20,11 @@ hub_url = None
 domain_id = None
 domain_secret = None
 item_ids = {}  
-prizes = []
+starting_items = {}  # Map from room to the item found there before anyone takes it
 users = {}  # Map from user id to their state
+inventories = {}  # Map from user id to (set of carried item ids, time.monotonic() when cached)
+inventory_ttl = 30.0  # seconds before a cached inventory is re-fetched from the hub anyway
+cache_stats = {'hits': 0, 'misses': 0}
 
 
 domain_items = [
@@ -56,39 +68,67 @@ domain_items = [
 
 
 class UserState:
+    __slots__ = ('location', 'keypad_locked', 'dressing_room_used', 'has_departed', 'items', 'named', 'version', 'rendered')
+
     def __init__(self):
         self.location = 'boutique-entrance'  # Starting location
         self.keypad_locked = True  # For VIP room
         self.dressing_room_used = False  
-        self.visited = set()
         self.has_departed = False  # Track if user has departed
+        self.items = {}  # This user's view of each room's items: {room: {item id: item}}
+        self.named = {}  # The same items by name: {room: {item name: {item id: item}}}
+        self.version = 0  # Bumped whenever items change, to invalidate rendered
+        self.rendered = {}  # Item lines of room_text: {(room, keypad_locked): (version, text)}
+
+    def place(self, room, item):
+        self.version += 1
+        self.items.setdefault(room, {})[item['id']] = item
+        self.named.setdefault(room, {}).setdefault(item['name'], {})[item['id']] = item
+
+    def remove(self, room, item):
+        if self.items.get(room, {}).pop(item['id'], None) is None:
+            return
+        self.version += 1
+        same = self.named[room][item['name']]
+        del same[item['id']]
+        if not same:
+            del self.named[room][item['name']]
+
+    def clear(self):
+        self.items.clear()
+        self.named.clear()
+        self.version += 1
+
+    def here(self):
+        """Items in the user's current room, by id"""
+        return self.items.get(self.location, {})
+
+    def find(self, name):
+        """An item with this name in the user's current room, or None"""
+        same = self.named.get(self.location, {}).get(name)
+        return next(iter(same.values())) if same else None
 
 
 locs = {
     'boutique-entrance': {
         'description': "You're in a glamorous boutique entrance with crystal chandeliers and marble floors. Shopping bags from various designers line the display windows. (Head north to shop, east to fitting rooms, south to journey)",
-        'exits': {'north': 'shopping-area', 'east': 'fitting-rooms', 'south': 'journey'},
-        'items': []
+        'exits': {'north': 'shopping-area', 'east': 'fitting-rooms', 'south': 'journey'}
     },
     'shopping-area': {
     'description': "Racks of designer clothes surround you...",
-    'exits': {'south': 'boutique-entrance', 'up': 'accessories', 'east': 'vip-lounge'},
-    'items': [] 
+    'exits': {'south': 'boutique-entrance', 'up': 'accessories', 'east': 'vip-lounge'}
     },
     'accessories': {
         'description': "Sparkling jewelry and designer handbags are displayed in illuminated glass cases. A makeup counter shimmers with the latest products. (Go down to return to shopping area)",
-        'exits': {'down': 'shopping-area'},
-        'items': []
+        'exits': {'down': 'shopping-area'}
     },
     'fitting-rooms': {
         'description': "Plush velvet curtains separate individual fitting rooms. A special VIP room with a gold door and keypad catches your eye. (Go west to return to entrance, then head north and east from there to reach the VIP lounge",
-        'exits': {'west': 'boutique-entrance'},
-        'items': []
+        'exits': {'west': 'boutique-entrance'}
     },
     'vip-lounge': {
         'description': "An exclusive area with a digital keypad by the door. Hint: check the sales-flyer for the code and 'tell keypad ____', then explore other domains to find a gold card ('use gold-card')! (West to shopping area → south to entrance/up to accessories)",
-        'exits': {'west': 'shopping-area'},
-        'items': []
+        'exits': {'west': 'shopping-area'}
     }
 }
 
@@ -97,17 +137,19 @@ locs = {
 
 @routes.post('/depart')
 async def handle_depart(req: Request) -> Response:
-    data = await req.json()
+    data = await codec.read(req, codec.HubRequest)
+    if isinstance(data, Response): return data
    
     if data['secret'] != domain_secret:
         return Response(status=403)
        
     user_id = data['user']
-    print(f"DEPART - Before departure: User {user_id} state exists: {user_id in users}")
+    inventories.pop(user_id, None)
     if user_id in users:
-        print(f"DEPART - Keypad state: {users[user_id].keypad_locked}")
         users[user_id].has_departed = True  # Mark as departed instead of deleting
-        print(f"DEPART - User marked as departed, keypad state: {users[user_id].keypad_locked}")
+        eventlog.info('depart', user=user_id, keypad_locked=users[user_id].keypad_locked)
+    else:
+        eventlog.info('depart', user=user_id, known=False)
    
     return Response(status=200)
 
@@ -117,14 +159,13 @@ async def register_with_hub_server(req: Request) -> Response:
     global hub_url, domain_id, domain_secret
    
     hub_url = await req.text()
-    # Only register once
-    async with req.app.client.post(hub_url+'/register', json={
+    # Only register once; the items are streamed a line each, so a long catalog is never one big body
+    async with req.app.client.post(hub_url+'/register', data=codec.ndjson({
         'url': whoami,
         'name': "Exclusive Fashion Boutique",
         'description': "A luxurious shopping destination with designer items and a mysterious VIP room. Let's start our journey by exploring north and taking what you find then after that go upstairs before returning downstairs to continue shopping. (Check item IDs of the items you journey (lipbalm, gold-card, diamond-necklace) for by looking in your invetory after you get them )",
-        'items': domain_items,
-    }) as resp:
-        data = await resp.json()
+    }, domain_items), headers={'Content-Type': 'application/x-ndjson'}) as resp:
+        data = codec.decode(await resp.read())
         if 'error' in data:
             return json_response(status=resp.status, data=data)
        
@@ -133,20 +174,22 @@ async def register_with_hub_server(req: Request) -> Response:
        
         # Clear and reinitialize state
         item_ids.clear()
-        for i, item_id in enumerate(data['items']):
+        ids = (item_id for first, after in data['ranges'] for item_id in range(first, after))
+        for i, item_id in enumerate(ids):
             item_ids[i] = item_id
         
         users.clear()
-        for loc in locs.values():
-            loc['items'] = []
+        inventories.clear()
            
         # Set initial items
-        locs['boutique-entrance']['items'] = [{
-            'name': 'sales-flyer',
-            'id': item_ids[0],
-            'description': domain_items[0]['description'],
-            'verb': domain_items[0]['verb']
-        }]
+        starting_items.clear()
+        for room, i in (('shopping-area', 3), ('boutique-entrance', 0)):
+            starting_items[room] = {
+                'name': domain_items[i]['name'],
+                'id': item_ids[i],
+                'description': domain_items[i]['description'],
+                'verb': domain_items[i]['verb']
+            }
        
         return json_response({'ok': 'Exclusive Fashion Boutique registered successfully'})
 
@@ -154,8 +197,8 @@ async def register_with_hub_server(req: Request) -> Response:
 @routes.post('/arrive')
 async def register_with_hub_server(req: Request) -> Response:
     """Called by hub server each time a user enters or re-enters this domain."""
-    global prizes
-    data = await req.json()
+    data = await codec.read(req, codec.ArriveRequest)
+    if isinstance(data, Response): return data
     
     if data['secret'] != domain_secret:
         return Response(status=403)
@@ -164,63 +207,48 @@ async def register_with_hub_server(req: Request) -> Response:
     user_id = data['user']
     arrival_direction = data.get('from', 'login')
     
-    print(f"ARRIVE - Before: User {user_id} state exists: {user_id in users}")
-    
-    if user_id in users:
-        print(f"ARRIVE - Current keypad state: {users[user_id].keypad_locked}")
-        print(f"ARRIVE - Has departed: {users[user_id].has_departed}")
+    known = user_id in users
+    if known:
         users[user_id].has_departed = False
         users[user_id].location = 'boutique-entrance'
-        print(f"ARRIVE - Preserved state with keypad: {users[user_id].keypad_locked}")
     else:
-        print(f"ARRIVE - Creating brand new state for user {user_id}")
         users[user_id] = UserState()
+
+    # The hub already told us what the user is carrying, so seed the inventory cache
+    inventories[user_id] = ({i['id'] for i in data.get('owned', []) + data.get('carried', [])}, time.monotonic())
     
-    # Reset locations but maintain user state
-    for loc in locs.values():
-        loc['items'] = []
+    # Rebuild this user's view of the rooms; other users' views are untouched
+    state = users[user_id]
+    state.clear()
+    had = {i['id'] for i in data.get('owned', [])} | {i['id'] for i in data.get('dropped', [])}
 
     # Add fashion magazine only if user doesn't have it
-    if not any(i.get('name') == 'fashion-magazine' for i in data.get('owned', [])) and \
-       not any(i.get('name') == 'fashion-magazine' for i in data.get('dropped', [])):
-        locs['shopping-area']['items'].append({
-            'name': 'fashion-magazine',
-            'id': item_ids[3],
-            'description': domain_items[3]['description'],
-            'verb': domain_items[3]['verb']
-        })
+    if item_ids[3] not in had:
+        state.place('shopping-area', starting_items['shopping-area'])
     
     # Handle depth-based item placement
     for item in prizes:
         depth = item.get('depth', 0)
         if depth == 0:
-            locs['accessories']['items'].append(item)
+            state.place('accessories', item)
         elif depth == 1 or depth == 2:
-            locs['vip-lounge']['items'].append(item)
+            state.place('vip-lounge', item)
             
     # Handle dropped items
     for item in data.get('dropped', []):
-        loc = item['location']
-        if isinstance(loc, tuple):
-            loc = loc[1]
-        locs[loc]['items'].append(item)
+        state.place(item['location'], item)
     
     # Place starting flyer if user doesn't have it
-    if not any(i.get('name') == 'sales-flyer' for i in data.get('owned', [])) and \
-       not any(i.get('name') == 'sales-flyer' for i in data.get('dropped', [])):
-        locs['boutique-entrance']['items'].append({
-            'name': 'sales-flyer',
-            'id': item_ids[0],
-            'description': domain_items[0]['description'],
-            'verb': domain_items[0]['verb']
-        })
+    if item_ids[0] not in had:
+        state.place('boutique-entrance', starting_items['boutique-entrance'])
     
-    print(f"ARRIVE - Final keypad state: {users[user_id].keypad_locked}")
+    eventlog.info('arrive', user=user_id, known=known, keypad_locked=state.keypad_locked, prizes=len(prizes))
     return Response(status=200)
 
 @routes.post('/dropped')
 async def handle_dropped(req: Request) -> Response:
-    data = await req.json()
+    data = await codec.read(req, codec.DroppedRequest)
+    if isinstance(data, Response): return data
    
     if data['secret'] != domain_secret:
         return Response(status=403)
@@ -231,7 +259,7 @@ async def handle_dropped(req: Request) -> Response:
    
     current_location = users[user_id].location
    
-    # Store dropped item in current location's items list
+    # Store dropped item in this user's view of the current location
     if 'item' in data:
         item_data = {
             'name': data['item']['name'],
@@ -239,254 +267,279 @@ async def handle_dropped(req: Request) -> Response:
             'description': data['item'].get('description', ''),
             'verb': data['item'].get('verb', {})
         }
-        locs[current_location]['items'].append(item_data)
+        users[user_id].place(current_location, item_data)
+        if user_id in inventories:
+            inventories[user_id][0].discard(item_data['id'])
    
     return json_response(users[user_id].location)
 
 
+@routes.post('/inventory')
+async def handle_inventory_changed(req: Request) -> Response:
+    """Called by hub server when a user's inventory changed somewhere other than this domain."""
+    data = await codec.read(req, codec.HubRequest)
+    if isinstance(data, Response): return data
+
+    if data['secret'] != domain_secret:
+        return Response(status=403)
+
+    inventories.pop(data['user'], None)
+    return Response(status=200)
+
+
+@routes.get('/cache')
+async def handle_cache_stats(req: Request) -> Response:
+    """Report how well the inventory cache is saving /query calls to the hub."""
+    total = cache_stats['hits'] + cache_stats['misses']
+    return json_response({
+        'hits': cache_stats['hits'],
+        'misses': cache_stats['misses'],
+        'hit_rate': cache_stats['hits'] / total if total else 0.0,
+        'hub_calls_avoided': cache_stats['hits'],
+        'cached_users': len(inventories),
+    })
+
+
+async def get_inventory(app, user_id):
+    """Set of item ids the user is carrying, or None if the hub can't tell us.
+
+    Served from the inventory cache when fresh; otherwise asks the hub with /query."""
+    cached = inventories.get(user_id)
+    if cached is not None and time.monotonic() - cached[1] < inventory_ttl:
+        cache_stats['hits'] += 1
+        return cached[0]
+    cache_stats['misses'] += 1
+    async with app.client.post(hub_url+'/query', json={
+        'domain': domain_id,
+        'secret': domain_secret,
+        'user': user_id,
+        'location': 'inventory'
+    }) as resp:
+        if resp.status != 200:
+            return None
+        inventory = set(codec.decode(await resp.read()))
+    inventories[user_id] = (inventory, time.monotonic())
+    return inventory
+
+
+
+
+commands = {}  # {verb: (handler, fewest words after the verb, most words after it)}
+
+def command(verb, fewest=0, most=None):
+    """Register the handler for a verb that takes fewest to most (default: any number of) words after it.
+
+    It is called as handler(req, user_id, state, words) and may return None for "I don't know how to do that."
+    """
+    def register(handler):
+        commands[verb] = (handler, fewest, sys.maxsize if most is None else most)
+        return handler
+    return register
+
+
+def room_text(state, look=False):
+    """The description of the user's room and what they can see in it
+
+    The item lines are cached per user by (room, keypad state) and rebuilt only when
+    state.version shows their items changed, so repeated looks are a dict lookup."""
+    room = state.location
+    head = locs[room]['description']
+    if look and room == 'vip-lounge' and not state.keypad_locked:
+        head += "\nThe VIP lounge contains exclusive items and a private styling area but youll need certain things to make it all the way through."
+    key = (room, state.keypad_locked)
+    cached = state.rendered.get(key)
+    if cached is None or cached[0] != state.version:
+        vip = room == 'vip-lounge'
+        lines = []
+        for item in state.here().values():
+            depth = item.get('depth', 0)
+            if not vip or not state.keypad_locked or depth == 0:
+                where = 'in the VIP section' if vip and depth >= 1 else 'here'
+                lines.append(f"\nThere is a {item['name']} <sub>{item['id']}</sub> {where}.")
+        cached = state.rendered[key] = (state.version, ''.join(lines))
+    return head + cached[1]
 
 
 @routes.post("/command")
 async def handle_command(req: Request) -> Response:
-    data = await req.json()
-    user_id = data['user']
-   
+    data = await codec.read(req, codec.DomainCommandRequest)
+    if isinstance(data, Response): return data
+    req['verb'] = command_verb(data['command'])
+    return await run_command(req, data['user'], data['command'])
+
+
+batch_limit = 1000  # most commands in one /commands request
+
+@routes.post("/commands")
+async def handle_commands(req: Request) -> Response:
+    """Handle {"commands":[{"user":id, "command":[str]}, ...]} in one request, replying with a list of
+    {"status":int, "text":str} in the same order; each user's commands run in order, different users' concurrently."""
+    data = await codec.read(req, codec.DomainBatchRequest)
+    if isinstance(data, Response): return data
+    entries = data['commands']
+    if len(entries) > batch_limit:
+        return json_response(status=413, data={'error': f'At most {batch_limit} commands per request'})
+    results = [None] * len(entries)
+
+    async def run_in_order(indexes):
+        for i in indexes:
+            t0 = time.perf_counter()
+            try:
+                resp = await run_command(req, entries[i]['user'], entries[i]['command'])
+                results[i] = {'status': resp.status, 'text': resp.text}
+            except Exception as ex:
+                eventlog.error('command_failed', command=entries[i]['command'], error=repr(ex))
+                results[i] = {'status': 500, 'text': '500 Internal Server Error'}
+            metrics.observe(metrics.command_seconds, (command_verb(entries[i]['command']),), time.perf_counter() - t0)
+
+    by_user = {}
+    for i, entry in enumerate(entries):
+        by_user.setdefault(entry['user'], []).append(i)
+    await asyncio.gather(*(run_in_order(_) for _ in by_user.values()))
+    return json_response(results)
+
+
+def command_verb(command):
+    """command[0] if it is a registered verb, for labelling metrics without letting players invent labels"""
+    return command[0] if command and command[0] in commands else 'other'
+
+
+async def run_command(req, user_id, command):
+    """Carry out one player command; shared by /command and /commands"""
     if user_id not in users:
         return Response(text="You have to journey to this domain before you can send it commands.")
 
     if users[user_id].has_departed:
         return Response(status=409, text="You have departed from this domain. You must arrive again before sending commands.")
-       
-    command = data['command']
-    state = users[user_id]
-    current_loc = locs[state.location]
-   
-    def cur_loc(name):
-        return any(i['name'] == name for i in current_loc['items'])
-       
-    def get_cur_loc(name):
-        return next((i for i in current_loc['items'] if i['name'] == name), None)
-       
-    if command[0] == 'look':
-        if len(command) == 1:
-            response = current_loc['description']
-            if state.location == 'vip-lounge' and not state.keypad_locked:
-                response += "\nThe VIP lounge contains exclusive items and a private styling area but youll need certain things to make it all the way through."
-           
-            # Show items in location
-            for item in current_loc['items']:
-                if (state.location != 'vip-lounge' or
-                    not state.keypad_locked or
-                    item.get('depth', 0) == 0):
-                    if state.location == 'vip-lounge' and item.get('depth', 0) >= 1:
-                        response += f"\nThere is a {item['name']} <sub>{item['id']}</sub> in the VIP section."
-                    else:
-                        response += f"\nThere is a {item['name']} <sub>{item['id']}</sub> here."
-            return Response(text=response)
-       
-        # Handle look <item>
-        else:
-            item = command[1]
-            if item == 'keypad' and state.location == 'vip-lounge':
-                return Response(text="A sleek digital keypad guards the VIP area. It's waiting for a code... if only you had one maybe you read something on the sales-flyer about it... hint 'tell keypad ____")
-               
-            # Check inventory for items
-            async with req.app.client.post(hub_url+'/query', json={
-                'domain': domain_id,
-                'secret': domain_secret,
-                'user': user_id,
-                'location': 'inventory'
-            }) as resp:
-                if resp.status == 200:
-                    inventory = await resp.json()
-                    if item == 'sales-flyer' and item_ids[0] in inventory:
-                        return Response(text=domain_items[0]['description'])
-                       
-            if cur_loc(item):
-                item_obj = get_cur_loc(item)
-                if 'description' in item_obj:
-                    return Response(text=item_obj['description'])
-                       
-            return Response(text="I don't know how to do that.")
-   
-    elif command[0] == 'read':
-        item_name = command[1]
-        async with req.app.client.post(hub_url+'/query', json={
-            'domain': domain_id,
-            'secret': domain_secret,
-            'user': user_id,
-            'location': 'inventory'
-        }) as resp:
-            if resp.status == 200:
-                inventory = await resp.json()
-                if item_ids[0] in inventory and item_name == 'sales-flyer':
-                    return Response(text='The flyer reads <q>VIP Room Code: VIP123</q>')
-          
-        return Response(text="I don't know how to do that.")
-   
-    # elif command[0] == 'use':
-    #     if len(command) >= 2:
-    #         item_name = command[1]
-    #         async with req.app.client.post(hub_url+'/query', json={
-    #             'domain': domain_id,
-    #             'secret': domain_secret,
-    #             'user': user_id,
-    #             'location': 'inventory'
-    #         }) as resp:
-    #             if resp.status == 200:
-    #                 inventory = await resp.json()
-    #                 if item_name == 'vip-card' and item_ids[1] in inventory:
-    #                     if state.location == 'vip-lounge':
-    #                         if not state.keypad_locked:
-    #                             # Check inventory for depth-2 items
-    #                             async with req.app.client.post(hub_url+'/query', json={
-    #                                 'domain': domain_id,
-    #                                 'secret': domain_secret,
-    #                                 'user': user_id,
-    #                                 'location': 'inventory'
-    #                             }) as depth_resp:
-    #                                 if depth_resp.status == 200:
-    #                                     depth_inv = await depth_resp.json()
-    #                                     # Get all depth-2 items from VIP section
-    #                                     depth_2_items = [item['id'] for item in locs['vip-lounge']['items'] if item.get('depth') == 2]
-    #                                     # Check if any depth-2 item is in inventory
-    #                                     has_depth_2 = any(item_id in depth_inv for item_id in depth_2_items)
-                                        
-    #                                     if not has_depth_2:
-    #                                         return Response(text="You need to take a special item from the VIP section first.")
-                                        
-    #                                     state.keypad_locked = False
-    #                                     async with req.app.client.post(hub_url+'/score', json={
-    #                                         'domain': domain_id,
-    #                                         'secret': domain_secret,
-    #                                         'user': user_id,
-    #                                         'score': 1.0
-    #                                     }) as score_resp:
-    #                                         pass
-    #                                     return Response(text="CONGRATULATIONS! You've won! You swipe the VIP card and enter the showroom with your special item!\n\nYour game score is now 1.0 - you've completed this domain!")
-    #                             return Response(text="You need VIP access to take items from this area")
-    elif command[0] == 'use':
-        if len(command) >= 2:
-            item_name = command[1]
-            async with req.app.client.post(hub_url+'/query', json={
-                'domain': domain_id,
-                'secret': domain_secret,
-                'user': user_id,
-                'location': 'inventory'
-            }) as resp:
-                if resp.status == 200:
-                    inventory = await resp.json()
-                    if item_name == 'gold-card' and item_ids[1] in inventory:
-                        if state.location == 'vip-lounge':
-                            if not state.keypad_locked:
-                                # check if they have a depth-2 item 
-                                depth_2_items = [item_id for item_id in inventory 
-                                            if item_id == item_ids[4]]  # diamond-necklace ID
-                                
-                                if depth_2_items:
-                                    state.keypad_locked = False
-                                    async with req.app.client.post(hub_url+'/score', json={
-                                        'domain': domain_id,
-                                        'secret': domain_secret,
-                                        'user': user_id,
-                                        'score': 1.0
-                                    }) as score_resp:
-                                        pass
-                                    return Response(text="CONGRATULATIONS! You've won! You swipe the gold-card and enter the showroom with your special item!\n\nYour game score is now 1.0 - you've completed this domain!")
-                                
-                                return Response(text="You need to take the diamond-necklace from the VIP section first.")
-                            return Response(text="You need to enter the correct keypad code first.")
 
+    handler, fewest, most = commands.get(command[0] if command else '', (None, 0, -1))
+    response = None
+    if fewest <= len(command)-1 <= most:
+        response = await handler(req, user_id, users[user_id], command[1:])
+    return response if response is not None else Response(text="I don't know how to do that.")
+
+
+@command('look')
+async def look(req, user_id, state, words):
+    if not words:
+        return Response(text=room_text(state, look=True))
+
+    item = words[0]
+    if item == 'keypad' and state.location == 'vip-lounge':
+        return Response(text="A sleek digital keypad guards the VIP area. It's waiting for a code... if only you had one maybe you read something on the sales-flyer about it... hint 'tell keypad ____")
+       
+    # Check inventory for items
+    inventory = await get_inventory(req.app, user_id)
+    if inventory is not None:
+        if item == 'sales-flyer' and item_ids[0] in inventory:
+            return Response(text=domain_items[0]['description'])
                
-    elif command[0] == 'take':
-        if len(command) != 2:
-            return Response(text="I don't know how to do that.")
-            
-        item_identifier = command[1]
+    item_obj = state.find(item)
+    if item_obj is not None:
+        if 'description' in item_obj:
+            return Response(text=item_obj['description'])
+
+
+@command('read', 1)
+async def read(req, user_id, state, words):
+    inventory = await get_inventory(req.app, user_id)
+    if inventory is not None:
+        if item_ids[0] in inventory and words[0] == 'sales-flyer':
+            return Response(text='The flyer reads <q>VIP Room Code: VIP123</q>')
+
+
+@command('use', 1)
+async def use(req, user_id, state, words):
+    inventory = await get_inventory(req.app, user_id)
+    if inventory is not None:
+        if words[0] == 'gold-card' and item_ids[1] in inventory:
+            if state.location == 'vip-lounge':
+                if not state.keypad_locked:
+                    # check if they have the depth-2 item, the diamond-necklace
+                    if item_ids[4] in inventory:
+                        state.keypad_locked = False
+                        async with req.app.client.post(hub_url+'/score', json={
+                            'domain': domain_id,
+                            'secret': domain_secret,
+                            'user': user_id,
+                            'score': 1.0
+                        }) as score_resp:
+                            pass
+                        return Response(text="CONGRATULATIONS! You've won! You swipe the gold-card and enter the showroom with your special item!\n\nYour game score is now 1.0 - you've completed this domain!")
+                    
+                    return Response(text="You need to take the diamond-necklace from the VIP section first.")
+                return Response(text="You need to enter the correct keypad code first.")
+
+
+@command('take', 1, 1)
+async def take(req, user_id, state, words):
+    item_identifier = words[0]
+    
+    # Try to parse as item ID first
+    try:
+        item_id = int(item_identifier)
+        # Find item by ID
+        item = state.here().get(item_id)
+        if item:
+            item_name = item['name']
+        else:
+            return Response(text=f"There's no item with ID {item_id} here to take")
+    except ValueError:
+        # If not an ID, treat as item name
+        item_name = item_identifier
+        item = state.find(item_name)
         
-        # Try to parse as item ID first
-        try:
-            item_id = int(item_identifier)
-            # Find item by ID
-            item = next((i for i in current_loc['items'] if str(i['id']) == str(item_id)), None)
-            if item:
-                item_name = item['name']
-            else:
-                return Response(text=f"There's no item with ID {item_id} here to take")
-        except ValueError:
-            # If not an ID, treat as item name
-            item_name = item_identifier
-            item = get_cur_loc(item_name)
+        if not item:
+            return Response(text=f"There's no {item_name} here to take")
             
-            if not item:
-                return Response(text=f"There's no {item_name} here to take")
-                
-        if state.location == 'vip-lounge' and state.keypad_locked:
-            return Response(text=f"You need VIP access to take items from this area")
+    if state.location == 'vip-lounge' and state.keypad_locked:
+        return Response(text=f"You need VIP access to take items from this area")
+    
+    if state.location == 'vip-lounge' and item.get('depth') == 2:
+        # Check if they have a depth-0 item first
+        inventory = await get_inventory(req.app, user_id)
+        if inventory is not None:
+            if not any(str(item_id) in str(item_ids[1]) for item_id in inventory):
+                return Response(text="You need the gold-card to take special items.")
         
-        if state.location == 'vip-lounge' and item.get('depth') == 2:
-            # Check if they have a depth-0 item first
-            async with req.app.client.post(hub_url+'/query', json={
-                'domain': domain_id,
-                'secret': domain_secret,
-                'user': user_id,
-                'location': 'inventory'
-            }) as depth_resp:
-                if depth_resp.status == 200:
-                    inventory = await depth_resp.json()
-                    if not any(str(item_id) in str(item_ids[1]) for item_id in inventory):
-                        return Response(text="You need the gold-card to take special items.")
+    async with req.app.client.post(hub_url+'/transfer', json={
+        'domain': domain_id,
+        'secret': domain_secret,
+        'user': user_id,
+        'item': item['id'],
+        'to': 'inventory'
+    }) as resp:
+        if resp.status != 200:
+            return Response(text="I don't know how to do that.")
+    if user_id in inventories:
+        inventories[user_id][0].add(item['id'])
             
-        async with req.app.client.post(hub_url+'/transfer', json={
-            'domain': domain_id,
-            'secret': domain_secret,
-            'user': user_id,
-            'item': item['id'],
-            'to': 'inventory'
-        }) as resp:
-            if resp.status != 200:
-                return Response(text="I don't know how to do that.")
-                
-        #current_loc['items'].remove(item)
-        current_loc['items'] = [i for i in current_loc['items'] if i['id'] != item['id']]
-        return Response(text=f"You take the {item_name}.")
+    state.remove(state.location, item)
+    return Response(text=f"You take the {item_name}.")
 
 
-   
-    elif command[0] == 'go':
-        if len(command) != 2:
-            return Response(text="I don't know how to do that.")
-           
-        direction = command[1]
-        if direction not in current_loc['exits']:
-            return Response(text="You can't go that way from here.")
-           
-        new_loc = current_loc['exits'][direction]
-        if new_loc == 'journey':
-            return Response(text="$journey east")
-           
-        state.location = new_loc
-        response = locs[new_loc]['description']
+@command('go', 1, 1)
+async def go(req, user_id, state, words):
+    exits = locs[state.location]['exits']
+    if words[0] not in exits:
+        return Response(text="You can't go that way from here.")
        
-        for item in locs[new_loc]['items']:
-            if (new_loc != 'vip-lounge' or
-                not state.keypad_locked or
-                item.get('depth', 0) == 0):
-                if new_loc == 'vip-lounge' and item.get('depth', 0) >= 1:
-                    response += f"\nThere is a {item['name']} <sub>{item['id']}</sub> in the VIP section."
-                else:
-                    response += f"\nThere is a {item['name']} <sub>{item['id']}</sub> here."
-        return Response(text=response)
-   
-    elif command[0] == 'tell' and len(command) == 3 and command[1] == 'keypad':
-        if state.location == 'vip-lounge':
-            if command[2].upper() == 'VIP123':
-                state.keypad_locked = False
-                return Response(text='The keypad beeps in confirmation. Now you need to swipe your gold card to complete access to the VIP area to enter the private showroom!')
-            else:
-                return Response(text=f'You enter the code "{command[2]}" but nothing happens.')
-        return Response(text="I don't know how to do that.")
+    new_loc = exits[words[0]]
+    if new_loc == 'journey':
+        return Response(text="$journey east")
+       
+    state.location = new_loc
+    return Response(text=room_text(state))
+
 
+@command('tell', 2, 2)
+async def tell(req, user_id, state, words):
+    if words[0] == 'keypad' and state.location == 'vip-lounge':
+        if words[1].upper() == 'VIP123':
+            state.keypad_locked = False
+            return Response(text='The keypad beeps in confirmation. Now you need to swipe your gold card to complete access to the VIP area to enter the private showroom!')
+        else:
+            return Response(text=f'You enter the code "{words[1]}" but nothing happens.')
 
 
 ##dont change this
@@ -505,7 +558,8 @@ async def allow_cors(req, handler):
 async def start_session(app):
     """To be run on startup of each event loop. Makes singleton ClientSession"""
     from aiohttp import ClientSession, ClientTimeout
-    app.client = ClientSession(timeout=ClientTimeout(total=3))
+    app.client = ClientSession(timeout=ClientTimeout(total=3), json_serialize=codec.dumps_str,
+        trace_configs=[metrics.client_trace()])
 
 
 async def end_session(app):
@@ -520,7 +574,12 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--host', type=str, default="0.0.0.0")
     parser.add_argument('-p','--port', type=int, default=3400)
+    parser.add_argument('--record', type=str, help='append the requests the hub and players send to this trace file; see traffic.py')
+    eventlog.arguments(parser)
+    profiler.arguments(parser)
     args = parser.parse_args()
+    eventlog.configure(args)
+    profiler.configure(args)
 
 
     import socket
@@ -532,8 +591,19 @@ if __name__ == '__main__':
     print()
 
 
-    app = web.Application(middlewares=[allow_cors])
+    middlewares = [metrics.middleware, allow_cors]
+    if args.record:
+        recorder = traffic.Recorder(args.record, 'domain')
+        middlewares.insert(0, recorder.middleware)
+    app = web.Application(middlewares=middlewares)
+    if args.record:
+        app.cleanup_ctx.append(recorder.running)
     app.on_startup.append(start_session)
     app.on_shutdown.append(end_session)
+    app.cleanup_ctx.append(eventlog.running)
+    app.cleanup_ctx.append(metrics.lag_monitor)
+    app.cleanup_ctx.append(profiler.watching)
     app.add_routes(routes)
+    app.add_routes(metrics.routes)
+    app.add_routes(profiler.routes)
     web.run_app(app, host=args.host, port=args.port)
@@ -0,0 +1,243 @@
+"""Find out where a running hub or domain server spends its time, without restarting it.
+
+    curl -H 'Authorization: Bearer TOKEN' -XPOST 'localhost:10340/debug/profile?seconds=10' > hub.folded
+    curl -H 'Authorization: Bearer TOKEN' -XPOST 'localhost:10340/debug/stalls?seconds=60&threshold=50'
+
+/debug/profile samples the event loop's stack every `interval` milliseconds of CPU time
+(SIGPROF, so the sample is taken on the loop's own thread, between bytecodes, and time spent
+waiting for I/O isn't sampled) for the given seconds, and replies with collapsed stacks
+("outer;inner;innermost count" lines) ready for flamegraph.pl, inferno or speedscope.
+
+/debug/stalls watches for the event loop going `threshold` milliseconds without running its
+scheduled callbacks, and replies with each stall: how long it was, the stack caught during it,
+and the route (and command verb, if the handler set req['verb']) whose handler was running.
+Run with --stall-threshold to watch all the time, logging loop_stall events and recording
+tba_loop_stall_seconds on /metrics.
+
+Both need the server's --admin-token; without one they answer 404. Nothing runs unless a
+request or --stall-threshold asks for it: no profiling timer, watchdog or middleware.
+"""
+from aiohttp import web
+import asyncio
+import collections
+import hmac
+import os
+import signal
+import sys
+import threading
+import time
+
+import codec
+import eventlog
+import metrics
+
+routes = web.RouteTableDef()
+
+token = None # what Authorization: Bearer must carry; None turns the endpoints off
+interval = 5.0 # milliseconds between samples
+most_seconds = 300 # longest a profile or stall watch may run for
+stall_threshold = 0.0 # seconds; watch for stalls this long all the time when above 0
+
+stall_seconds = metrics.histogram('tba_loop_stall_seconds', 'Times the event loop went longer than --stall-threshold without running callbacks, by the route being handled', 'route', 'verb')
+
+
+def authorized(req : web.Request) -> web.Response | None:
+    if token is None:
+        raise web.HTTPNotFound()
+    given = req.headers.get('Authorization', '').removeprefix('Bearer ')
+    if not hmac.compare_digest(given.encode(), token.encode()):
+        return codec.json_response(status=403, data={'error':'Admin token required'})
+    return None
+
+def window(req : web.Request, default:float) -> web.Response | float:
+    """The seconds=... query parameter, checked"""
+    try:
+        seconds = float(req.query.get('seconds', default))
+    except ValueError:
+        return codec.json_response(status=400, data={'error':'seconds must be a number'})
+    if not 0 < seconds <= most_seconds:
+        return codec.json_response(status=400, data={'error':f'seconds must be above 0 and at most {most_seconds}'})
+    return seconds
+
+
+###############################
+###  Section: sampling  ###
+
+_names = {} # {code object: "function (file:line)"}
+
+def collapse(frame) -> str:
+    """A stack as one collapsed line, outermost frame first"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        name = _names.get(code)
+        if name is None:
+            name = _names[code] = f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+        names.append(name)
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+async def sample(seconds:float, every:float) -> collections.Counter:
+    """Count the distinct stacks the process is in, every `every` seconds of CPU time, for `seconds`"""
+    stacks = collections.Counter()
+    def take(signum, frame):
+        stacks[collapse(frame)] += 1
+    before = signal.signal(signal.SIGPROF, take)
+    signal.setitimer(signal.ITIMER_PROF, every, every)
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, before)
+    return stacks
+
+profiling = False
+
+@routes.post('/debug/profile')
+async def profile(req : web.Request) -> web.Response:
+    """Sample the event loop's stack for ?seconds= (default 10), every ?interval= milliseconds"""
+    global profiling
+    problem = authorized(req)
+    if problem is not None: return problem
+    seconds = window(req, 10)
+    if isinstance(seconds, web.Response): return seconds
+    try:
+        every = float(req.query.get('interval', interval)) / 1e3
+    except ValueError:
+        return codec.json_response(status=400, data={'error':'interval must be a number of milliseconds'})
+    if profiling:
+        return codec.json_response(status=409, data={'error':'Already profiling'})
+    if threading.current_thread() is not threading.main_thread():
+        return codec.json_response(status=501, data={'error':'Signals only reach an event loop on the main thread'})
+    profiling = True
+    try:
+        stacks = await sample(seconds, max(every, 0.001))
+    finally:
+        profiling = False
+    return web.Response(text=''.join(f'{stack} {n}\n' for stack, n in stacks.most_common()),
+        headers={'Content-Disposition':f'attachment; filename="profile-{int(time.time())}.folded"'})
+
+
+###############################
+###  Section: stall detection  ###
+
+def handlers(app:web.Application) -> dict:
+    """{code object of a route's handler: "METHOD /route"}"""
+    found = {}
+    for route in app.router.routes():
+        code = getattr(route.handler, '__code__', None)
+        if code is not None and route.resource is not None:
+            found[code] = f'{route.method} {route.resource.canonical}'
+    return found
+
+def attribute(frame, known:dict) -> tuple[str, str]:
+    """The route whose handler is on this stack, and the verb it set, if any"""
+    while frame is not None:
+        route = known.get(frame.f_code)
+        if route is not None:
+            req = frame.f_locals.get(frame.f_code.co_varnames[0]) if frame.f_code.co_argcount else None
+            return route, req.get('verb', '') if isinstance(req, web.Request) else ''
+        frame = frame.f_back
+    return 'none', ''
+
+
+class Watchdog:
+    """Notices the event loop stalling for longer than threshold seconds, and what it was running
+
+    A task on the loop ticks every threshold/2 seconds. A thread checks on it four times as often
+    and, when a tick is overdue, catches the loop thread's stack. When the late tick comes, the
+    stall is reported to every list in `listeners`, logged, and recorded on /metrics.
+    """
+    def __init__(self, app:web.Application, threshold:float):
+        self.threshold = threshold
+        self.known = handlers(app)
+        self.listeners = []
+        self.thread = threading.get_ident()
+        self.due = time.monotonic() # when the next tick should come
+        self.caught = None # (due, route, verb, stack) caught for the tick due then
+        self.stopping = False
+        self.task = None # when started for /debug/stalls requests, its task, cancelled when the last of them ends
+        self.requests = 0 # /debug/stalls requests listening
+
+    def check(self) -> None:
+        while not self.stopping:
+            time.sleep(self.threshold / 4)
+            due = self.due
+            if time.monotonic() - due > self.threshold and (self.caught is None or self.caught[0] != due):
+                frame = sys._current_frames().get(self.thread)
+                if frame is not None:
+                    self.caught = (due,) + attribute(frame, self.known) + (collapse(frame),)
+                del frame
+
+    async def run(self) -> None:
+        checker = threading.Thread(target=self.check, name='stall-watchdog', daemon=True)
+        checker.start()
+        try:
+            every = self.threshold / 2
+            while True:
+                self.due = time.monotonic() + every
+                await asyncio.sleep(every)
+                late = time.monotonic() - self.due
+                if late > self.threshold:
+                    caught = self.caught if self.caught is not None and self.caught[0] == self.due else (None, 'unknown', '', '')
+                    stall = {'seconds':round(late, 4), 'route':caught[1], 'verb':caught[2], 'stack':caught[3]}
+                    metrics.observe(stall_seconds, (stall['route'], stall['verb']), late)
+                    eventlog.warning('loop_stall', **stall)
+                    for stalls in self.listeners: stalls.append(stall)
+        finally:
+            self.stopping = True
+
+watchdog = None # the Watchdog running, if any
+
+async def watching(app:web.Application):
+    """Watch for stalls for as long as the application runs, if --stall-threshold was given"""
+    global watchdog
+    task = None
+    if stall_threshold > 0:
+        watchdog = Watchdog(app, stall_threshold)
+        task = asyncio.create_task(watchdog.run())
+    yield
+    if task is not None:
+        task.cancel()
+        watchdog = None
+
+@routes.post('/debug/stalls')
+async def stalls(req : web.Request) -> web.Response:
+    """Report stalls over ?seconds= (default 10) longer than ?threshold= milliseconds (default 50, or --stall-threshold)"""
+    global watchdog
+    problem = authorized(req)
+    if problem is not None: return problem
+    seconds = window(req, 10)
+    if isinstance(seconds, web.Response): return seconds
+    found = []
+    if watchdog is None:
+        try:
+            threshold = float(req.query.get('threshold', 50)) / 1e3
+        except ValueError:
+            return codec.json_response(status=400, data={'error':'threshold must be a number of milliseconds'})
+        if threshold <= 0:
+            return codec.json_response(status=400, data={'error':'threshold must be above 0'})
+        watchdog = Watchdog(req.app, threshold)
+        watchdog.task = asyncio.create_task(watchdog.run())
+    dog = watchdog # already watching, perhaps with another threshold, if this request didn't start it
+    dog.listeners.append(found)
+    dog.requests += 1
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        dog.listeners.remove(found)
+        dog.requests -= 1
+        if dog.task is not None and dog.requests == 0:
+            dog.task.cancel()
+            if watchdog is dog: watchdog = None
+    return codec.json_response({'threshold':dog.threshold*1e3, 'stalls':found})
+
+
+def arguments(parser) -> None:
+    parser.add_argument('--admin-token', type=str, help='turns on /debug/profile and /debug/stalls for requests with Authorization: Bearer ADMIN_TOKEN')
+    parser.add_argument('--stall-threshold', type=float, default=0, metavar='MS', help='log each time the event loop stalls this many milliseconds or more (0: only when asked on /debug/stalls)')
+
+def configure(args) -> None:
+    global token, stall_threshold
+    token = args.admin_token
+    stall_threshold = args.stall_threshold / 1e3
@@ -0,0 +1,103 @@
+"""The hub's web front-end, held in memory ready to send.
+
+Each file in `files` is read once, compressed with gzip (and brotli, when that module is
+installed) and served from memory with a strong ETag, so a browser revalidating its copy gets
+a 304 without the disk being touched. `watch` re-reads a file when its modification time
+changes, so edits show up without a restart.
+
+Add `routes` to an application's routes and `watch` to its cleanup_ctx. A request carrying
+?v=<version> of the file's current content is told to cache it for a year; anything else is
+told to revalidate each time.
+"""
+from aiohttp import web
+import asyncio
+import gzip
+import hashlib
+import mimetypes
+import os
+
+import eventlog
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+routes = web.RouteTableDef()
+
+files = {'/': 'tba.html'} # {route: file}; split-out scripts and stylesheets go here too
+check_every = 2.0 # seconds between checks for changed files
+preferred = ('br', 'gzip', 'identity')
+
+
+class Asset:
+    """One file's content in each encoding, with the headers to send for each"""
+    __slots__ = ('mtime', 'version', 'bodies', 'headers')
+
+    def __init__(self, path:str):
+        with open(path, 'rb') as f:
+            self.mtime = os.fstat(f.fileno()).st_mtime_ns
+            body = f.read()
+        self.version = hashlib.blake2s(body, digest_size=8).hexdigest()
+        self.bodies = {'identity': body, 'gzip': gzip.compress(body, 9, mtime=0)}
+        if brotli is not None:
+            self.bodies['br'] = brotli.compress(body)
+        for encoding in ('gzip', 'br'):
+            if len(self.bodies.get(encoding, body)) >= len(body): self.bodies.pop(encoding, None)
+        kind = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        if kind.startswith('text/') or kind.endswith('javascript'): kind += '; charset=utf-8'
+        self.headers = {}
+        for encoding in self.bodies:
+            self.headers[encoding] = {'Content-Type':kind, 'Vary':'Accept-Encoding',
+                'ETag':f'"{self.version}"' if encoding == 'identity' else f'"{self.version}-{encoding}"'}
+            if encoding != 'identity':
+                self.headers[encoding]['Content-Encoding'] = encoding
+
+    def encoding(self, accept:str) -> str:
+        """The most compact encoding both we and an Accept-Encoding header allow"""
+        allowed = set()
+        for part in accept.lower().replace(' ', '').split(','):
+            name, _, q = part.partition(';q=')
+            try:
+                if q and float(q) == 0: continue
+            except ValueError: pass
+            allowed.add(name)
+        return next(e for e in preferred if e in self.bodies and (e in allowed or e == 'identity'))
+
+
+assets = {} # {route: Asset}
+
+def load(route:str) -> None:
+    try:
+        assets[route] = Asset(files[route])
+    except OSError as ex:
+        eventlog.error('static_load_failed', path=files[route], error=repr(ex))
+
+async def watch(app:web.Application):
+    """Load every file, then reload any whose modification time changes"""
+    for route in files: load(route)
+    async def poll():
+        while True:
+            await asyncio.sleep(check_every)
+            for route, path in files.items():
+                try: mtime = os.stat(path).st_mtime_ns
+                except OSError: continue
+                if route not in assets or assets[route].mtime != mtime: load(route)
+    task = asyncio.create_task(poll())
+    yield
+    task.cancel()
+
+
+async def serve(req : web.Request) -> web.Response:
+    asset = assets.get(req.path)
+    if asset is None:
+        raise web.HTTPServiceUnavailable(text=files[req.path]+' could not be loaded')
+    encoding = asset.encoding(req.headers.get('Accept-Encoding', ''))
+    headers = asset.headers[encoding]
+    cache = 'public, max-age=31536000, immutable' if req.query.get('v') == asset.version else 'no-cache'
+    if headers['ETag'] in req.headers.get('If-None-Match', ''):
+        return web.Response(status=304, headers={'ETag':headers['ETag'], 'Vary':'Accept-Encoding', 'Cache-Control':cache})
+    return web.Response(body=asset.bodies[encoding], headers=headers | {'Cache-Control':cache})
+
+for route in files:
+    routes.get(route)(serve)
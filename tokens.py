@@ -0,0 +1,38 @@
+"""Signed session tokens, so a request can be authenticated without looking anything up.
+
+A token names what it was issued to and when it expires, followed by a MAC of both:
+
+    u42.1767225600.5f0c8e1d2b7a94c3e6d1f0a8
+
+is user 42's token until that Unix time ("d" instead of "u" for a domain). Any process
+holding the key can check one, so every hub worker verifies tokens the same way.
+"""
+import hashlib
+import hmac
+import secrets
+import time
+
+
+def new_key() -> bytes:
+    return secrets.token_bytes(32)
+
+def _sign(key:bytes, payload:str) -> bytes:
+    # keyed BLAKE2 is a MAC on its own, and several times faster here than HMAC-SHA256
+    return hashlib.blake2s(payload.encode(), key=key, digest_size=12).hexdigest().encode()
+
+def issue(key:bytes, kind:str, id:int, lifetime:float) -> str:
+    """A token for id of this kind ("u" or "d"), good for lifetime seconds"""
+    payload = f'{kind}{id}.{int(time.time() + lifetime)}'
+    return payload + '.' + _sign(key, payload).decode()
+
+def check(key:bytes, token:str, kind:str, id:int) -> str | None:
+    """None if token is a current one for id of this kind, or else what is wrong with it"""
+    payload, _, signature = token.rpartition('.')
+    if not hmac.compare_digest(_sign(key, payload), signature.encode()):
+        return 'Invalid secret'
+    who, _, expires = payload.partition('.')
+    if who != f'{kind}{id}':
+        return 'Invalid secret'
+    if int(expires) < time.time():
+        return 'Expired secret'
+    return None
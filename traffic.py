@@ -0,0 +1,265 @@
+"""Record the requests a hub or domain server gets, and replay them later against fresh servers.
+
+Run hub.py or newdomain.py with --record FILE to append each /login, /register, /command, /transfer,
+/query, /score, /arrive and /dropped request it handles to FILE (FILE.<worker> for each hub worker),
+with the time it arrived, how long it took and its status. Secrets are left out.
+
+Replay a trace at its recorded pace, N times faster, or as fast as the target allows:
+
+    python traffic.py hub.trace --target http://localhost:10340 --speed 1
+    python traffic.py domain.trace --target http://localhost:3400 --speed 0
+
+A hub trace needs a hub that is still in setup mode: the replayer registers a stand-in domain for
+each domain in the trace (as loadgen.py --farm does), logs players in again as the trace did, and
+swaps in their new ids and secrets, and the stand-ins' item ids for those of domains that registered
+while recording (in /transfer bodies and in commands such as "drop 675"). A domain trace needs a newly started domain server: the
+replayer stands in for its hub to learn the secret /arrive and /dropped need. Afterwards it compares
+latencies and statuses with the recorded ones, route by route.
+
+Other item ids are replayed as recorded, so requests naming items the fresh servers don't have
+will get different answers; those show up in the status comparison.
+"""
+from aiohttp import web, ClientSession, ClientTimeout, TCPConnector
+import asyncio
+import struct
+import time
+
+import codec
+
+routes = ('/login', '/register', '/command', '/transfer', '/query', '/score', '/arrive', '/dropped') # recorded, by index
+codes = {route: i for i, route in enumerate(routes)}
+_record = struct.Struct('<dfHBI') # time.time(), seconds taken, status, route index, length of the body after it
+_magic = b'TBA-TRACE 1 '
+
+
+###############################
+###  Section: recording  ###
+
+def _without_secret(body:bytes) -> bytes:
+    try: data = codec.decode(body)
+    except codec.BadRequest: return b''
+    if isinstance(data, dict): data.pop('secret', None)
+    return codec.dumps(data)
+
+class Recorder:
+    """Appends requests to a trace file; add `middleware` to the app's middlewares and `running` to its cleanup_ctx"""
+    def __init__(self, path:str, server:str):
+        self.path, self.server = path, server # server is "hub" or "domain"
+        self.file = None
+
+    async def running(self, app:web.Application):
+        self.file = open(self.path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(_magic + self.server.encode() + b'\n')
+        yield
+        self.file.close()
+
+    @web.middleware
+    async def middleware(self, req : web.Request, handler) -> web.StreamResponse:
+        code = codes.get(req.path)
+        if code is None or self.file is None:
+            return await handler(req)
+        t, t0 = time.time(), time.perf_counter()
+        answered = req.path in ('/login', '/register') # only what was handed out is kept, so a streamed body stays streamed
+        body = b'' if answered else await req.read() # aiohttp keeps it, so the handler can read it again
+        status, resp = 500, None
+        try:
+            resp = await handler(req)
+            status = resp.status
+            return resp
+        except web.HTTPException as ex:
+            status = ex.status
+            raise
+        finally:
+            took = time.perf_counter() - t0
+            if answered: # what was handed out, to map later requests to the replay's
+                reply = codec.decode(resp.body) if status == 200 else {}
+                if req.path == '/login': data = codec.dumps({'user':reply['id']} if 'id' in reply else {})
+                else: data = codec.dumps({'domain':reply['id'], 'items':reply['items'] if 'items' in reply else
+                    [tid for first, after in reply['ranges'] for tid in range(first, after)]} if 'id' in reply else {})
+            else:
+                data = _without_secret(body)
+            self.file.write(_record.pack(t, took, status, code, len(data)) + data)
+
+
+def read(path:str) -> tuple[str, list[tuple]]:
+    """The server a trace was recorded on and its records, (time, seconds taken, status, route, body)"""
+    with open(path, 'rb') as f:
+        server = f.readline()[len(_magic):].strip().decode()
+        records = []
+        while header := f.read(_record.size):
+            if len(header) < _record.size: break # torn write at the end of the trace
+            t, took, status, code, n = _record.unpack(header)
+            body = f.read(n)
+            if len(body) < n: break
+            records.append((t, took, status, routes[code], codec.decode(body) if body else {}))
+    return server, records
+
+
+###############################
+###  Section: replaying  ###
+
+stand_in_hub = web.RouteTableDef()
+stand_in = {'secret': 'replay-'+str(time.time())} # what the stand-in hub gave the domain server being replayed to
+
+@stand_in_hub.post('/register')
+async def register(req : web.Request) -> web.Response:
+    """Hands out ids 0, 1, ... for the items, in either of the hub's /register formats"""
+    if req.content_type == 'application/x-ndjson':
+        count = -1 # the first line describes the domain
+        try:
+            async for n, lines in codec.read_lines(req):
+                if count < 0: codec.decode_lines(lines[:1], codec.DomainInfo, n)
+                codec.decode_lines(lines[1:] if count < 0 else lines, codec.ItemTemplate, n+1 if count < 0 else n)
+                count += len(lines)
+        except codec.BadRequest as ex:
+            return codec.json_response(status=400, data={'error':str(ex)})
+        if count < 0:
+            return codec.json_response(status=400, data={'error':'Request must start with a line describing the domain'})
+        return codec.json_response({'id':0, 'secret':stand_in['secret'], 'ranges':[[0, count]] if count else [], 'count':count})
+    data = await codec.read(req, codec.RegisterRequest)
+    if isinstance(data, web.Response): return data
+    return codec.json_response({'id':0, 'secret':stand_in['secret'], 'items':list(range(len(data['items'])))})
+
+@stand_in_hub.post('/query')
+async def query(req : web.Request) -> web.Response:
+    return codec.json_response([])
+
+@stand_in_hub.post('/transfer')
+@stand_in_hub.post('/score')
+async def accept(req : web.Request) -> web.Response:
+    return web.Response(text='ok')
+
+
+async def start_stand_in_hub(target:str, host:str, port:int) -> web.AppRunner:
+    """Serve as the hub for the domain server at target, and have it register"""
+    import socket
+    whoami = socket.getfqdn()
+    if '.' not in whoami: whoami = 'localhost'
+    app = web.Application()
+    app.add_routes(stand_in_hub)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    async with ClientSession() as session:
+        async with session.post(target+'/newhub', data=f'http://{whoami}:{port}') as resp:
+            if not resp.ok: raise RuntimeError(target+' did not register: '+await resp.text())
+    return runner
+
+
+def percentile(ts:list[float], q:float) -> float:
+    return ts[min(len(ts)-1, int(q*len(ts)))]*1e3 if ts else 0.0
+
+def report(results:list[tuple]) -> None:
+    """Compare replayed latencies and statuses to the recorded ones, by route"""
+    print(f'{"route":>10} {"requests":>9} {"skipped":>8} {"status changed":>15} {"p50 ms was":>11} {"now":>8} {"p99 ms was":>11} {"now":>8}')
+    for route in routes:
+        mine = [r for r in results if r[0] == route]
+        if not mine: continue
+        done = [r for r in mine if r[3] is not None]
+        was = sorted(r[1] for r in done)
+        now = sorted(r[3] for r in done)
+        changed = sum(r[2] != r[4] for r in done)
+        print(f'{route:>10} {len(mine):>9} {len(mine)-len(done):>8} {changed:>15} '
+            f'{percentile(was,.5):>11.2f} {percentile(now,.5):>8.2f} {percentile(was,.99):>11.2f} {percentile(now,.99):>8.2f}')
+    slower = sorted((r for r in results if r[3] is not None and r[3] > 2*r[1] and r[3] - r[1] > .001),
+        key=lambda r: r[1] - r[3])[:5]
+    if slower:
+        print('\nfurthest from the recording:')
+        for route, was, was_status, now, status, t in slower:
+            print(f'  {route} at +{t:.3f}s: {was*1e3:.2f} ms -> {now*1e3:.2f} ms, status {was_status} -> {status}')
+
+
+async def replay(paths:list[str], target:str, speed:float, concurrency:int, host:str, port:int) -> None:
+    """Send the requests in the traces at paths to target, speed times as fast as recorded (0: flat out)"""
+    import loadgen
+    traces = [read(path) for path in paths]
+    server = traces[0][0]
+    records = sorted((r for _, rs in traces for r in rs), key=lambda r: r[0])
+    if not records: return
+    servers = [] # AppRunners for stand-in domains or the stand-in hub
+    users = {} # {recorded user id: (id, secret) on target}
+    domains = {} # {recorded domain id: (id, secret) on target}
+    items = {} # {recorded item id: item id on target}
+    if server == 'hub':
+        recorded = sorted({r[4]['domain'] for r in records if 'domain' in r[4]})
+        registered = {r[4]['domain']:r[4]['items'] for r in records if r[3] == '/register' and r[4]}
+        loadgen.items_each = max([loadgen.items_each] + [len(tids) for tids in registered.values()])
+        servers.append(await loadgen.start_farm(max(1, len(recorded)), host, port))
+        await loadgen.register_farm(target)
+        for i, did in enumerate(recorded):
+            domains[did] = loadgen.farm[i]['id'], loadgen.farm[i]['secret']
+            mine = list(loadgen.farm[i]['items'])
+            for j, tid in enumerate(registered.get(did, ())):
+                items[tid] = mine[j % len(mine)]
+    else:
+        servers.append(await start_stand_in_hub(target, host, port))
+
+    results = [] # (route, seconds taken then, status then, seconds taken now or None if skipped, status now, offset)
+    slots = asyncio.Semaphore(concurrency)
+    async with ClientSession(connector=TCPConnector(limit=concurrency), timeout=ClientTimeout(total=30),
+            json_serialize=codec.dumps_str) as session:
+        async def send(t, took, status, route, body, before, start):
+            try:
+                await attempt(t, took, status, route, body, before, start)
+            except Exception: # a record that can't be replayed counts as skipped, rather than ending the replay
+                results.append((route, took, status, None, None, t - records[0][0]))
+
+        async def attempt(t, took, status, route, body, before, start):
+            if speed: await asyncio.sleep(max(0.0, start + (t - records[0][0])/speed - time.perf_counter()))
+            if before is not None: await before
+            if route == '/register': return # the stand-ins registered in place of the recorded domains
+            body = dict(body)
+            if server == 'hub' and route != '/login':
+                if body.get('user') not in users:
+                    results.append((route, took, status, None, None, t - records[0][0])) # logged in before recording began
+                    return
+                body['user'], secret = users[body['user']]
+                if route == '/command': body['secret'] = secret
+                if 'domain' in body: body['domain'], body['secret'] = domains[body['domain']]
+                if 'item' in body: body['item'] = items.get(body['item'], body['item'])
+                if route == '/command':
+                    body['command'] = [str(items.get(int(w), w)) if w.isascii() and w.isdigit() else w for w in body['command']]
+            elif route in ('/arrive', '/dropped'):
+                body['secret'] = stand_in['secret']
+            async with slots:
+                t0 = time.perf_counter()
+                try:
+                    request = session.get(target+route) if route == '/login' else session.post(target+route, json=body)
+                    async with request as resp:
+                        reply = await resp.read()
+                        now = resp.status
+                except Exception:
+                    reply, now = b'', 0
+                taken = time.perf_counter() - t0
+            if route == '/login' and now == 200 and 'user' in body:
+                login = codec.decode(reply)
+                users[body['user']] = login['id'], login['secret']
+            results.append((route, took, status, taken, now, t - records[0][0]))
+
+        last = {} # {recorded user: task sending their latest request}, so each user's requests stay in order
+        tasks = []
+        start = time.perf_counter()
+        for t, took, status, route, body in records:
+            who = body.get('user')
+            task = asyncio.create_task(send(t, took, status, route, body, last.get(who), start))
+            if who is not None: last[who] = task
+            tasks.append(task)
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+    for runner in servers: await runner.cleanup()
+    print(f'Replayed {len(records)} requests recorded over {records[-1][0]-records[0][0]:.1f}s in {elapsed:.1f}s\n')
+    report(results)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('traces', nargs='+', help='trace files from --record, e.g. one per hub worker')
+    parser.add_argument('--target', type=str, required=True, help='URL of the fresh hub or domain server to replay to')
+    parser.add_argument('--speed', type=float, default=1.0, help='how many times faster than recorded; 0 sends requests as fast as possible')
+    parser.add_argument('--concurrency', type=int, default=100, help='most requests in flight at once')
+    parser.add_argument('--host', type=str, default='0.0.0.0', help='address the stand-in domains or hub listen on')
+    parser.add_argument('-p','--port', type=int, default=3600, help='port the stand-in domains or hub listen on')
+    args = parser.parse_args()
+    asyncio.run(replay(args.traces, args.target, args.speed, args.concurrency, args.host, args.port))